@@ -0,0 +1,138 @@
+"""MongoDB auth lookup latency, two find_one calls versus one aggregation.
+
+Inserts ``--keys`` API keys and their users into ``cgc.api_keys`` and
+``cgc.rest_users`` of the given server and measures:
+
+  * the old lookup (``find_one`` on ``api_keys``, then on ``rest_users``,
+    full documents),
+  * ``MongoDatabase.user_list`` (one ``$lookup`` aggregation, projected),
+
+both with and without the indexes ``ensure_indexes`` creates. Results are
+written as JSON. The latency difference grows with the round-trip time, so
+run it from where the proxy runs against the real cluster topology, but on a
+scratch server: it refuses to touch non-empty collections and drops them
+afterwards.
+
+    python -m benchmarks.mongo_auth --uri mongodb://scratch:27017 --keys 10000
+"""
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import random
+import sys
+import time
+
+from llmproxy.db import MongoDatabase
+
+from benchmarks.sqlite_schema import percentiles
+
+
+def digest(i):
+    return hashlib.sha256(b"key-%d" % i).hexdigest()
+
+
+async def populate(cgc, keys):
+    chunk = 10_000
+    for base in range(0, keys, chunk):
+        n = min(chunk, keys - base)
+        await cgc["rest_users"].insert_many({"_id": "u%d" % i,
+            "namespace": "ns%d" % i, "org_id": i, "subscription_level": "pro",
+            "email": "user%d@example.com" % i, "settings": {"x": "y" * 512}}
+            for i in range(base, base + n))
+        await cgc["api_keys"].insert_many({"_id": "k%d" % i,
+            "user_id": "u%d" % i, "secret": digest(i), "access_level": "LLM",
+            "date_expiry": None, "comment": "bench"}
+            for i in range(base, base + n))
+
+
+async def old_lookup(cgc, secret):
+    key = await cgc["api_keys"].find_one({
+        "access_level": "LLM",
+        "secret": secret,
+        "$or": [
+            {"date_expiry": None},
+            {"date_expiry": {"$gt": datetime.datetime.now(datetime.UTC)}},
+        ],
+    })
+    user = await cgc["rest_users"].find_one({"_id": key["user_id"]})
+    return key, user
+
+
+async def measure(db, cgc, keys, samples):
+    rng = random.Random(1)
+    old, current = [], []
+    for _ in range(samples):
+        secret = digest(rng.randrange(keys))
+
+        start = time.perf_counter()
+        await old_lookup(cgc, secret)
+        old.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        rows = await db.user_list(secret)
+        current.append(time.perf_counter() - start)
+        assert len(rows) == 1
+
+    return {"find_one_ms": percentiles(old),
+        "aggregate_ms": percentiles(current)}
+
+
+async def run(args):
+    db = await MongoDatabase.create(args.uri)
+    cgc = db.db["cgc"]
+    try:
+        for name in ("api_keys", "rest_users", "billing_record"):
+            if await cgc[name].estimated_document_count():
+                print("cgc.%s is not empty, refusing to run" % name,
+                    file=sys.stderr)
+                sys.exit(1)
+
+        await populate(cgc, args.keys)
+        try:
+            results = {"no_indexes": await measure(db, cgc, args.keys,
+                args.samples)}
+            await db.ensure_indexes()
+            results["indexes"] = await measure(db, cgc, args.keys,
+                args.samples)
+        finally:
+            for name in ("api_keys", "rest_users", "billing_record"):
+                await cgc[name].drop()
+    finally:
+        await db.close()
+
+    return results
+
+
+parser = argparse.ArgumentParser("benchmarks.mongo_auth",
+    description="Measure MongoDB auth lookup latency")
+parser.add_argument("--uri", required=True,
+    help="mongodb:// URI of a scratch server")
+parser.add_argument("--keys", type=int, default=10_000,
+    help="API keys (and users) to insert")
+parser.add_argument("--samples", type=int, default=1000,
+    help="measured lookups per variant")
+parser.add_argument("-o", "--output", help="write JSON results to this file")
+
+
+def main():
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+
+    report = {
+        "params": {"keys": args.keys, "samples": args.samples},
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""SQLite auth and billing insert latency, schema v1 versus the current one.
+
+Builds a database with the version-1 schema (no indexes), ``--keys`` API keys
+and ``--events`` billing rows, and measures:
+
+  * auth lookup latency with the old query (``secret LIKE ? || '%'``),
+  * billing insert latency the way the old code wrote it (one INSERT per
+    resource and a commit, rollback journal, synchronous=FULL),
+
+then opens it with ``SqliteDatabase.create`` (timing the migration) and
+measures ``user_list(..., exact=True)`` and ``billing_record_add`` again.
+Results are written as JSON.
+
+The defaults (1M keys, 100M events) need ~10 GB of disk and take a while to
+populate; try smaller sizes first:
+
+    python -m benchmarks.sqlite_schema --keys 100000 --events 1000000
+"""
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import importlib.resources
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+from llmproxy.db import SqliteDatabase
+
+V1_AUTH = """
+    SELECT id, secret, expires,
+        CASE WHEN CURRENT_TIMESTAMP >= expires THEN 'expired'
+            ELSE 'active' END AS status,
+        IFNULL(comment, '') AS comment
+    FROM api_key
+    WHERE type = 'LLM' AND secret LIKE ? || '%'
+        AND (? OR expires > datetime() OR expires IS NULL)
+    """
+
+INSERT = """
+    INSERT INTO event_oneoff (created, api_key, product, quantity, rid)
+    VALUES (?, ?, ?, ?, ?)
+    """
+
+PRODUCTS = ("bench/none/prompt", "bench/none/completion")
+
+
+def digest(i):
+    return hashlib.sha256(b"key-%d" % i).hexdigest()
+
+
+def populate(path, keys, events):
+    schema = importlib.resources.files("llmproxy") \
+        .joinpath("schema.sql").read_text()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executescript(schema)
+    conn.execute("PRAGMA user_version = 1")
+
+    conn.executemany("INSERT INTO api_key (id, secret, type) "
+        "VALUES (?, ?, 'LLM')", ((str(i), digest(i)) for i in range(keys)))
+
+    rng = random.Random(0)
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+    step = datetime.timedelta(seconds=1)
+    chunk = 1_000_000
+    for base in range(0, events, chunk):
+        conn.executemany(INSERT, (
+            ((start + (base + i) // 2 * step).isoformat(),
+                str(rng.randrange(keys)), PRODUCTS[(base + i) % 2],
+                rng.randrange(1, 2000), "r%d" % ((base + i) // 2))
+            for i in range(min(chunk, events - base))))
+        conn.commit()
+        print("Populated %d/%d events" % (min(base + chunk, events), events),
+            file=sys.stderr)
+
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {"p%d" % p:
+        samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000
+        for p in (50, 99)}
+
+
+def measure_v1(path, keys, samples):
+    conn = sqlite3.connect(path)
+    rng = random.Random(1)
+
+    auth = []
+    for _ in range(samples):
+        secret = digest(rng.randrange(keys))
+        start = time.perf_counter()
+        rows = conn.execute(V1_AUTH, (secret, False)).fetchall()
+        auth.append(time.perf_counter() - start)
+        assert len(rows) == 1
+
+    insert = []
+    for _ in range(samples):
+        rid = str(uuid.uuid4())
+        now = datetime.datetime.now(datetime.UTC)
+        start = time.perf_counter()
+        for product in PRODUCTS:
+            conn.execute(INSERT, (now, "0", product, 1, rid))
+        conn.commit()
+        insert.append(time.perf_counter() - start)
+
+    conn.close()
+    return {"auth_ms": percentiles(auth), "insert_ms": percentiles(insert)}
+
+
+async def measure_current(path, keys, samples):
+    start = time.perf_counter()
+    db = await SqliteDatabase.create("sqlite://%s" % path)
+    migration = time.perf_counter() - start
+    rng = random.Random(1)
+
+    try:
+        auth = []
+        for _ in range(samples):
+            secret = digest(rng.randrange(keys))
+            start = time.perf_counter()
+            rows = await db.user_list(secret, exact=True)
+            auth.append(time.perf_counter() - start)
+            assert len(rows) == 1
+
+        insert = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            await db.billing_record_add({"id": "0"},
+                datetime.datetime.now(datetime.UTC),
+                dict.fromkeys(PRODUCTS, 1), uuid.uuid4())
+            insert.append(time.perf_counter() - start)
+    finally:
+        await db.close()
+
+    return {"migration_s": migration, "auth_ms": percentiles(auth),
+        "insert_ms": percentiles(insert)}
+
+
+parser = argparse.ArgumentParser("benchmarks.sqlite_schema",
+    description="Measure SQLite auth and billing insert latency")
+parser.add_argument("--keys", type=int, default=1_000_000,
+    help="API keys in the database")
+parser.add_argument("--events", type=int, default=100_000_000,
+    help="billing rows in the database")
+parser.add_argument("--samples", type=int, default=1000,
+    help="measured lookups and inserts per schema")
+parser.add_argument("--dir", help="directory for the database file "
+    "(default: system temp dir)")
+parser.add_argument("-o", "--output", help="write JSON results to this file")
+
+
+def main():
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".sqlite", dir=args.dir)
+    os.close(fd)
+    try:
+        populate(path, args.keys, args.events)
+        v1 = measure_v1(path, args.keys, args.samples)
+        current = asyncio.run(measure_current(path, args.keys, args.samples))
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+    report = {
+        "params": {"keys": args.keys, "events": args.events,
+            "samples": args.samples},
+        "results": {"v1": v1, "current": current},
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
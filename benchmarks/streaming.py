@@ -0,0 +1,294 @@
+"""Streaming throughput benchmark.
+
+Pushes generated SSE streams from the mock backend (tests/mockbackend.py)
+through the proxy and, as a baseline, straight from the backend, and reports
+per shape (chat, messages, responses):
+
+  * tokens/s delivered to the clients,
+  * per-token latency (client receive time minus backend send time) p50/p99,
+  * CPU time per stream and peak RSS of the process,
+
+plus the proxy overhead (proxy minus direct). Every case runs in a fresh
+interpreter so CPU and RSS are not polluted by earlier cases. Results are
+written as JSON; pass ``--baseline`` with an earlier result file to fail on a
+throughput regression.
+
+Runs offline from the repository root:
+
+    python -m benchmarks.streaming --streams 100 --tokens 2000 -o bench.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import aiohttp.test_utils
+
+from llmproxy.app import create_app
+from llmproxy.db import get_db
+from tests import mockbackend
+
+SHAPES = {
+    "chat": ("/v1/chat/completions",
+        {"messages": [{"role": "user", "content": "hi"}]}),
+    "messages": ("/v1/messages",
+        {"max_tokens": 4, "messages": [{"role": "user", "content": "hi"}]}),
+    "responses": ("/v1/responses", {"input": "hi"}),
+}
+
+TARGETS = ("direct", "proxy")
+
+STAMP = re.compile(rb'"t": ([0-9.]+)')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def start_proxy(backend, db_path, args):
+    cfg = {
+        "log_level": "WARNING",
+        "timeout_connect": 5,
+        "timeout_read": 60,
+        "db": {"uri": "sqlite://%s" % db_path},
+        "backends": {
+            "mymodel": {
+                "url": "http://%s:%d" % (backend.host, backend.port),
+                "token": "benchtoken",
+                "device": "none",
+            },
+        },
+    }
+    if args.coalesce_bytes:
+        cfg["coalesce_bytes"] = args.coalesce_bytes
+        cfg["coalesce_ms"] = args.coalesce_ms
+
+    app = await create_app(cfg)
+
+    db = await get_db(cfg["db"]["uri"])
+    await db.db.execute("""
+        INSERT INTO api_key (id, secret, type) VALUES ('bench', ?, 'LLM')
+        """, (hashlib.sha256(b"benchtoken").hexdigest(),))
+    await db.db.commit()
+    await db.close()
+
+    server = aiohttp.test_utils.TestServer(app)
+    await server.start_server()
+    return server
+
+
+async def one_stream(session, url, body, latencies):
+    tokens = 0
+    async with session.post(url, json=body,
+            headers={"Authorization": "Bearer benchtoken"}) as res:
+        if res.status != 200:
+            raise RuntimeError("HTTP %d from %s" % (res.status, url))
+        async for data in res.content.iter_any():
+            now = time.monotonic()
+            for m in STAMP.finditer(data):
+                latencies.append(now - float(m.group(1)))
+                tokens += 1
+    return tokens
+
+
+async def run_case(shape, target, args):
+    logging.disable(logging.WARNING)
+
+    backend = aiohttp.test_utils.TestServer(mockbackend.create_app())
+    await backend.start_server()
+
+    fd, db_path = tempfile.mkstemp()
+    os.close(fd)
+    proxy = None
+    try:
+        if target == "proxy":
+            proxy = await start_proxy(backend, db_path, args)
+            server = proxy
+        else:
+            server = backend
+
+        path, extra = SHAPES[shape]
+        url = "http://%s:%d%s" % (server.host, server.port, path)
+        body = {"model": "mymodel", "stream": True, "_tokens": args.tokens,
+            "_token_size": args.token_size, "_chunk": args.chunk,
+            "_delay": args.delay, **extra}
+
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            latencies = []
+            cpu = time.process_time()
+            start = time.monotonic()
+            counts = await asyncio.gather(*(
+                one_stream(session, url, body, latencies)
+                for _ in range(args.streams)))
+            wall = time.monotonic() - start
+            cpu = time.process_time() - cpu
+    finally:
+        if proxy is not None:
+            await proxy.close()
+        await backend.close()
+        os.unlink(db_path)
+
+    tokens = sum(counts)
+    if tokens != args.tokens * args.streams:
+        raise RuntimeError("lost tokens: got %d, expected %d" %
+            (tokens, args.tokens * args.streams))
+
+    return {
+        "shape": shape,
+        "target": target,
+        "streams": args.streams,
+        "tokens": tokens,
+        "wall_s": wall,
+        "tokens_per_s": tokens / wall,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+        },
+        "cpu_ms_per_stream": cpu * 1000 / args.streams,
+        # Linux reports ru_maxrss in KiB.
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def overhead(results):
+    by_case = {(r["shape"], r["target"]): r for r in results}
+    rows = []
+    for shape in dict.fromkeys(r["shape"] for r in results):
+        direct = by_case.get((shape, "direct"))
+        proxy = by_case.get((shape, "proxy"))
+        if direct is None or proxy is None:
+            continue
+        rows.append({
+            "shape": shape,
+            "added_latency_ms": {
+                p: proxy["latency_ms"][p] - direct["latency_ms"][p]
+                for p in ("p50", "p99")
+            },
+            "cpu_ms_per_stream":
+                proxy["cpu_ms_per_stream"] - direct["cpu_ms_per_stream"],
+            "rss_kib": proxy["peak_rss_kib"] - direct["peak_rss_kib"],
+        })
+    return rows
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print tokens/s against ``baseline``; return False if any case dropped
+    by more than ``tolerance`` (a fraction)."""
+    old = {(r["shape"], r["target"]): r for r in baseline["results"]}
+    ok = True
+    for r in results:
+        prev = old.get((r["shape"], r["target"]))
+        if prev is None:
+            continue
+        change = r["tokens_per_s"] / prev["tokens_per_s"] - 1
+        regressed = r["target"] == "proxy" and change < -tolerance
+        ok = ok and not regressed
+        print("%-9s %-6s %10.0f tok/s  %+6.1f%%%s" % (r["shape"], r["target"],
+            r["tokens_per_s"], change * 100, "  REGRESSION" if regressed else ""),
+            file=sys.stderr)
+    return ok
+
+
+parser = argparse.ArgumentParser("benchmarks.streaming",
+    description="Measure streaming overhead of the proxy")
+parser.add_argument("--streams", type=int, default=50,
+    help="concurrent streams per case")
+parser.add_argument("--tokens", type=int, default=1000,
+    help="content deltas per stream")
+parser.add_argument("--token-size", type=int, default=4,
+    help="characters per delta")
+parser.add_argument("--chunk", type=int, default=1,
+    help="deltas per backend write")
+parser.add_argument("--delay", type=float, default=0,
+    help="seconds between backend writes")
+parser.add_argument("--shape", action="append", choices=sorted(SHAPES),
+    help="stream shape(s) to run (default: all)")
+parser.add_argument("--coalesce-bytes", type=int, default=0,
+    help="enable proxy write coalescing with this byte bound")
+parser.add_argument("--coalesce-ms", type=float, default=0,
+    help="proxy write coalescing delay")
+parser.add_argument("-o", "--output", help="write JSON results to this file")
+parser.add_argument("--baseline",
+    help="earlier JSON result to compare tokens/s against")
+parser.add_argument("--tolerance", type=float, default=0.1,
+    help="allowed tokens/s drop versus --baseline (fraction)")
+parser.add_argument("--case", help=argparse.SUPPRESS)
+
+
+def main():
+    args = parser.parse_args()
+
+    if args.case:
+        shape, target = args.case.split(":")
+        json.dump(asyncio.run(run_case(shape, target, args)), sys.stdout)
+        return
+
+    passthrough = ["--streams", str(args.streams), "--tokens", str(args.tokens),
+        "--token-size", str(args.token_size), "--chunk", str(args.chunk),
+        "--delay", str(args.delay),
+        "--coalesce-bytes", str(args.coalesce_bytes),
+        "--coalesce-ms", str(args.coalesce_ms)]
+    results = []
+    for shape in args.shape or SHAPES:
+        for target in TARGETS:
+            print("Running %s/%s" % (shape, target), file=sys.stderr)
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.streaming",
+                    *passthrough, "--case", "%s:%s" % (shape, target)],
+                capture_output=True, text=True)
+            if out.returncode != 0:
+                print(out.stderr, file=sys.stderr)
+                sys.exit(1)
+            results.append(json.loads(out.stdout))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {k: v for k, v in vars(args).items()
+                if k not in ("output", "baseline", "tolerance", "case")},
+        },
+        "results": results,
+        "overhead": overhead(results),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
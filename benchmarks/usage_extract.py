@@ -0,0 +1,84 @@
+"""Usage extraction benchmark for non-stream bodies.
+
+Compares the full ``json.loads(body, parse_float=decimal.Decimal)`` the
+handlers used to run with ``jsonscan.top_level_member`` on a synthetic vLLM
+embeddings response (``--inputs`` vectors of ``--dim`` floats) and writes the
+timings as JSON.
+
+    python -m benchmarks.usage_extract --inputs 64 --dim 4096
+"""
+
+import argparse
+import decimal
+import json
+import random
+import sys
+import timeit
+
+from llmproxy.jsonscan import top_level_member
+
+
+def embeddings_body(inputs, dim):
+    rng = random.Random(0)
+    return json.dumps({
+        "id": "embd-0",
+        "object": "list",
+        "created": 0,
+        "model": "bench",
+        "data": [{"index": i, "object": "embedding",
+            "embedding": [rng.uniform(-1, 1) for _ in range(dim)]}
+            for i in range(inputs)],
+        "usage": {"prompt_tokens": inputs * 16, "total_tokens": inputs * 16,
+            "completion_tokens": 0, "prompt_tokens_details": None},
+    }).encode()
+
+
+parser = argparse.ArgumentParser("benchmarks.usage_extract",
+    description="Measure usage extraction from large embedding responses")
+parser.add_argument("--inputs", type=int, default=64,
+    help="embedding vectors per response")
+parser.add_argument("--dim", type=int, default=4096,
+    help="floats per vector")
+parser.add_argument("--repeat", type=int, default=5,
+    help="timing repetitions (best is reported)")
+parser.add_argument("-o", "--output", help="write JSON results to this file")
+
+
+def main():
+    args = parser.parse_args()
+    body = embeddings_body(args.inputs, args.dim)
+
+    def full():
+        return json.loads(body, parse_float=decimal.Decimal)["usage"]
+
+    def targeted():
+        return top_level_member(body, "usage")
+
+    assert full() == targeted()
+
+    results = {}
+    for name, fn in (("full_parse", full), ("top_level_member", targeted)):
+        timer = timeit.Timer(fn)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=args.repeat, number=number)) / number
+        results[name] = {"seconds": best, "mb_per_s": len(body) / best / 1e6}
+
+    report = {
+        "params": {"inputs": args.inputs, "dim": args.dim,
+            "body_bytes": len(body)},
+        "results": results,
+        "speedup": results["full_parse"]["seconds"]
+            / results["top_level_member"]["seconds"],
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    print("Speedup: %.0fx" % report["speedup"], file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
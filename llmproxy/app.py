@@ -1,5 +1,6 @@
 import argparse
 import asyncio
+import contextlib
 import functools
 import logging
 import pathlib
@@ -9,28 +10,100 @@ import sys
 import uuid
 
 import aiohttp.web
-import yarl
 
-from . import audio, chat, config, embeddings, messages, metrics, responses
-from .db import get_db
+from . import (audio, auth, balancer, billing, chat, config, embeddings,
+    messages, metrics, ratelimit, responses)
+from .db import Pool
 
 
-async def check_db(app):
-    db = await get_db(app["config"]["db"]["uri"])
-    await db.close()
+async def open_db_pool(app):
+    db_cfg = app["config"]["db"]
+    app["db_pool"] = await Pool.create(db_cfg["uri"],
+        db_cfg.get("pool_size", 4), db_cfg.get("pool_check_idle", 30))
+
+    async def db_pool_close(app):
+        await app["db_pool"].close()
+    app.on_cleanup.append(db_pool_close)
+
+    if db_cfg.get("ensure_indexes", False):
+        async with app["db_pool"].connection() as db:
+            await db.ensure_indexes()
 
     logging.info("Database ready")
 
 
+async def open_billing_queue(app):
+    billing_cfg = app["config"].get("billing", {})
+    if "journal" not in billing_cfg:
+        return
+
+    app["billing_queue"] = await billing.BillingQueue.open(app["db_pool"],
+        billing_cfg["journal"], billing_cfg.get("batch_size", 500),
+        billing_cfg.get("flush_interval", 1))
+
+    # Before the pool closes (cleanup callbacks run in order).
+    async def billing_queue_close(app):
+        await app["billing_queue"].close()
+    app.on_cleanup.insert(0, billing_queue_close)
+
+
+async def open_key_filter(app):
+    auth_cfg = app["config"].get("auth", {})
+    if not auth_cfg.get("key_filter", False):
+        return
+
+    app["key_filter"] = auth.KeyFilter(
+        fp_rate=auth_cfg.get("key_filter_fp_rate", 0.001),
+        miss_lookups=auth_cfg.get("key_filter_miss_lookups", 1))
+    await app["key_filter"].load(app["db_pool"])
+    start_refresh(app, app["key_filter"],
+        auth_cfg.get("key_filter_interval", 60))
+
+    logging.info("API key filter ready (%d keys)", app["key_filter"].count)
+
+
+async def open_revoked_keys(app):
+    auth_cfg = app["config"].get("auth", {})
+    if "signing_key" not in auth_cfg:
+        return
+
+    app["revoked_keys"] = auth.RevokedKeys()
+    await app["revoked_keys"].load(app["db_pool"])
+    start_refresh(app, app["revoked_keys"],
+        auth_cfg.get("revocation_interval", 30))
+
+
+def start_refresh(app, what, interval):
+    """Reload ``what`` in the background; SIGUSR1 reloads it immediately."""
+    wakeup = asyncio.Event()
+    app["auth_refresh"].append(wakeup)
+    task = asyncio.create_task(auth.refresh(what, wakeup, interval,
+        app["db_pool"]))
+
+    # Before the pool closes (cleanup callbacks run in order).
+    async def refresh_close(app):
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    app.on_cleanup.insert(0, refresh_close)
+
+
+def open_balancer(app):
+    app["balancer"] = balancer.Balancer()
+    app["balancer"].update(app["config"])
+
+    async def balancer_close(app):
+        await app["balancer"].close()
+    app.on_cleanup.append(balancer_close)
+
+
 async def check_backends(app):
-    for name, cfg in app["config"].get("backends", {}).items():
-        try:
-            ssl = None if cfg.get("verify_ssl", True) else False
-            await app["client"].get(yarl.URL(cfg["url"]) / "health", ssl=ssl,
-                raise_for_status=True)
-            logging.info("Backend %s ready", name)
-        except aiohttp.ClientError as e:
-            logging.error("Backend %s not ready: %s", name, e)
+    for name, replicas in app["balancer"].backends.items():
+        for replica in replicas:
+            if await replica.check():
+                logging.info("Backend %s ready (%s)", name, replica.url)
+            else:
+                logging.error("Backend %s not ready (%s)", name, replica.url)
 
 
 @aiohttp.web.middleware
@@ -66,18 +139,6 @@ async def add_cors_headers(req, handler):
     return res
 
 
-@aiohttp.web.middleware
-async def close_db(req, handler):
-    try:
-        res = await handler(req)
-    finally:
-        db = req.pop("db", None)
-        if db is not None:
-            await db.close()
-
-    return res
-
-
 JSON_BODY_LIMIT = 32 * 1024 * 1024  # default cap for non-upload endpoints
 
 
@@ -90,11 +151,10 @@ async def limit_request_body(req, handler):
     # chunked bodies with no Content-Length; aiohttp has no public per-route
     # limit), and reject early when the client declares an oversized body.
     if req.path != "/v1/audio/transcriptions":
-        # Only the audio route consumes multipart. On the JSON text endpoints a
-        # multipart body would be parsed by aiohttp's post(): each non-file
-        # field is read WHOLE into memory before _client_max_size is checked, so
-        # it bypasses the byte-bounded read below and lets an authenticated
-        # client OOM the single worker. Reject it here, before any body is read.
+        # Only the audio route consumes multipart (streamed by formstream,
+        # which enforces client_max_size itself). The text endpoints have no
+        # use for it, and any multipart parse there would bypass the
+        # byte-bounded read below. Reject it here, before any body is read.
         if req.content_type == "multipart/form-data":
             raise aiohttp.web.HTTPUnsupportedMediaType(
                 text="multipart/form-data is not supported on this endpoint")
@@ -106,6 +166,13 @@ async def limit_request_body(req, handler):
     return await handler(req)
 
 
+def clear_key_cache(app):
+    app["key_cache"].clear()
+    for wakeup in app["auth_refresh"]:
+        wakeup.set()
+    app.logger.info("API key cache cleared")
+
+
 def reload_config(app):
     try:
         cfg = config.load(app["config"]["_path"])
@@ -113,8 +180,15 @@ def reload_config(app):
         app.logger.error("Failed reloading config: %s", e)
         return
 
-    # Only backends are reloaded
+    # Only backends (and their global defaults) are reloaded. Replicas that
+    # are kept keep their state; requests in flight to removed ones finish.
     app["config"]["backends"] = cfg.get("backends", {})
+    for key in config.BACKEND_DEFAULTS:
+        if key in cfg:
+            app["config"][key] = cfg[key]
+        else:
+            app["config"].pop(key, None)
+    app["balancer"].update(app["config"])
     app.logger.info("Config reloaded. Configured backends: %s",
         " ".join(app["config"]["backends"]) or "none")
 
@@ -133,7 +207,6 @@ async def create_app(cfg):
             assign_request_id,
             add_request_id_header,
             add_cors_headers,
-            close_db,
             limit_request_body,
         ])
 
@@ -169,17 +242,20 @@ async def create_app(cfg):
 
     app["config"] = cfg
 
-    await check_db(app)
+    await open_db_pool(app)
+    await open_billing_queue(app)
 
-    timeout = aiohttp.ClientTimeout(
-        connect=app["config"]["timeout_connect"],
-        sock_read=app["config"]["timeout_read"],
-    )
-    app["client"] = aiohttp.ClientSession(timeout=timeout)
-    async def client_close(app):
-        await app["client"].close()
-    app.on_cleanup.append(client_close)
+    auth_cfg = cfg.get("auth", {})
+    app["key_cache"] = auth.KeyCache(auth_cfg.get("cache_size", 10000),
+        auth_cfg.get("cache_ttl", 60), auth_cfg.get("cache_negative_ttl", 5))
+    app["auth_refresh"] = []
+    await open_key_filter(app)
+    await open_revoked_keys(app)
+
+    if "rate_limit" in cfg:
+        app["rate_limiter"] = ratelimit.RateLimiter(cfg["rate_limit"])
 
+    open_balancer(app)
     await check_backends(app)
 
     return app
@@ -216,6 +292,11 @@ def main():
     if hasattr(signal, "SIGHUP"):
         loop.add_signal_handler(signal.SIGHUP,
             functools.partial(reload_config, app))
+    # Sent after `llmproxyctl user update` so a revoked key stops working
+    # before its cache entry expires.
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1,
+            functools.partial(clear_key_cache, app))
 
     ssl_ctx = None
     if (cert := app["config"].get("cert")) and (key := app["config"].get("key")):
@@ -1,10 +1,9 @@
 import decimal
-import json
 import math
 
 import aiohttp
 
-from . import auth, billing, metrics, proxy
+from . import auth, billing, jsonscan, metrics, proxy
 
 
 def force_verbose(body):
@@ -28,12 +27,11 @@ async def transcriptions(f_req):
             request_id=f_req["request_id"])
 
         body = await b_res.content.read()
-        data = json.loads(body, parse_float=decimal.Decimal)
 
         # Duration (seconds) is the only billable quantity for transcription. If
         # the backend omits it or reports <= 0 we cannot bill, so fail loud with
         # a 502 + log instead of a 500-after-response with the request unbilled.
-        duration = data.get("duration")
+        duration = jsonscan.top_level_member(body, "duration", None)
         if (not isinstance(duration, (int, float, decimal.Decimal))
                 or isinstance(duration, bool)
                 or not math.isfinite(duration)
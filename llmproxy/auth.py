@@ -1,26 +1,326 @@
+import asyncio
+import base64
+import collections
+import contextlib
+import datetime
 import hashlib
+import hmac
+import json
+import logging
+import math
+import time
 
 import aiohttp.web
 
-from .db import DatabaseError, get_db
+from . import metrics
+from .db import DatabaseError
 
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+def _expiry(value):
+    """Return the key's expiry (an ``expires`` column value: a datetime from
+    Mongo, an ISO string from SQLite) as a POSIX timestamp, or None."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.UTC)
+    return value.timestamp()
+
+
+class KeyCache:
+    """LRU cache of API key lookups, keyed by the token's SHA-256 digest.
+
+    Valid keys are kept for ``ttl`` seconds but never past their own expiry;
+    unknown keys are remembered (as None) for ``negative_ttl`` seconds so a
+    client retrying with a bad key doesn't hit the database each time. A
+    ``size`` of 0 disables the cache. ``clear()`` drops everything (SIGUSR1).
+    """
+
+    def __init__(self, size=10000, ttl=60, negative_ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = collections.OrderedDict()  # digest -> (user, deadline)
+
+    def get(self, digest):
+        """Return the cached user row, None for a cached unknown key, or
+        ``_MISSING``."""
+        entry = self._entries.get(digest)
+        if entry is not None and time.time() >= entry[1]:
+            del self._entries[digest]
+            entry = None
+
+        if entry is None:
+            if self.size:
+                metrics.AUTH_CACHE_LOOKUPS_TOTAL.labels("miss").inc()
+            return _MISSING
+
+        self._entries.move_to_end(digest)
+        metrics.AUTH_CACHE_LOOKUPS_TOTAL.labels("hit").inc()
+        return entry[0]
+
+    def put(self, digest, user):
+        if not self.size:
+            return
+
+        now = time.time()
+        if user is None:
+            deadline = now + self.negative_ttl
+        else:
+            deadline = now + self.ttl
+            if (expires := _expiry(user.get("expires"))) is not None:
+                deadline = min(deadline, expires)
+        if deadline <= now:
+            return
+
+        self._entries[digest] = (user, deadline)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            metrics.AUTH_CACHE_EVICTIONS_TOTAL.inc()
+
+    def clear(self):
+        self._entries.clear()
+
+
+class KeyFilter:
+    """Bloom filter of the digests of all valid API keys, sized for
+    ``capacity`` keys at a false positive rate of ``fp_rate``.
+
+    ``digest in filter`` is False only for a digest that was never added, so
+    ``require_auth`` can reject it without a database lookup. The bit
+    positions are slices of the SHA-256 digest itself, which is already
+    uniformly distributed, so no further hashing is needed.
+
+    Keys created since the last rebuild aren't in the filter. So that they
+    work right away, ``require_auth`` still looks up up to ``miss_lookups``
+    rejected keys per second (``allow_lookup``) and adds the ones found.
+    """
+
+    def __init__(self, capacity=0, fp_rate=0.001, miss_lookups=1):
+        capacity = max(capacity, 1)
+        self.target_fp_rate = fp_rate
+        self.miss_lookups = miss_lookups
+        self._allowance = miss_lookups
+        self._allowance_at = time.monotonic()
+        self.bits = max(64, math.ceil(
+            -capacity * math.log(fp_rate) / math.log(2) ** 2))
+        # A 32-byte digest has eight 4-byte slices.
+        self.hashes = min(8, max(1, round(self.bits / capacity * math.log(2))))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, digest):
+        try:
+            raw = bytes.fromhex(digest)
+        except ValueError:
+            raw = b""
+        if len(raw) != 32:  # not a SHA-256 hex digest
+            raw = hashlib.sha256(digest.encode()).digest()
+        for i in range(0, 4 * self.hashes, 4):
+            yield int.from_bytes(raw[i:i + 4], "little") % self.bits
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self._array[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        return all(self._array[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(digest))
+
+    def allow_lookup(self):
+        """Whether a key the filter rejected may be looked up anyway."""
+        now = time.monotonic()
+        self._allowance = min(max(1, self.miss_lookups), self._allowance
+            + (now - self._allowance_at) * self.miss_lookups)
+        self._allowance_at = now
+        if self._allowance < 1:
+            return False
+        self._allowance -= 1
+        return True
+
+    def fp_rate(self):
+        """Expected false positive rate at the current fill."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) \
+            ** self.hashes
+
+    async def load(self, pool, batch=10000):
+        """Replace the contents with the digests of all valid keys, sized for
+        their number. Loads a batch per connection use so requests aren't
+        kept waiting for the pool, and swaps the new filter in at the end."""
+        async with pool.connection() as db:
+            count = await db.key_count()
+        # Headroom for keys found by lookups before the next rebuild.
+        fresh = KeyFilter(int(count * 1.1) + 100, self.target_fp_rate)
+
+        after = ""
+        while True:
+            async with pool.connection() as db:
+                digests = await db.key_digests(after, batch)
+            for digest in digests:
+                fresh.add(digest)
+            if len(digests) < batch:
+                break
+            after = digests[-1]
+
+        self.bits, self.hashes = fresh.bits, fresh.hashes
+        self.count, self._array = fresh.count, fresh._array
+        metrics.AUTH_FILTER_KEYS.set(self.count)
+        metrics.AUTH_FILTER_FP_RATE.set(self.fp_rate())
 
-async def require_auth(req):
-    db = await get_db(req.app["config"]["db"]["uri"], req)
 
+class RevokedKeys:
+    """Ids of API keys revoked in the database (expiry set to the past), for
+    signed keys, which are otherwise verified without a lookup."""
+
+    def __init__(self):
+        self.ids = frozenset()
+
+    def __contains__(self, key_id):
+        return key_id in self.ids
+
+    async def load(self, pool):
+        async with pool.connection() as db:
+            self.ids = frozenset(await db.revoked_key_ids())
+        metrics.AUTH_REVOKED_KEYS.set(len(self.ids))
+
+
+async def refresh(what, wakeup, interval, pool):
+    """Reload ``what`` (a ``KeyFilter`` or ``RevokedKeys``) every ``interval``
+    seconds, or when the event ``wakeup`` is set (SIGUSR1). On failure the
+    previous contents stay in use."""
+    while True:
+        with contextlib.suppress(TimeoutError):
+            await asyncio.wait_for(wakeup.wait(), interval)
+        wakeup.clear()
+
+        try:
+            await what.load(pool)
+        except DatabaseError as e:
+            logger.error("Failed reloading %s: %s", type(what).__name__, e)
+
+
+SIGNED_PREFIX = "llmp1."
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def sign_key(secret, claims):
+    """Return a signed API key carrying ``claims`` (``id`` and optionally
+    ``exp``, a POSIX timestamp, and the billing identity: ``uid`` (user id),
+    ``org``, ``ns`` (namespace) and ``tier``), HMAC-SHA256 signed with
+    ``secret``."""
+    payload = _b64(json.dumps(claims, separators=(",", ":")).encode())
+    mac = hmac.new(secret.encode(), payload.encode(), hashlib.sha256)
+    return "%s%s.%s" % (SIGNED_PREFIX, payload, _b64(mac.digest()))
+
+
+def verify_key(secret, token):
+    """Return the claims of a signed key made with ``secret``, or None if it
+    is malformed or the signature doesn't match. Expiry isn't checked."""
+    payload, _, sig = token.removeprefix(SIGNED_PREFIX).partition(".")
+    mac = hmac.new(secret.encode(), payload.encode(), hashlib.sha256)
+    try:
+        if not hmac.compare_digest(_unb64(sig), mac.digest()):
+            return None
+        claims = json.loads(_unb64(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or not isinstance(claims.get("id"), str):
+        return None
+    return claims
+
+
+def _signed_user(req, token):
+    """The user row of a signed key, verified in memory, or None."""
+    claims = verify_key(req.app["config"]["auth"]["signing_key"], token)
+    if claims is None:
+        metrics.AUTH_SIGNED_KEYS_TOTAL.labels("invalid").inc()
+        return None
+
+    expires = claims.get("exp")
+    if expires is not None and time.time() >= expires:
+        metrics.AUTH_SIGNED_KEYS_TOTAL.labels("expired").inc()
+        return None
+    if claims["id"] in req.app["revoked_keys"]:
+        metrics.AUTH_SIGNED_KEYS_TOTAL.labels("revoked").inc()
+        return None
+
+    metrics.AUTH_SIGNED_KEYS_TOTAL.labels("valid").inc()
+    # Every field of a database user row, so billing works the same on
+    # either database.
+    user = {"id": claims["id"], "expires": None, "comment": None,
+        "_user_id": claims.get("uid"), "_org_id": claims.get("org", ""),
+        "_namespace": claims.get("ns", ""), "_tier": claims.get("tier", "")}
+    if expires is not None:
+        user["expires"] = datetime.datetime.fromtimestamp(expires,
+            datetime.UTC)
+    return user
+
+
+async def require_auth(req):
     scheme, _, token = req.headers.get("Authorization", "").partition(" ")
     if scheme != "Bearer":
         raise aiohttp.web.HTTPUnauthorized(text="Unsupported authorization scheme")
 
+    if token.startswith(SIGNED_PREFIX) and "revoked_keys" in req.app:
+        user = _signed_user(req, token)
+        if user is None:
+            raise aiohttp.web.HTTPUnauthorized(text="Incorrect API key")
+        req["user"] = user
+        return user
+
     digest = hashlib.sha256(token.encode()).hexdigest()
 
-    try:
-        rows = await db.user_list(digest)
-    except DatabaseError as e:
-        req.app.logger.critical(e)
-        raise aiohttp.web.GracefulExit() from e
+    cache = req.app["key_cache"]
+    user = cache.get(digest)
+    if user is _MISSING:
+        key_filter = req.app.get("key_filter")
+        passed = True
+        if key_filter is not None:
+            passed = digest in key_filter
+            if passed:
+                metrics.AUTH_FILTER_CHECKS_TOTAL.labels("passed").inc()
+            elif key_filter.allow_lookup():
+                # Maybe a key created since the filter was built.
+                metrics.AUTH_FILTER_CHECKS_TOTAL.labels("looked_up").inc()
+            else:
+                metrics.AUTH_FILTER_CHECKS_TOTAL.labels("rejected").inc()
+                raise aiohttp.web.HTTPUnauthorized(text="Incorrect API key")
+
+        try:
+            async with req.app["db_pool"].connection() as db:
+                rows = await db.user_list(digest, exact=True)
+        except DatabaseError as e:
+            req.app.logger.critical(e)
+            raise aiohttp.web.GracefulExit() from e
+
+        user = rows[0] if rows else None
+        cache.put(digest, user)
+        if key_filter is not None:
+            if user is None and passed:
+                metrics.AUTH_FILTER_FALSE_POSITIVES_TOTAL.inc()
+            elif user is not None and not passed:
+                key_filter.add(digest)
 
-    if not rows:
+    if user is None:
         raise aiohttp.web.HTTPUnauthorized(text="Incorrect API key")
 
-    return rows[0]
+    # For the rate limits in proxy.request.
+    req["user"] = user
+    return user
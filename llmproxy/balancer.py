@@ -0,0 +1,560 @@
+"""Backend replicas: load balancing, health checks and circuit breaking.
+
+A backend is served by one or more replicas (``url``, or a ``replicas`` list
+of tables with ``url`` and optional ``weight`` and ``token``). Each request
+goes to the replica with the fewest requests in flight per unit of weight,
+among all of them (``balance = "least_outstanding"``) or among two picked at
+random (``balance = "power_of_two"``). A request counts as in flight until its
+response, including a stream, has been fully read.
+
+Every replica has a circuit breaker. After ``circuit_failures`` consecutive
+failed connections or health checks it opens and gets no requests; after
+``circuit_open_seconds`` it is half-open and the next request or health check
+decides whether it closes again. With no replica available requests go to
+the backend's ``fallback`` backend, if any, or fail fast with 503 instead of
+waiting ``timeout_connect`` each.
+
+Requests that fail before the response headers are retried (see
+``proxy.request``) within a per-backend ``RetryBudget``.
+
+Each backend has its own ``Client``, an HTTP session with its own pool of
+up to ``connection_limit`` connections, so a busy backend can't take the
+connections of the others.
+
+A backend's ``Limiter`` admits at most ``max_concurrency`` requests at a time
+(by default the sum of its replicas' ``max_concurrency``, if they all have
+one); up to ``max_queue`` more wait in FIFO order for at most
+``max_queue_time`` seconds, the rest are turned away (429) at once.
+
+With ``adaptive_concurrency`` the limit follows the backend instead, between
+``min_concurrency`` and ``max_concurrency`` (by default the backend's
+``connection_limit``). It starts at the maximum and is adjusted after every
+request from its time to the first token (to the response headers if it
+wasn't streamed), gradient style: while that stays within 1.5 times its long
+term average the limit grows by about its square root, beyond that it shrinks
+in proportion, down to half. A timeout or an overload answer (429, 503, 504)
+cuts it by a tenth, once per round trip.
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import math
+import random
+import ssl
+import time
+
+import aiohttp
+import yarl
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker states, as exported by llmproxy_backend_state.
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+def replica_configs(b_cfg):
+    """The replica tables of a backend config; a plain ``url`` is one."""
+    if "replicas" in b_cfg:
+        return b_cfg["replicas"]
+    if "url" in b_cfg:
+        return [{"url": b_cfg["url"]}]
+    return []
+
+
+class Overloaded(Exception):
+    """A backend's ``Limiter`` turned a request away. ``retry_after`` is an
+    estimate of the seconds until it may be admitted."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """Admission control for one backend: at most ``limit`` requests at a time
+    (0 = unlimited), and up to ``max_queue`` more waiting in FIFO order for
+    at most ``max_wait`` seconds each. An adaptive limit moves between
+    ``min_limit`` and ``max_limit`` with the latencies passed to
+    ``release``."""
+
+    def __init__(self, name):
+        self.name = name
+        self.limit = 0
+        self.max_queue = 100
+        self.max_wait = 30
+        self.in_flight = 0
+        self.hold_time = 1.0  # moving average of seconds a slot is held
+        self.adaptive = False
+        self.min_limit = 1
+        self.max_limit = 0
+        self._estimate = 0.0  # adaptive limit before rounding
+        self._baseline = None  # long term average latency
+        self._cut_at = 0.0  # when the adaptive limit was last cut
+        self._waiters = collections.deque()
+
+    def configure(self, limit, max_queue, max_wait, adaptive=False,
+            min_limit=1):
+        """Set the limit, or with ``adaptive`` its upper bound. An adaptive
+        limit kept over a reload keeps its value, within the new bounds."""
+        if adaptive:
+            if not self.adaptive:
+                self._estimate = limit
+            self.min_limit = min(min_limit, limit)
+            self.max_limit = limit
+            self._estimate = min(max(self._estimate, self.min_limit), limit)
+            limit = int(self._estimate)
+        self.adaptive = adaptive
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        metrics.BACKEND_CONCURRENCY_LIMIT.labels(self.name).set(limit)
+        self._wake()
+
+    def retry_after(self):
+        """Seconds until a request arriving now would likely be admitted."""
+        if not self.limit:
+            return 1
+        return max(1, math.ceil(
+            self.hold_time * (len(self._waiters) + 1) / self.limit))
+
+    def _reject(self, reason):
+        metrics.BACKEND_REJECTED_TOTAL.labels(self.name, reason).inc()
+        return Overloaded(reason, self.retry_after())
+
+    async def acquire(self):
+        """Wait for a slot and return the time it was taken, for
+        ``release``. Raises ``Overloaded`` if the queue is full or the wait
+        takes longer than ``max_wait``."""
+        if not self.limit or (self.in_flight < self.limit
+                and not self._waiters):
+            self.in_flight += 1
+            return time.monotonic()
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        metrics.BACKEND_QUEUE_DEPTH.labels(self.name).set(len(self._waiters))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except (TimeoutError, asyncio.CancelledError) as e:
+            granted = waiter.done() and not waiter.cancelled()
+            if not granted:
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                if granted:
+                    self.release(start)
+                raise
+            if not granted:
+                raise self._reject("queue_timeout") from None
+        finally:
+            now = time.monotonic()
+            metrics.BACKEND_QUEUE_WAIT_SECONDS.labels(self.name).observe(
+                now - start)
+            metrics.BACKEND_QUEUE_DEPTH.labels(self.name).set(
+                len(self._waiters))
+        return now
+
+    def release(self, acquired, latency=None, overloaded=False):
+        """Free the slot taken at ``acquired``. ``latency`` (seconds to the
+        first token) and ``overloaded`` (the backend timed out or said it
+        was overloaded) adjust an adaptive limit."""
+        self.in_flight -= 1
+        self.hold_time += 0.1 * (time.monotonic() - acquired - self.hold_time)
+        if self.adaptive:
+            self._adapt(acquired, latency, overloaded)
+        self._wake()
+
+    def _adapt(self, acquired, latency, overloaded):
+        if overloaded:
+            # Requests admitted before the last cut saw the old limit; they
+            # don't cut it again.
+            if acquired < self._cut_at:
+                return
+            self._estimate *= 0.9
+            self._cut_at = time.monotonic()
+        elif latency is not None:
+            if self._baseline is None:
+                self._baseline = latency
+            else:
+                self._baseline += (latency - self._baseline) / 500
+                # Forget a slow past quickly.
+                if self._baseline > 2 * latency:
+                    self._baseline *= 0.95
+            # A limit the traffic doesn't reach says nothing about the
+            # backend.
+            if (self.in_flight + 1) * 2 < self._estimate:
+                return
+            gradient = max(0.5, min(1.0,
+                1.5 * self._baseline / max(latency, 1e-6)))
+            target = self._estimate * gradient + math.sqrt(self._estimate)
+            self._estimate += 0.2 * (target - self._estimate)
+        else:
+            return
+        self._estimate = min(max(self._estimate, self.min_limit),
+            self.max_limit)
+        if int(self._estimate) != self.limit:
+            self.limit = int(self._estimate)
+            metrics.BACKEND_CONCURRENCY_LIMIT.labels(self.name).set(
+                self.limit)
+
+    def _wake(self):
+        # Hand free slots to the oldest waiters still waiting.
+        while self._waiters and (not self.limit
+                or self.in_flight < self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class Client:
+    """The HTTP client session and connection pool of one backend, created on
+    first use. Once retired it is closed when its last request ends."""
+
+    def __init__(self, name, cfg, b_cfg):
+        def get(key, default):
+            return b_cfg.get(key, cfg.get(key, default))
+
+        self.name = name
+        self.settings = (get("connection_limit", 100),
+            get("connection_limit_per_host", 0),
+            get("keepalive_timeout", 15), get("dns_cache_ttl", 10),
+            b_cfg.get("unix_socket"), b_cfg.get("verify_ssl", True))
+        self.users = 0
+        self.retired = False
+        self._session = None
+        self._closing = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self._create()
+        return self._session
+
+    def _create(self):
+        limit, limit_per_host, keepalive, dns_ttl, unix_socket, verify = \
+            self.settings
+        if unix_socket is not None:
+            connector = aiohttp.UnixConnector(unix_socket, limit=limit,
+                limit_per_host=limit_per_host, keepalive_timeout=keepalive)
+        else:
+            # One SSL context per backend instead of deciding per request.
+            context = ssl.create_default_context() if verify else False
+            connector = aiohttp.TCPConnector(limit=limit,
+                limit_per_host=limit_per_host, keepalive_timeout=keepalive,
+                ttl_dns_cache=dns_ttl, ssl=context)
+        metrics.BACKEND_CONNECTION_LIMIT.labels(self.name).set(limit)
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(self._queued_start)
+        trace.on_connection_queued_end.append(self._queued_end)
+        trace.on_connection_create_end.append(self._created)
+        trace.on_connection_reuseconn.append(self._reused)
+        return aiohttp.ClientSession(connector=connector,
+            trace_configs=[trace])
+
+    async def _queued_start(self, session, ctx, params):
+        ctx.queued_at = time.monotonic()
+
+    async def _queued_end(self, session, ctx, params):
+        metrics.BACKEND_CONNECTION_WAIT_SECONDS.labels(self.name).observe(
+            time.monotonic() - ctx.queued_at)
+
+    async def _created(self, session, ctx, params):
+        metrics.BACKEND_CONNECTIONS_TOTAL.labels(self.name, "new").inc()
+
+    async def _reused(self, session, ctx, params):
+        metrics.BACKEND_CONNECTIONS_TOTAL.labels(self.name, "reused").inc()
+
+    def acquire(self):
+        self.users += 1
+        return self
+
+    def release(self):
+        self.users -= 1
+        if self.retired and not self.users:
+            self.retire()
+
+    def retire(self):
+        self.retired = True
+        if not self.users and self._session is not None:
+            self._closing = asyncio.ensure_future(self.close())
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class Replica:
+    """One URL serving a backend, with its requests in flight and circuit
+    breaker state."""
+
+    def __init__(self, backend, url):
+        self.backend = backend
+        self.url = url
+        self.in_flight = 0
+        self.state = CLOSED
+        self.failures = 0  # consecutive
+        self.opened_at = 0
+        self.task = None
+        self.retired = False
+        self._publish()
+
+    def configure(self, cfg, b_cfg, r_cfg):
+        """Apply the (re)loaded config: global ``cfg``, backend ``b_cfg`` and
+        replica ``r_cfg``."""
+        def get(key, default):
+            return b_cfg.get(key, cfg.get(key, default))
+
+        self.weight = r_cfg.get("weight", 1)
+        self.token = r_cfg.get("token", b_cfg.get("token"))
+        self.max_concurrency = r_cfg.get("max_concurrency", 0)
+        self.max_failures = get("circuit_failures", 3)
+        self.open_seconds = get("circuit_open_seconds", 30)
+        self.check_interval = get("health_interval", 10)
+        self.check_timeout = get("health_timeout", 5)
+
+    def _publish(self):
+        if self.retired:
+            return
+        metrics.BACKEND_IN_FLIGHT.labels(self.backend, self.url).set(
+            self.in_flight)
+        metrics.BACKEND_STATE.labels(self.backend, self.url).set(self.state)
+
+    def _cool_down(self):
+        if (self.state == OPEN
+                and time.monotonic() - self.opened_at >= self.open_seconds):
+            self.state = HALF_OPEN
+            self._publish()
+
+    def available(self):
+        """Whether the replica may take a request. A half-open one takes a
+        single trial request at a time."""
+        self._cool_down()
+        if self.state == HALF_OPEN:
+            return self.in_flight == 0
+        if self.max_concurrency and self.in_flight >= self.max_concurrency:
+            return False
+        return self.state == CLOSED
+
+    def acquire(self):
+        """Count a request as in flight until ``release``. Returns the
+        backend's ``Client`` to send it with."""
+        self.in_flight += 1
+        self._publish()
+        return self.client.acquire()
+
+    def release(self, client):
+        self.in_flight -= 1
+        self._publish()
+        client.release()
+
+    @contextlib.contextmanager
+    def use(self):
+        """Count a request as in flight for the duration of the block."""
+        client = self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def success(self):
+        self.failures = 0
+        if self.state != CLOSED:
+            logger.info("Backend %s replica %s recovered", self.backend,
+                self.url)
+            self.state = CLOSED
+            self._publish()
+
+    def failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED
+                and self.max_failures
+                and self.failures >= self.max_failures):
+            logger.error("Backend %s replica %s is down, circuit open for "
+                "%s s", self.backend, self.url, self.open_seconds)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._publish()
+
+    async def check(self):
+        """Probe ``/health`` and record the result. Returns True if healthy."""
+        timeout = aiohttp.ClientTimeout(total=self.check_timeout)
+        client = self.client.acquire()
+        try:
+            async with client.session.get(yarl.URL(self.url) / "health",
+                    timeout=timeout, raise_for_status=True):
+                pass
+        except (aiohttp.ClientError, TimeoutError) as e:
+            logger.debug("Backend %s replica %s health check failed: %s",
+                self.backend, self.url, e or type(e).__name__)
+            metrics.BACKEND_HEALTH_CHECKS_TOTAL.labels(self.backend,
+                self.url, "failed").inc()
+            self.failure()
+            return False
+        finally:
+            client.release()
+
+        metrics.BACKEND_HEALTH_CHECKS_TOTAL.labels(self.backend, self.url,
+            "ok").inc()
+        self.success()
+        return True
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            # An open circuit isn't probed until it may go half-open.
+            self._cool_down()
+            if self.state != OPEN:
+                await self.check()
+
+    def start(self):
+        if self.check_interval and self.task is None:
+            self.task = asyncio.create_task(self._check_loop())
+        elif not self.check_interval and self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def retire(self):
+        """Stop health checks and drop the metrics. Requests still in flight
+        finish normally."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.retired = True
+        metrics.BACKEND_IN_FLIGHT.remove(self.backend, self.url)
+        metrics.BACKEND_STATE.remove(self.backend, self.url)
+
+
+class RetryBudget:
+    """Caps retries at ``ratio`` of the requests to a backend, so retries
+    can't multiply the load of a backend that is already failing. Each
+    request adds ``ratio`` tokens and each retry takes one; up to
+    ``reserve`` tokens are saved for bursts."""
+
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+
+    def deposit(self):
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Balancer:
+    """The replicas of all backends. ``update`` brings them in line with a
+    (re)loaded config, keeping the state of replicas whose URL is unchanged."""
+
+    def __init__(self):
+        self.clients = {}  # name -> Client
+        self.retired_clients = []  # still in use
+        self.backends = {}  # name -> [Replica]
+        self.balance = {}  # name -> policy
+        self.budgets = {}  # name -> RetryBudget
+        self.limiters = {}  # name -> Limiter
+
+    def update(self, cfg):
+        backends = {}
+        budgets = {}
+        clients = {}
+        limiters = {}
+        for name, b_cfg in cfg.get("backends", {}).items():
+            client = Client(name, cfg, b_cfg)
+            if (old_client := self.clients.get(name)) is not None \
+                    and old_client.settings == client.settings:
+                client = old_client
+            clients[name] = client
+
+            old = {r.url: r for r in self.backends.get(name, [])}
+            replicas = []
+            for r_cfg in replica_configs(b_cfg):
+                replica = old.pop(r_cfg["url"], None) or Replica(name,
+                    r_cfg["url"])
+                replica.configure(cfg, b_cfg, r_cfg)
+                replica.client = client
+                replica.start()
+                replicas.append(replica)
+            backends[name] = replicas
+            self.balance[name] = b_cfg.get("balance",
+                cfg.get("balance", "least_outstanding"))
+            budget = budgets[name] = self.budgets.get(name) or RetryBudget()
+            budget.ratio = b_cfg.get("retry_budget",
+                cfg.get("retry_budget", 0.2))
+
+            limit = b_cfg.get("max_concurrency", cfg.get("max_concurrency"))
+            if limit is None:
+                limit = 0
+                if all(r.max_concurrency for r in replicas):
+                    limit = sum(r.max_concurrency for r in replicas)
+            adaptive = b_cfg.get("adaptive_concurrency",
+                cfg.get("adaptive_concurrency", False))
+            if adaptive and not limit:
+                limit = client.settings[0] or 100
+            limiter = limiters[name] = self.limiters.get(name) \
+                or Limiter(name)
+            limiter.configure(limit,
+                b_cfg.get("max_queue", cfg.get("max_queue", 100)),
+                b_cfg.get("max_queue_time", cfg.get("max_queue_time", 30)),
+                adaptive, b_cfg.get("min_concurrency",
+                    cfg.get("min_concurrency", 1)))
+
+        kept = {id(r) for replicas in backends.values() for r in replicas}
+        for replicas in self.backends.values():
+            for replica in replicas:
+                if id(replica) not in kept:
+                    replica.retire()
+        # Requests in flight keep using the client they started with.
+        for name, client in self.clients.items():
+            if clients.get(name) is not client:
+                client.retire()
+                self.retired_clients.append(client)
+        self.retired_clients = [c for c in self.retired_clients if c.users]
+        self.backends = backends
+        self.budgets = budgets
+        self.clients = clients
+        self.limiters = limiters
+
+    def pick(self, name, avoid=()):
+        """A replica of backend ``name`` to send a request to, except those in
+        ``avoid``, or None if none is available."""
+        candidates = [r for r in self.backends.get(name, ())
+            if r not in avoid and r.available()]
+        if not candidates:
+            return None
+        if (self.balance.get(name) == "power_of_two"
+                and len(candidates) > 2):
+            first, = random.choices(candidates,
+                [r.weight for r in candidates])
+            rest = [r for r in candidates if r is not first]
+            candidates = [first] + random.choices(rest,
+                [r.weight for r in rest])
+
+        least = min(r.in_flight / r.weight for r in candidates)
+        return random.choice(
+            [r for r in candidates if r.in_flight / r.weight == least])
+
+    async def close(self):
+        tasks = [r.task for replicas in self.backends.values()
+            for r in replicas if r.task is not None]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        for client in [*self.clients.values(), *self.retired_clients]:
+            await client.close()
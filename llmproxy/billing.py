@@ -1,28 +1,167 @@
+import asyncio
 import datetime
+import logging
+import time
 
 import aiohttp.web
 
-from .db import DatabaseError, get_db
+from . import metrics, ratelimit
+from .db import DatabaseError
+from .journal import Journal
+
+logger = logging.getLogger(__name__)
+
+# User row fields the billing records need (SQLite uses "id" only).
+_USER_FIELDS = ("id", "_user_id", "_namespace", "_org_id", "_tier")
 
 
 async def record(f_req, user, resources):
     """Write one billing record for a successful request.
 
-    Centralizes the get_db + billing_record_add + DatabaseError->GracefulExit
+    Centralizes the pooled billing_record_add + DatabaseError->GracefulExit
     block that every billed endpoint shares, so usage extraction is the only
     per-endpoint concern. On DB failure we kill the worker (GracefulExit)
     rather than silently drop revenue.
+
+    With a billing journal configured the record is only appended to the
+    journal here and written to the database by ``BillingQueue``; failing to
+    journal it kills the worker the same way.
+
+    The request's rate limit charge is corrected by the tokens billed.
     """
     app = f_req.app
+    now = datetime.datetime.now(datetime.UTC)
+    ratelimit.reconcile(f_req, resources)
+
+    if (queue := app.get("billing_queue")) is not None:
+        try:
+            await queue.add(user, now, resources, f_req["request_id"])
+        except OSError as e:
+            app.logger.critical("Failed writing billing journal: %s", e)
+            raise aiohttp.web.GracefulExit() from e
+        return
 
-    db = await get_db(app["config"]["db"]["uri"], f_req)
     try:
-        await db.billing_record_add(
-            user=user,
-            time=datetime.datetime.now(datetime.UTC),
-            resources=resources,
-            request_id=f_req["request_id"],
-        )
+        async with app["db_pool"].connection() as db:
+            await db.billing_record_add(
+                user=user,
+                time=now,
+                resources=resources,
+                request_id=f_req["request_id"],
+            )
     except DatabaseError as e:
         app.logger.critical(e)
         raise aiohttp.web.GracefulExit() from e
+
+
+class BillingQueue:
+    """Write-behind billing: records are acknowledged once they are in the
+    local journal and written to the database in batches (one transaction on
+    SQLite, one insert_many on Mongo) every ``flush_interval`` seconds or as
+    soon as ``batch_size`` records are waiting.
+
+    A failed flush leaves the records in the journal and is retried with
+    backoff; records still in the journal at exit are replayed on the next
+    start. Replayed and retried records are checked against the database by
+    request id first, so nothing is billed twice.
+    """
+
+    def __init__(self, pool, journal, batch_size, flush_interval):
+        self.pool = pool
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    @classmethod
+    async def open(cls, pool, path, batch_size=500, flush_interval=1):
+        """Open the journal at ``path``, replay what a previous run left in it
+        (raising DatabaseError if that fails) and start flushing."""
+        self = cls(pool, await Journal.open(path), batch_size, flush_interval)
+
+        replay = sum(len(s.records) for s in self.journal.sealed)
+        metrics.BILLING_QUEUE_DEPTH.set(replay)
+        if replay:
+            await self.flush()
+            logger.info("Replayed %d billing records from the journal", replay)
+
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def add(self, user, time, resources, request_id):
+        await self.journal.append({
+            "rid": str(request_id),
+            "time": time,
+            "user": {k: user[k] for k in _USER_FIELDS if k in user},
+            "resources": resources,
+        })
+        metrics.BILLING_QUEUE_DEPTH.inc()
+        if len(self.journal.current.records) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        delay = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                # Whatever went wrong, the records are still in the journal;
+                # stopping here would leave them unbilled until a restart.
+                metrics.BILLING_FLUSH_ERRORS_TOTAL.inc()
+                logger.error("Billing flush failed, retrying in %g s: %s",
+                    delay, e, exc_info=not isinstance(e, DatabaseError))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+            else:
+                delay = self.flush_interval
+
+    async def flush(self):
+        """Write everything journaled so far to the database."""
+        async with self._flush_lock:
+            await self.journal.rotate()
+
+            for segment in list(self.journal.sealed):
+                while segment.flushed < len(segment.records):
+                    batch = segment.records[
+                        segment.flushed:segment.flushed + self.batch_size]
+                    start = time.monotonic()
+                    try:
+                        async with self.pool.connection() as db:
+                            await db.billing_records_add(batch,
+                                dedupe=segment.dedupe)
+                    except Exception:
+                        # Mongo's insert_many may have written part of it.
+                        segment.dedupe = True
+                        raise
+                    metrics.BILLING_FLUSH_DURATION_SECONDS.observe(
+                        time.monotonic() - start)
+                    metrics.BILLING_FLUSH_BATCH_SIZE.observe(len(batch))
+                    segment.flushed += len(batch)
+                    metrics.BILLING_QUEUE_DEPTH.dec(len(batch))
+
+                self.journal.discard(segment)
+
+    async def close(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+        try:
+            await self.flush()
+        except Exception as e:
+            left = sum(len(s.records) - s.flushed for s in self.journal.sealed)
+            logger.critical("Failed flushing billing records: %s; %d records "
+                "stay in the journal and are replayed on the next start",
+                e, left, exc_info=not isinstance(e, DatabaseError))
+
+        await self.journal.close()
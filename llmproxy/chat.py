@@ -5,7 +5,7 @@ import logging
 import aiohttp
 import aiohttp.web
 
-from . import auth, billing, metrics, proxy, streaming
+from . import auth, billing, jsonscan, metrics, proxy, streaming
 
 
 class _ChatStreamUsage:
@@ -15,6 +15,8 @@ class _ChatStreamUsage:
     also captures a usage chunk that arrives separately after ``finish_reason``.
     """
 
+    skim = streaming.SKIM_LAST
+
     def __init__(self):
         self._last = b""
 
@@ -53,15 +55,15 @@ async def chat(f_req):
 
         if "text/event-stream" in b_res.headers.get("Content-Type", ""):
             usage_acc = _ChatStreamUsage()
-            f_res = await streaming.stream_through(f_req, b_res, usage_acc)
+            f_res = await streaming.stream_through(f_req, b_res, usage_acc,
+                b_name, b_cfg)
             usage = usage_acc.usage()
         else:
             body = await b_res.content.read()
-            data = json.loads(body, parse_float=decimal.Decimal)
+            usage = jsonscan.top_level_member(body, "usage")
             f_hdrs = {"Content-Type":
                 b_res.headers.get("Content-Type", "application/octet-stream")}
             f_res = aiohttp.web.Response(body=body, headers=f_hdrs)
-            usage = data["usage"]
 
         await billing.record(f_req, user, {
             "%s/%s/prompt" % (b_name, b_cfg["device"]):
@@ -75,7 +77,8 @@ async def chat(f_req):
             b_name)
 
         metrics.observe_text_tokens(b_name,
-            usage["prompt_tokens"], usage["completion_tokens"])
+            usage["prompt_tokens"], usage["completion_tokens"],
+            f_req.get("generation_seconds"))
 
         return f_res
 
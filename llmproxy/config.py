@@ -8,13 +8,183 @@ class ConfigError(Exception):
     pass
 
 
+# Global settings that backends may override. Reloaded with the backends.
+BACKEND_DEFAULTS = ("balance", "health_interval", "health_timeout",
+    "circuit_failures", "circuit_open_seconds", "retries", "retry_backoff",
+    "retry_budget", "connection_limit", "connection_limit_per_host",
+    "keepalive_timeout", "dns_cache_ttl", "max_concurrency", "max_queue",
+    "max_queue_time", "adaptive_concurrency", "min_concurrency")
+
+
+def _validate_coalesce(cfg, where):
+    if "coalesce_bytes" in cfg:
+        value = cfg["coalesce_bytes"]
+        if type(value) is not int or value < 0:
+            raise ConfigError(
+                "%scoalesce_bytes must be a non-negative integer" % where)
+
+    if "coalesce_ms" in cfg:
+        value = cfg["coalesce_ms"]
+        if type(value) not in (int, float) or value < 0:
+            raise ConfigError(
+                "%scoalesce_ms must be a non-negative number" % where)
+
+
+def _validate_balancing(cfg, where):
+    if "balance" in cfg and cfg["balance"] not in (
+            "least_outstanding", "power_of_two"):
+        raise ConfigError(
+            '%sbalance must be "least_outstanding" or "power_of_two"' % where)
+
+    for key in ("health_interval", "circuit_open_seconds", "retry_backoff",
+            "retry_budget", "max_queue_time"):
+        if key in cfg:
+            value = cfg[key]
+            if type(value) not in (int, float) or value < 0:
+                raise ConfigError(
+                    "%s%s must be a non-negative number" % (where, key))
+
+    if "health_timeout" in cfg:
+        value = cfg["health_timeout"]
+        if type(value) not in (int, float) or value <= 0:
+            raise ConfigError(
+                "%shealth_timeout must be a positive number" % where)
+
+    for key in ("circuit_failures", "retries", "max_concurrency",
+            "max_queue"):
+        if key in cfg:
+            value = cfg[key]
+            if type(value) is not int or value < 0:
+                raise ConfigError(
+                    "%s%s must be a non-negative integer" % (where, key))
+
+    if "adaptive_concurrency" in cfg \
+            and type(cfg["adaptive_concurrency"]) is not bool:
+        raise ConfigError(
+            "%sadaptive_concurrency must be a boolean" % where)
+
+    if "min_concurrency" in cfg:
+        value = cfg["min_concurrency"]
+        if type(value) is not int or value <= 0:
+            raise ConfigError(
+                "%smin_concurrency must be a positive integer" % where)
+
+
+def _validate_connections(cfg, where):
+    for key in ("connection_limit", "connection_limit_per_host"):
+        if key in cfg:
+            value = cfg[key]
+            if type(value) is not int or value < 0:
+                raise ConfigError(
+                    "%s%s must be a non-negative integer" % (where, key))
+
+    for key in ("keepalive_timeout", "dns_cache_ttl"):
+        if key in cfg:
+            value = cfg[key]
+            if type(value) not in (int, float) or value < 0:
+                raise ConfigError(
+                    "%s%s must be a non-negative number" % (where, key))
+
+
+def _validate_rate_limits(cfg, where, keys):
+    for key in keys:
+        if key in cfg:
+            value = cfg[key]
+            if type(value) is not int or value < 0:
+                raise ConfigError(
+                    "%s%s must be a non-negative integer" % (where, key))
+
+
 def validate(cfg):
-    for key in ("client_max_size", "max_json_body"):
+    for key in ("client_max_size", "max_json_body", "max_sse_frame"):
         if key in cfg:
             value = cfg[key]
             if type(value) is not int or value <= 0:
                 raise ConfigError("%s must be a positive integer" % key)
 
+    _validate_coalesce(cfg, "")
+    _validate_balancing(cfg, "")
+    _validate_connections(cfg, "")
+
+    db = cfg.get("db", {})
+    if "pool_size" in db:
+        value = db["pool_size"]
+        if type(value) is not int or value <= 0:
+            raise ConfigError("db.pool_size must be a positive integer")
+    if "pool_check_idle" in db:
+        value = db["pool_check_idle"]
+        if type(value) not in (int, float) or value < 0:
+            raise ConfigError(
+                "db.pool_check_idle must be a non-negative number")
+
+    if "ensure_indexes" in db and type(db["ensure_indexes"]) is not bool:
+        raise ConfigError("db.ensure_indexes must be a boolean")
+
+    auth = cfg.get("auth", {})
+    if "cache_size" in auth:
+        value = auth["cache_size"]
+        if type(value) is not int or value < 0:
+            raise ConfigError("auth.cache_size must be a non-negative integer")
+    for key in ("cache_ttl", "cache_negative_ttl"):
+        if key in auth:
+            value = auth[key]
+            if type(value) not in (int, float) or value < 0:
+                raise ConfigError("auth.%s must be a non-negative number" % key)
+
+    if "key_filter" in auth and type(auth["key_filter"]) is not bool:
+        raise ConfigError("auth.key_filter must be a boolean")
+    if "key_filter_interval" in auth:
+        value = auth["key_filter_interval"]
+        if type(value) not in (int, float) or value <= 0:
+            raise ConfigError(
+                "auth.key_filter_interval must be a positive number")
+    if "key_filter_miss_lookups" in auth:
+        value = auth["key_filter_miss_lookups"]
+        if type(value) not in (int, float) or value < 0:
+            raise ConfigError(
+                "auth.key_filter_miss_lookups must be a non-negative number")
+    if "key_filter_fp_rate" in auth:
+        value = auth["key_filter_fp_rate"]
+        if type(value) not in (int, float) or not 0 < value < 1:
+            raise ConfigError(
+                "auth.key_filter_fp_rate must be between 0 and 1")
+
+    if "signing_key" in auth:
+        value = auth["signing_key"]
+        if type(value) is not str or len(value) < 32:
+            raise ConfigError(
+                "auth.signing_key must be a string of at least 32 characters")
+    if "revocation_interval" in auth:
+        value = auth["revocation_interval"]
+        if type(value) not in (int, float) or value <= 0:
+            raise ConfigError(
+                "auth.revocation_interval must be a positive number")
+
+    rate_limit = cfg.get("rate_limit", {})
+    _validate_rate_limits(rate_limit, "rate_limit.",
+        ("requests_per_minute", "tokens_per_minute"))
+    tiers = rate_limit.get("tiers", {})
+    if type(tiers) is not dict or not all(
+            type(t) is dict for t in tiers.values()):
+        raise ConfigError("rate_limit.tiers must be a table of tables")
+    for name, t_cfg in tiers.items():
+        _validate_rate_limits(t_cfg, "rate_limit.tiers.%s." % name,
+            ("requests_per_minute", "tokens_per_minute",
+                "tier_requests_per_minute", "tier_tokens_per_minute"))
+
+    billing = cfg.get("billing", {})
+    if "journal" in billing and type(billing["journal"]) is not str:
+        raise ConfigError("billing.journal must be a path")
+    if "batch_size" in billing:
+        value = billing["batch_size"]
+        if type(value) is not int or value <= 0:
+            raise ConfigError("billing.batch_size must be a positive integer")
+    if "flush_interval" in billing:
+        value = billing["flush_interval"]
+        if type(value) not in (int, float) or value <= 0:
+            raise ConfigError(
+                "billing.flush_interval must be a positive number")
+
     for name, meta in cfg.get("backends", {}).items():
         if "max_model_len" in meta:
             value = meta["max_model_len"]
@@ -29,6 +199,47 @@ def validate(cfg):
                 raise ConfigError(
                     'Backend "%s" timeout must be a positive number' % name)
 
+        _validate_coalesce(meta, 'Backend "%s" ' % name)
+        _validate_balancing(meta, 'Backend "%s" ' % name)
+        _validate_connections(meta, 'Backend "%s" ' % name)
+
+        if "unix_socket" in meta and type(meta["unix_socket"]) is not str:
+            raise ConfigError(
+                'Backend "%s" unix_socket must be a path' % name)
+
+        if "fallback" in meta and (meta["fallback"] == name
+                or meta["fallback"] not in cfg["backends"]):
+            raise ConfigError(
+                'Backend "%s" fallback must be another backend' % name)
+
+        if "replicas" in meta:
+            replicas = meta["replicas"]
+            if "url" in meta:
+                raise ConfigError(
+                    'Backend "%s" must set either url or replicas' % name)
+            if type(replicas) is not list or not replicas or not all(
+                    type(r) is dict and type(r.get("url")) is str
+                    for r in replicas):
+                raise ConfigError(
+                    'Backend "%s" replicas must be a list of tables with a '
+                    'url' % name)
+            urls = [r["url"] for r in replicas]
+            if len(set(urls)) != len(urls):
+                raise ConfigError(
+                    'Backend "%s" replicas must have distinct urls' % name)
+            for r in replicas:
+                if "weight" in r and (type(r["weight"]) not in (int, float)
+                        or r["weight"] <= 0):
+                    raise ConfigError(
+                        'Backend "%s" replica weight must be a positive '
+                        'number' % name)
+                if "max_concurrency" in r and (
+                        type(r["max_concurrency"]) is not int
+                        or r["max_concurrency"] <= 0):
+                    raise ConfigError(
+                        'Backend "%s" replica max_concurrency must be a '
+                        'positive integer' % name)
+
 
 def load(path=None, create=False):
     choices = [path, os.environ.get("LLMPROXY_CONFIG"), "config.toml"]
@@ -67,6 +278,11 @@ def load(path=None, create=False):
             print("Loaded database URI from the LLMPROXY_DB_URI env var",
                 file=sys.stderr)
 
+        if signing_key := os.environ.get("LLMPROXY_SIGNING_KEY"):
+            cfg.setdefault("auth", {})["signing_key"] = signing_key
+            print("Loaded signing key from the LLMPROXY_SIGNING_KEY env var",
+                file=sys.stderr)
+
         validate(cfg)
 
         return cfg
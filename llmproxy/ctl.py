@@ -1,11 +1,17 @@
 import argparse
 import asyncio
+import csv
 import datetime
+import decimal
 import hashlib
+import json
+import os
 import secrets
 import sys
+import time
+import uuid
 
-from . import config
+from . import auth, config
 from .db import DatabaseError, get_db
 
 
@@ -30,16 +36,44 @@ subparsers_user = parser_user.add_subparsers(required=True)
 # Command: user create
 
 async def command_user_create(args):
-    db = await get_db(uri=args.config["db"]["uri"])
+    id_ = None
+    if args.signed:
+        signing_key = args.config.get("auth", {}).get("signing_key")
+        if not signing_key:
+            print("Signed keys need signing_key in section auth of the config",
+                file=sys.stderr)
+            sys.exit(1)
 
-    secret = secrets.token_urlsafe(64)
+        id_ = str(uuid.uuid4())
+        claims = {"id": id_}
+        if args.expires is not None:
+            claims["exp"] = int(args.expires.timestamp())
+        for claim, value in (("uid", args.user_id), ("org", args.org_id),
+                ("ns", args.namespace), ("tier", args.tier)):
+            if value is not None:
+                claims[claim] = value
+        secret = auth.sign_key(signing_key, claims)
+    elif any(value is not None for value in (args.user_id, args.org_id,
+            args.namespace, args.tier)):
+        print("--user-id, --org-id, --namespace and --tier need --signed",
+            file=sys.stderr)
+        sys.exit(1)
+    else:
+        secret = secrets.token_urlsafe(64)
     digest = hashlib.sha256(secret.encode()).hexdigest()
 
+    db = await get_db(uri=args.config["db"]["uri"])
+
     try:
-        await db.user_create(digest, args.expires, args.comment)
+        await db.user_create(digest, args.expires, args.comment, id_)
     except DatabaseError as e:
         print("Database error:", e, file=sys.stderr)
         sys.exit(1)
+    except NotImplementedError:
+        # Keys in MongoDB belong to users managed elsewhere.
+        print("Creating API keys is only supported with SQLite",
+            file=sys.stderr)
+        sys.exit(1)
 
     await db.close()
 
@@ -56,6 +90,17 @@ parser_user_create.add_argument("-e", "--expires", type=isodatetime,
     help="expiration time in ISO 8601 format")
 parser_user_create.add_argument("-t", "--comment",
     help="arbitrary text associated with the key")
+parser_user_create.add_argument("--signed", action="store_true",
+    help="make a signed key the proxy verifies without a database lookup "
+    "(needs auth.signing_key)")
+parser_user_create.add_argument("--user-id",
+    help="user id embedded in a signed key (billed as its owner)")
+parser_user_create.add_argument("--org-id",
+    help="organization id embedded in a signed key")
+parser_user_create.add_argument("--namespace",
+    help="namespace embedded in a signed key")
+parser_user_create.add_argument("--tier",
+    help="subscription tier embedded in a signed key")
 parser_user_create.set_defaults(func=command_user_create)
 
 
@@ -149,6 +194,256 @@ parser_user_update.add_argument("hash")
 parser_user_update.set_defaults(func=command_user_update)
 
 
+# Command: usage
+parser_usage = subparsers.add_parser("usage", help="usage reports")
+subparsers_usage = parser_usage.add_subparsers(required=True)
+
+
+# Command: usage report
+
+async def command_usage_report(args):
+    db = await get_db(uri=args.config["db"]["uri"])
+
+    try:
+        api_keys = None
+        if args.hash:
+            api_keys = await db.key_ids(args.hash)
+        rows = await db.usage_report(args.since, args.until, api_keys,
+            args.product, args.by)
+        remaining = await db.usage_backfill_remaining()
+    except DatabaseError as e:
+        print("Database error:", e, file=sys.stderr)
+        await db.close()
+        sys.exit(1)
+
+    await db.close()
+
+    if remaining:
+        print("Warning: %d event ids from before the rollups are not "
+            "included yet; run `llmproxyctl usage backfill`" % remaining,
+            file=sys.stderr)
+
+    fmt = "%(period)-19s  %(secret)-12.12s  %(product)-40s  %(requests)10s" \
+        "  %(quantity)14s"
+    print(fmt % {"period": "Period", "secret": "Hash", "product": "Product",
+        "requests": "Requests", "quantity": "Quantity"})
+    print(fmt % {"period": "-" * 19, "secret": "-" * 12, "product": "-" * 40,
+        "requests": "-" * 10, "quantity": "-" * 14})
+    for row in rows:
+        print(fmt % {**row, "period": row["period"] or "-",
+            "secret": row["secret"] or row["api_key"]})
+
+parser_usage_report = subparsers_usage.add_parser("report",
+    help="usage per period, API key and product")
+parser_usage_report.add_argument("-s", "--since", type=isodatetime,
+    help="start time in ISO 8601 format (rounded down to the hour)")
+parser_usage_report.add_argument("-u", "--until", type=isodatetime,
+    help="end time in ISO 8601 format, exclusive (rounded down to the hour)")
+parser_usage_report.add_argument("-p", "--product", default="",
+    help="product prefix to use for filtering (e.g. a model name)")
+parser_usage_report.add_argument("-b", "--by", default="day",
+    choices=("hour", "day", "month", "total"), help="period (default: day)")
+parser_usage_report.add_argument("hash", nargs="?", default="",
+    help="API key hash prefix to use for filtering")
+parser_usage_report.set_defaults(func=command_usage_report)
+
+
+# Command: usage backfill
+
+async def command_usage_backfill(args):
+    db = await get_db(uri=args.config["db"]["uri"])
+
+    start = time.monotonic()
+    done = 0
+    try:
+        remaining = await db.usage_backfill_remaining()
+        total = remaining
+        while remaining:
+            remaining = await db.usage_backfill(args.chunk)
+            done = total - remaining
+            print("Rolled up %d/%d event ids (%.0f/s)" % (done, total,
+                done / max(time.monotonic() - start, 1e-9)), file=sys.stderr)
+    except DatabaseError as e:
+        print("Database error:", e, file=sys.stderr)
+        await db.close()
+        sys.exit(1)
+
+    await db.close()
+
+    print("Backfill complete", file=sys.stderr)
+
+parser_usage_backfill = subparsers_usage.add_parser("backfill",
+    help="build rollups from events stored before they existed")
+parser_usage_backfill.add_argument("--chunk", type=int, default=100000,
+    help="event ids per transaction (default: 100000)")
+parser_usage_backfill.set_defaults(func=command_usage_backfill)
+
+
+# Command: billing
+parser_billing = subparsers.add_parser("billing",
+    help="billing data management")
+subparsers_billing = parser_billing.add_subparsers(required=True)
+
+
+# Command: billing export
+
+EXPORT_FIELDS = ("id", "created", "api_key", "product", "quantity", "rid")
+
+
+def _export_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)  # keep the exact value
+    raise TypeError("Cannot export %r" % type(value))
+
+
+def _save_cursor(path, cursor):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(cursor + "\n")
+    os.replace(tmp, path)
+
+
+async def command_billing_export(args):
+    after = args.after
+    if after is None and args.cursor_file \
+            and os.path.exists(args.cursor_file):
+        with open(args.cursor_file) as f:
+            after = f.read().strip() or None
+    resume = after is not None
+
+    db = await get_db(uri=args.config["db"]["uri"])
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, "a" if resume else "w", newline="")
+    writer = None
+    if args.format == "csv":
+        writer = csv.DictWriter(out, EXPORT_FIELDS, extrasaction="ignore")
+        if not resume:
+            writer.writeheader()
+
+    exported = 0
+    try:
+        api_keys = None
+        if args.hash:
+            api_keys = await db.key_ids(args.hash)
+
+        while True:
+            rows, cursor = await db.billing_export(after, args.since,
+                args.until, api_keys, args.batch)
+            if cursor is None:
+                break
+
+            for row in rows:
+                if writer is not None:
+                    writer.writerow({k: v.isoformat()
+                        if isinstance(v, datetime.datetime) else v
+                        for k, v in row.items()})
+                else:
+                    out.write(json.dumps(row, default=_export_value) + "\n")
+            out.flush()
+            exported += len(rows)
+
+            # Only once the batch is out, so a resumed export neither skips
+            # nor repeats events.
+            after = cursor
+            if args.cursor_file:
+                _save_cursor(args.cursor_file, cursor)
+    except DatabaseError as e:
+        print("Database error:", e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        await db.close()
+
+    print("Exported %d events" % exported, file=sys.stderr)
+    if after is not None:
+        print("Cursor:", after, file=sys.stderr)
+
+parser_billing_export = subparsers_billing.add_parser("export",
+    help="dump billing events in id order")
+parser_billing_export.add_argument("-f", "--format", default="ndjson",
+    choices=("ndjson", "csv"), help="output format (default: ndjson)")
+parser_billing_export.add_argument("-o", "--output",
+    help="output file (default: stdout); appended to when resuming")
+parser_billing_export.add_argument("-s", "--since", type=isodatetime,
+    help="only events created at or after this time (ISO 8601)")
+parser_billing_export.add_argument("-u", "--until", type=isodatetime,
+    help="only events created before this time (ISO 8601)")
+parser_billing_export.add_argument("--after",
+    help="resume after this cursor (printed at the end of an export)")
+parser_billing_export.add_argument("--cursor-file",
+    help="resume from and save the cursor to this file after every batch")
+parser_billing_export.add_argument("--batch", type=int, default=1000,
+    help="events read per query (default: 1000)")
+parser_billing_export.add_argument("hash", nargs="?", default="",
+    help="API key hash prefix to use for filtering")
+parser_billing_export.set_defaults(func=command_billing_export)
+
+
+
+# Command: billing archive
+
+async def command_billing_archive(args):
+    db = await get_db(uri=args.config["db"]["uri"])
+    directory = args.dir or os.path.dirname(os.path.abspath(
+        args.config["db"]["uri"].removeprefix("sqlite://")))
+
+    try:
+        # Archived events are gone from event_oneoff, so roll them up first.
+        while await db.usage_backfill():
+            pass
+
+        size = await db.size()
+        start = time.monotonic()
+        moved = 0
+        while (n := await db.billing_archive(args.before, directory,
+                args.batch)):
+            moved += n
+            print("Archived %d events (%.0f/s)" % (moved,
+                moved / max(time.monotonic() - start, 1e-9)), file=sys.stderr)
+
+        if args.full_vacuum:
+            print("Vacuuming (writes are blocked until done)", file=sys.stderr)
+            await db.vacuum()
+        else:
+            while True:
+                free, incremental = await db.vacuum_step()
+                if not free or not incremental:
+                    break
+            if free:
+                print("%d free pages will be reused for new events; run once "
+                    "with --full-vacuum to let archiving shrink the file" %
+                    free, file=sys.stderr)
+        new_size = await db.size()
+    except DatabaseError as e:
+        print("Database error:", e, file=sys.stderr)
+        await db.close()
+        sys.exit(1)
+
+    await db.close()
+
+    print("Archived %d events into %s" % (moved, directory), file=sys.stderr)
+    print("Database size: %d -> %d bytes" % (size, new_size), file=sys.stderr)
+
+parser_billing_archive = subparsers_billing.add_parser("archive",
+    help="move old events into per-month archive databases (SQLite)")
+parser_billing_archive.add_argument("--before", required=True,
+    type=datetime.date.fromisoformat,
+    help="archive events created before this date (YYYY-MM-DD, UTC)")
+parser_billing_archive.add_argument("-d", "--dir",
+    help="directory for the archive files (default: the database's)")
+parser_billing_archive.add_argument("--batch", type=int, default=10000,
+    help="events moved per transaction (default: 10000)")
+parser_billing_archive.add_argument("--full-vacuum", action="store_true",
+    help="rewrite the database afterwards, enabling incremental vacuum on "
+    "databases created before it was the default; blocks the proxy's "
+    "writes while it runs")
+parser_billing_archive.set_defaults(func=command_billing_archive)
+
+
 if __name__ == "__main__":
     args = parser.parse_args()
     asyncio.run(args.func(args))
@@ -1,11 +1,19 @@
+import asyncio
+import contextlib
 import datetime
 import decimal
 import hashlib
 import importlib.resources
+import json
 import logging
+import os
+import re
 import sqlite3
+import time
 import uuid
 
+from . import metrics
+
 logger = logging.getLogger(__name__)
 
 sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat())
@@ -52,10 +60,87 @@ def _billing_document(user, time, resources, request_id):
     }
 
 
-async def get_db(uri, req=None):
-    if req is not None and "db" in req:
-        return req["db"]
+def _valid_key_query(now):
+    return {
+        "access_level": "LLM",
+        "$or": [
+            {"date_expiry": None},
+            {"date_expiry": {"$gt": now}},
+        ],
+    }
+
+
+def _user_pipeline(secret_hash, now):
+    """Aggregation that authenticates one API key: the key joined with its
+    owner, projected down to the fields ``require_auth`` and
+    ``_billing_document`` use, in a single round trip."""
+    return [
+        {"$match": {**_valid_key_query(now), "secret": secret_hash}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "rest_users",
+            "localField": "user_id",
+            "foreignField": "_id",
+            "as": "user",
+        }},
+        {"$unwind": "$user"},  # drops keys whose user is gone
+        {"$project": {
+            "secret": 1,
+            "date_expiry": 1,
+            "comment": 1,
+            "user_id": 1,
+            "user.namespace": 1,
+            "user.org_id": 1,
+            "user.subscription_level": 1,
+        }},
+    ]
+
+
+def _user_from_document(doc):
+    user = doc["user"]
+    return {
+        "id": doc["_id"],
+        "_user_id": doc["user_id"],
+        "_namespace": user["namespace"],
+        "_org_id": str(user.get("org_id", "")),
+        "_tier": user.get("subscription_level", ""),
+        "secret": doc["secret"],
+        "expires": doc.get("date_expiry", None),
+        "comment": doc.get("comment"),
+    }
+
+
+# (collection in cgc, index keys) checked by MongoDatabase.ensure_indexes.
+_MONGO_INDEXES = (
+    ("api_keys", [("secret", 1), ("access_level", 1)]),
+    ("billing_record", [("request_id", 1)]),
+)
+
+
+def _hour(time):
+    """Rollup hour bucket of an aware datetime (see _SQLITE_HOUR)."""
+    return time.astimezone(datetime.UTC).strftime("%Y-%m-%d %H:00:00")
+
+
+def _codec_options():
+    import bson
 
+    class DecimalCodec(bson.codec_options.TypeCodec):
+        python_type = decimal.Decimal
+        bson_type = bson.decimal128.Decimal128
+
+        def transform_python(self, value):
+            return _decimal_to_bson(value)
+
+        def transform_bson(self, value):
+            return value.to_decimal()
+
+    treg = bson.codec_options.TypeRegistry([DecimalCodec()])
+    return bson.codec_options.CodecOptions(type_registry=treg)
+
+
+async def get_db(uri):
+    """Open a single connection (llmproxyctl); the app uses a ``Pool``."""
     if uri.startswith("mongodb://"):
         db = await MongoDatabase.create(uri)
     elif uri.startswith("sqlite://"):
@@ -63,9 +148,6 @@ async def get_db(uri, req=None):
     else:
         raise ValueError("Unrecognized URI scheme: \"%s\"" % uri)
 
-    if req is not None:
-        req["db"] = db
-
     return db
 
 
@@ -73,46 +155,184 @@ class DatabaseError(Exception):
     pass
 
 
-class MongoDatabase:
+class Pool:
+    """Fixed-size pool of database connections shared by all requests.
+
+    Opening a connection per request cost a thread and a schema check on
+    SQLite and a TLS handshake, server selection and a ping on Mongo. The pool
+    opens ``size`` connections at startup and hands them out for the duration
+    of one database operation (``async with pool.connection() as db``).
+
+    SQLite connections are separate aiosqlite connections. On Mongo all slots
+    share one motor client (itself a connection pool, capped at ``size``); the
+    slots only bound and measure concurrency.
+
+    A connection idle for ``check_idle`` seconds or more is pinged before it
+    is handed out and reopened if the ping fails.
+    """
+
+    def __init__(self, uri, size, check_idle):
+        self.uri = uri
+        self.size = size
+        self.check_idle = check_idle
+        self._idle = asyncio.Queue()  # (db or None, last used)
+        self._client = None  # shared motor client
+
     @classmethod
-    async def create(cls, uri):
-        import bson
-        import motor.motor_asyncio
-        import pymongo.errors
-        import pymongo.server_api
+    async def create(cls, uri, size=4, check_idle=30):
+        self = cls(uri, size, check_idle)
 
-        class DecimalCodec(bson.codec_options.TypeCodec):
-            python_type = decimal.Decimal
-            bson_type = bson.decimal128.Decimal128
+        if uri.startswith("mongodb://"):
+            self._client = await MongoDatabase.connect(uri, size)
+        elif not uri.startswith("sqlite://"):
+            raise ValueError("Unrecognized URI scheme: \"%s\"" % uri)
 
-            def transform_python(self, value):
-                return _decimal_to_bson(value)
+        try:
+            for _ in range(size):
+                self._idle.put_nowait((await self._open(), time.monotonic()))
+        except BaseException:
+            await self.close()
+            raise
 
-            def transform_bson(self, value):
-                return value.to_decimal()
+        metrics.DB_POOL_SIZE.set(size)
+        return self
 
-        self = cls()
+    async def _open(self):
+        if self._client is not None:
+            return MongoDatabase.from_client(self._client)
+        return await SqliteDatabase.create(self.uri)
 
-        self.db = motor.motor_asyncio.AsyncIOMotorClient(uri,
-            tz_aware=True, connect=True,
-            server_api=pymongo.server_api.ServerApi('1'))
+    async def _reopen(self):
+        try:
+            return await self._open()
+        except sqlite3.Error as e:
+            raise DatabaseError(e) from e
+
+    async def acquire(self):
+        start = time.monotonic()
+        db, last_used = await self._idle.get()
+        metrics.DB_POOL_WAIT_SECONDS.observe(time.monotonic() - start)
+
+        try:
+            if db is not None and time.monotonic() - last_used >= self.check_idle:
+                try:
+                    await db.ping()
+                except DatabaseError as e:
+                    logger.warning("Reopening database connection: %s", e)
+                    await self._discard(db)
+                    db = None
+            if db is None:
+                db = await self._reopen()
+        except BaseException:
+            # Keep the slot; the next acquire retries the connection. A
+            # connection whose ping was interrupted (e.g. cancelled) is closed
+            # rather than dropped, or its aiosqlite thread would keep the
+            # process alive.
+            self._idle.put_nowait((None, 0))
+            if db is not None:
+                await asyncio.shield(self._discard(db))
+            raise
+
+        metrics.DB_POOL_IN_USE.inc()
+        return db
+
+    async def release(self, db):
+        metrics.DB_POOL_IN_USE.dec()
+        reset = False
+        try:
+            await db.reset()
+            reset = True
+        except DatabaseError as e:
+            logger.warning("Dropping database connection: %s", e)
+        finally:
+            # The slot always goes back, even if the reset was cancelled; a
+            # connection in an unknown state is closed and reopened later.
+            if reset:
+                self._idle.put_nowait((db, time.monotonic()))
+            else:
+                self._idle.put_nowait((None, 0))
+                await asyncio.shield(self._discard(db))
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        db = await self.acquire()
+        try:
+            yield db
+        finally:
+            await self.release(db)
+
+    async def _discard(self, db):
+        try:
+            await db.close()
+        except Exception as e:
+            logger.debug("Error closing database connection: %s", e)
+
+    async def close(self):
+        while not self._idle.empty():
+            db, _ = self._idle.get_nowait()
+            if db is not None:
+                await self._discard(db)
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        logger.debug("Closed database pool")
 
-        treg = bson.codec_options.TypeRegistry([DecimalCodec()])
-        self.copt = bson.codec_options.CodecOptions(type_registry=treg)
 
-        await self.db.admin.command("ping")
+class MongoDatabase:
+    @staticmethod
+    async def connect(uri, pool_size=None):
+        """Return a connected motor client (``pool_size`` caps its pool)."""
+        import motor.motor_asyncio
+        import pymongo.server_api
+
+        kwargs = {} if pool_size is None else {"maxPoolSize": pool_size}
+        client = motor.motor_asyncio.AsyncIOMotorClient(uri,
+            tz_aware=True, connect=True,
+            server_api=pymongo.server_api.ServerApi('1'), **kwargs)
+
+        await client.admin.command("ping")
         logger.debug("Connected to database")
 
+        return client
+
+    @classmethod
+    def from_client(cls, client):
+        """Wrap a client owned by someone else (a ``Pool``); ``close()``
+        leaves it open."""
+        self = cls()
+        self.db = client
+        self.copt = _codec_options()
+        self._owner = False
+        return self
+
+    @classmethod
+    async def create(cls, uri):
+        self = cls.from_client(await cls.connect(uri))
+        self._owner = True
         return self
 
     async def close(self):
-        self.db.close()
-        logger.debug("Closed database connection")
+        if self._owner:
+            self.db.close()
+            logger.debug("Closed database connection")
+
+    async def ping(self):
+        import pymongo.errors
+
+        try:
+            await self.db.admin.command("ping")
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
+
+    async def reset(self):
+        pass
 
-    async def user_create(self, secret_hash, expires=None, comment=None):
+    async def user_create(self, secret_hash, expires=None, comment=None,
+            id_=None):
         raise NotImplementedError("not implemented for MongoDB")
 
-    async def user_list(self, secret_hash="", include_expired=False):
+    async def user_list(self, secret_hash="", include_expired=False,
+            exact=False):
         import pymongo.errors
 
         if secret_hash == "":
@@ -121,38 +341,97 @@ class MongoDatabase:
             raise NotImplementedError("not implemented for MongoDB")
 
         try:
-            key = await self.db["cgc"]["api_keys"].find_one({
+            docs = await self.db["cgc"]["api_keys"].aggregate(
+                _user_pipeline(secret_hash,
+                    datetime.datetime.now(datetime.UTC))).to_list(1)
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
+
+        return [_user_from_document(doc) for doc in docs]
+
+    async def key_ids(self, secret_hash):
+        """Ids (ObjectIds, as stored in billing records) of the API keys,
+        expired ones included, whose hash starts with ``secret_hash``."""
+        import pymongo.errors
+
+        try:
+            docs = await self.db["cgc"]["api_keys"].find({
                 "access_level": "LLM",
-                "secret": secret_hash,
-                "$or": [
-                    {"date_expiry": None},
-                    {"date_expiry": {"$gt": datetime.datetime.now(datetime.UTC)}},
-                ],
+                "secret": {"$regex": "^" + re.escape(secret_hash)},
+            }, {"_id": 1}).to_list(None)
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
+
+        return [doc["_id"] for doc in docs]
+
+    async def key_count(self):
+        import pymongo.errors
+
+        try:
+            return await self.db["cgc"]["api_keys"].count_documents(
+                _valid_key_query(datetime.datetime.now(datetime.UTC)))
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
+
+    async def revoked_key_ids(self):
+        import pymongo.errors
+
+        try:
+            ids = await self.db["cgc"]["api_keys"].distinct("_id", {
+                "access_level": "LLM",
+                "date_expiry": {"$lte": datetime.datetime.now(datetime.UTC)},
             })
-            if key is None:
-                return []
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
 
-            user = await self.db["cgc"]["rest_users"].find_one(
-                {"_id": key["user_id"]})
-            if user is None:
-                return []
+        return [str(id_) for id_ in ids]
+
+    async def key_digests(self, after="", limit=10000):
+        import pymongo.errors
+
+        query = _valid_key_query(datetime.datetime.now(datetime.UTC))
+        query["secret"] = {"$gt": after}
+        try:
+            docs = await self.db["cgc"]["api_keys"].find(query,
+                {"_id": 0, "secret": 1}).sort("secret", 1).limit(limit) \
+                .to_list(limit)
         except pymongo.errors.PyMongoError as e:
             raise DatabaseError(e) from e
 
-        return [{
-            "id": key["_id"],
-            "_user_id": key["user_id"],
-            "_namespace": user["namespace"],
-            "_org_id": str(user.get("org_id", "")),
-            "_tier": user.get("subscription_level", ""),
-            "secret": key["secret"],
-            "expires": key.get("date_expiry", None),
-            "comment": key.get("comment"),
-        }]
+        return [doc["secret"] for doc in docs]
+
+    async def ensure_indexes(self):
+        """Create the indexes the proxy's queries rely on, unless an index
+        with the same keys exists already (under any name)."""
+        import pymongo.errors
+
+        try:
+            for name, keys in _MONGO_INDEXES:
+                col = self.db["cgc"][name]
+                info = await col.index_information()
+                if any(spec["key"] == keys for spec in info.values()):
+                    continue
+                logger.info("Creating index on cgc.%s %s", name, keys)
+                await col.create_index(keys)
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
 
     async def user_update(self, user, **kwargs):
         raise NotImplementedError("not implemented for MongoDB")
 
+    async def usage_report(self, since=None, until=None, api_keys=None,
+            product="", period="hour"):
+        raise NotImplementedError("not implemented for MongoDB")
+
+    async def usage_backfill_remaining(self):
+        raise NotImplementedError("not implemented for MongoDB")
+
+    async def usage_backfill(self, chunk=100000):
+        raise NotImplementedError("not implemented for MongoDB")
+
+    async def billing_archive(self, before, directory, limit=10000):
+        raise NotImplementedError("not implemented for MongoDB")
+
     async def billing_record_add(self, user, time, resources, request_id):
         import pymongo.errors
 
@@ -165,6 +444,144 @@ class MongoDatabase:
         except pymongo.errors.PyMongoError as e:
             raise DatabaseError(e) from e
 
+    async def billing_export(self, after=None, since=None, until=None,
+            api_keys=None, limit=1000):
+        """Like ``SqliteDatabase.billing_export``, paginated by ``_id``. A
+        document's resources become one event each, so a batch may hold
+        more than ``limit`` events."""
+        import bson
+        import pymongo.errors
+
+        query = {}
+        if after is not None:
+            query["_id"] = {"$gt": bson.ObjectId(after)}
+        if since is not None or until is not None:
+            query["created_at"] = {}
+            if since is not None:
+                query["created_at"]["$gte"] = since
+            if until is not None:
+                query["created_at"]["$lt"] = until
+        if api_keys is not None:
+            query["api_key_id"] = {"$in": api_keys}
+
+        col = self.db["cgc"].get_collection("billing_record",
+            codec_options=self.copt)
+        try:
+            docs = await col.find(query, {"created_at": 1, "api_key_id": 1,
+                "resources": 1, "request_id": 1}).sort("_id", 1) \
+                .limit(limit).to_list(limit)
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
+
+        rows = [{"id": str(doc["_id"]), "created": doc.get("created_at"),
+            "api_key": str(doc.get("api_key_id")), "product": product,
+            "quantity": quantity, "rid": doc.get("request_id")}
+            for doc in docs
+            for product, quantity in doc.get("resources", {}).items()]
+        return rows, str(docs[-1]["_id"]) if docs else None
+
+    async def billing_records_add(self, records, dedupe=False):
+        """Insert journaled billing records (dicts with rid, time, user and
+        resources) with one insert_many. With ``dedupe``, records whose
+        request id is already stored are skipped."""
+        import pymongo.errors
+
+        col = self.db["cgc"].get_collection("billing_record",
+            codec_options=self.copt)
+        docs = [_billing_document(r["user"], r["time"], r["resources"],
+            r["rid"]) for r in records]
+
+        try:
+            if dedupe:
+                seen = set(await col.distinct("request_id",
+                    {"request_id": {"$in": [d["request_id"] for d in docs]}}))
+                docs = [d for d in docs if d["request_id"] not in seen]
+            if docs:
+                await col.insert_many(docs)
+        except pymongo.errors.PyMongoError as e:
+            raise DatabaseError(e) from e
+
+
+async def _sqlite_v1(db):
+    schema = importlib.resources.files("llmproxy") \
+        .joinpath("schema.sql").read_text()
+    await db.executescript("BEGIN;\n%s\nPRAGMA user_version = 1;\nCOMMIT;"
+        % schema)
+
+
+async def _sqlite_v2(db):
+    # Hot-path indexes, and at most one row per (request, product) so a
+    # replayed billing record can't be stored twice.
+    cur = await db.execute("""
+        SELECT COUNT(*) FROM (SELECT 1 FROM event_oneoff
+            WHERE rid IS NOT NULL GROUP BY rid, product HAVING COUNT(*) > 1)
+        """)
+    dups, = await cur.fetchone()
+    if dups:
+        raise DatabaseError("Cannot migrate to version 2: %d (rid, product) "
+            "pairs in event_oneoff have more than one row; resolve them "
+            "first" % dups)
+
+    await db.executescript("""
+        BEGIN;
+        CREATE INDEX IF NOT EXISTS api_key_secret ON api_key (secret);
+        CREATE INDEX IF NOT EXISTS event_oneoff_api_key_created
+            ON event_oneoff (api_key, created);
+        CREATE INDEX IF NOT EXISTS event_oneoff_created
+            ON event_oneoff (created);
+        CREATE UNIQUE INDEX IF NOT EXISTS event_oneoff_rid_product
+            ON event_oneoff (rid, product);
+        PRAGMA user_version = 2;
+        COMMIT;
+        """)
+
+
+# Hour bucket of an event_oneoff.created value, in UTC ('' if unknown).
+_SQLITE_HOUR = "IFNULL(strftime('%Y-%m-%d %H:00:00', {}), '')"
+
+
+async def _sqlite_v3(db):
+    # Hourly usage rollups. The trigger keeps them current in the inserting
+    # transaction, for every writer, and doesn't count rows that INSERT OR
+    # IGNORE skipped. Events already stored are rolled up later, in chunks,
+    # by `llmproxyctl usage backfill`: usage_backfill holds the id range
+    # still to do, so the migration itself stays instant on a large table.
+    await db.executescript("""
+        BEGIN;
+        CREATE TABLE IF NOT EXISTS usage_hourly (
+            api_key TEXT NOT NULL,
+            product TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            requests INTEGER NOT NULL,
+            PRIMARY KEY (api_key, product, hour)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS usage_hourly_hour ON usage_hourly (hour);
+        CREATE TABLE IF NOT EXISTS usage_backfill (
+            next_id INTEGER NOT NULL,
+            end_id INTEGER NOT NULL
+        );
+        INSERT INTO usage_backfill
+            SELECT IFNULL(MIN(id), 0), IFNULL(MAX(id), -1) FROM event_oneoff;
+        CREATE TRIGGER IF NOT EXISTS event_oneoff_usage_hourly
+        AFTER INSERT ON event_oneoff
+        BEGIN
+            INSERT INTO usage_hourly (api_key, product, hour, quantity,
+                requests)
+            VALUES (NEW.api_key, NEW.product, %s, NEW.quantity, 1)
+            ON CONFLICT (api_key, product, hour) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                requests = requests + 1;
+        END;
+        PRAGMA user_version = 3;
+        COMMIT;
+        """ % _SQLITE_HOUR.format("NEW.created"))
+
+
+# _MIGRATIONS[n] migrates an SQLite database from version n to n + 1.
+_MIGRATIONS = (_sqlite_v1, _sqlite_v2, _sqlite_v3)
+SCHEMA_VERSION = len(_MIGRATIONS)
+
 
 class SqliteDatabase:
     @classmethod
@@ -175,30 +592,48 @@ class SqliteDatabase:
         assert path != uri
 
         self = cls()
+        self.path = path
         self.db = await aiosqlite.connect(path)
         logger.debug("Connected to database")
 
-        # user_version is the schema-initialization marker (0 = uninitialized).
-        # schema.sql is idempotent (CREATE TABLE IF NOT EXISTS), so applying it
-        # to a version-0 database that already has the tables — e.g. one made
-        # with `sqlite3 db.sqlite < schema.sql`, which does not stamp
-        # user_version — is safe and simply heals the marker to 1. NOTE: this is
-        # a single-version init, not a migration ladder; a future schema v2 needs
-        # real migrations here, and a divergent v0 table would be accepted as-is
-        # (surfacing only at query time) rather than failing loudly at startup.
-        cur = await self.db.execute("PRAGMA user_version")
-        ver, = await cur.fetchone()
-        if ver == 0:
-            schema = importlib.resources.files("llmproxy") \
-                .joinpath("schema.sql").read_text()
-            await self.db.executescript(schema)
-            await self.db.execute("PRAGMA user_version = 1")
-            logger.info("Initialized database to version 1")
+        try:
+            # Only takes effect on a new database (or after a VACUUM), and
+            # only before WAL writes the header: lets `llmproxyctl billing
+            # archive` return freed pages to the filesystem.
+            await self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # synchronous is per connection; WAL persists in the file.
+            await self.db.execute("PRAGMA journal_mode = WAL")
+            await self.db.execute("PRAGMA synchronous = NORMAL")
+
+            await self._migrate()
+        except BaseException:
+            # aiosqlite runs on a non-daemon thread; don't leave it behind.
+            await self.db.close()
+            raise
 
         self.db.row_factory = self.dict_factory
 
         return self
 
+    async def _migrate(self):
+        # user_version is the schema version (0 = uninitialized); each step of
+        # _MIGRATIONS takes the database one version up, in a transaction
+        # with the new user_version. schema.sql (version 1) is idempotent
+        # (CREATE TABLE IF NOT EXISTS), so applying it to a version-0 database
+        # that already has the tables — e.g. one made with `sqlite3 db.sqlite
+        # < schema.sql`, which does not stamp user_version — is safe and
+        # simply heals the marker. A divergent v0 table is accepted as-is
+        # (surfacing only at query time) rather than failing at startup.
+        cur = await self.db.execute("PRAGMA user_version")
+        ver, = await cur.fetchone()
+        if ver > SCHEMA_VERSION:
+            raise DatabaseError("Database schema version %d is newer than "
+                "this llmproxy (%d)" % (ver, SCHEMA_VERSION))
+
+        for ver in range(ver + 1, SCHEMA_VERSION + 1):
+            await _MIGRATIONS[ver - 1](self.db)
+            logger.info("Migrated database to version %d", ver)
+
     @staticmethod
     def dict_factory(cursor, row):
         fields = [column[0] for column in cursor.description]
@@ -208,8 +643,28 @@ class SqliteDatabase:
         await self.db.close()
         logger.debug("Closed database connection")
 
-    async def user_create(self, secret_hash, expires=None, comment=None):
-        id_ = str(uuid.uuid4())
+    async def ping(self):
+        try:
+            await self.db.execute("SELECT 1")
+        except (ValueError, sqlite3.Error) as e:
+            # aiosqlite raises ValueError once the connection is closed.
+            raise DatabaseError(e) from e
+
+    async def reset(self):
+        """Roll back what a failed operation left uncommitted, so the next
+        user of this pooled connection doesn't commit it."""
+        try:
+            if self.db.in_transaction:
+                await self.db.rollback()
+        except (ValueError, sqlite3.Error) as e:
+            raise DatabaseError(e) from e
+
+    async def ensure_indexes(self):
+        pass  # created by the schema migrations
+
+    async def user_create(self, secret_hash, expires=None, comment=None,
+            id_=None):
+        id_ = id_ or str(uuid.uuid4())
 
         try:
             await self.db.execute("""
@@ -223,17 +678,24 @@ class SqliteDatabase:
 
         return id_
 
-    async def user_list(self, secret_hash="", include_expired=False):
+    async def user_list(self, secret_hash="", include_expired=False,
+            exact=False):
+        # Exact lookups (auth) search the secret index; the planner only
+        # uses it for a plain "secret = ?", so the prefix match (llmproxyctl)
+        # is a separate statement. Expiry is compared through datetime()
+        # because expires is stored as ISO 8601 ("T" separator, UTC offset).
+        match = "secret = ?" if exact else "secret LIKE ? || '%'"
         try:
             cur = await self.db.execute("""
                 SELECT id, secret, expires,
-                    CASE WHEN CURRENT_TIMESTAMP >= expires THEN 'expired'
+                    CASE WHEN datetime() >= datetime(expires) THEN 'expired'
                         ELSE 'active' END AS status,
                     IFNULL(comment, '') AS comment
                 FROM api_key
-                WHERE type = 'LLM' AND secret LIKE ? || '%'
-                    AND (? OR expires > datetime() OR expires IS NULL)
-                """, (secret_hash, include_expired))
+                WHERE type = 'LLM' AND %s
+                    AND (? OR datetime(expires) > datetime()
+                        OR expires IS NULL)
+                """ % match, (secret_hash, include_expired))
         except sqlite3.DatabaseError as e:
             raise DatabaseError(e) from e
 
@@ -242,6 +704,68 @@ class SqliteDatabase:
 
         return rows
 
+    async def key_ids(self, secret_hash):
+        """Ids of the API keys, expired ones included, whose hash starts with
+        ``secret_hash``."""
+        try:
+            cur = await self.db.execute("""
+                SELECT id FROM api_key
+                WHERE type = 'LLM' AND secret LIKE ? || '%'
+                """, (secret_hash,))
+            rows = await cur.fetchall()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return [row["id"] for row in rows]
+
+    async def key_count(self):
+        """Number of valid (unexpired) API keys."""
+        try:
+            cur = await self.db.execute("""
+                SELECT COUNT(*) AS n FROM api_key
+                WHERE type = 'LLM'
+                    AND (expires IS NULL OR datetime(expires) > datetime())
+                """)
+            row = await cur.fetchone()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return row["n"]
+
+    async def revoked_key_ids(self):
+        """Ids of API keys whose expiry has passed."""
+        try:
+            cur = await self.db.execute("""
+                SELECT id FROM api_key
+                WHERE type = 'LLM' AND datetime(expires) <= datetime()
+                """)
+            rows = await cur.fetchall()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return [row["id"] for row in rows]
+
+    async def key_digests(self, after="", limit=10000):
+        """Up to ``limit`` digests of valid API keys greater than ``after``,
+        in order (for paging through all of them)."""
+        try:
+            cur = await self.db.execute("""
+                SELECT secret FROM api_key
+                WHERE type = 'LLM' AND secret > ?
+                    AND (expires IS NULL OR datetime(expires) > datetime())
+                ORDER BY secret
+                LIMIT ?
+                """, (after, limit))
+            rows = await cur.fetchall()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return [row["secret"] for row in rows]
+
     async def user_update(self, user, **kwargs):
         assert kwargs.keys() <= {"expires", "comment"}
         try:
@@ -258,15 +782,246 @@ class SqliteDatabase:
 
         await self.db.commit()
 
-    async def billing_record_add(self, user, time, resources, request_id):
+    async def usage_report(self, since=None, until=None, api_keys=None,
+            product="", period="hour"):
+        """Sum the hourly usage rollups per ``period`` ("hour", "day",
+        "month" or "total"), API key and product. ``since`` and ``until``
+        (datetimes) are rounded down to the hour; ``api_keys`` is a list of
+        key ids and ``product`` a prefix."""
+        length = {"hour": 19, "day": 10, "month": 7, "total": 0}[period]
+        where = ["product LIKE ? || '%'"]
+        params = [length, product]
+        if since is not None:
+            where.append("hour >= ?")
+            params.append(_hour(since))
+        if until is not None:
+            where.append("hour < ?")
+            params.append(_hour(until))
+        if api_keys is not None:
+            where.append("api_key IN (%s)" % ", ".join("?" * len(api_keys)))
+            params.extend(api_keys)
+
         try:
-            for name, quant in resources.items():
-                await self.db.execute("""
-                    INSERT INTO event_oneoff
-                        (created, api_key, product, quantity, rid)
-                    VALUES (?, ?, ?, ?, ?)
-                    """, (time, user["id"], name, quant, str(request_id)))
+            cur = await self.db.execute("""
+                SELECT r.*, IFNULL(k.secret, '') AS secret FROM (
+                    SELECT substr(hour, 1, ?) AS period, api_key, product,
+                        SUM(requests) AS requests, SUM(quantity) AS quantity
+                    FROM usage_hourly
+                    WHERE %s
+                    GROUP BY period, api_key, product
+                ) AS r LEFT JOIN api_key AS k ON k.id = r.api_key
+                ORDER BY period, api_key, product
+                """ % " AND ".join(where), params)
+            rows = await cur.fetchall()
+            await cur.close()
         except sqlite3.DatabaseError as e:
             raise DatabaseError(e) from e
 
-        await self.db.commit()
+        return rows
+
+    async def usage_backfill_remaining(self):
+        """Number of event ids not yet rolled up by ``usage_backfill``."""
+        try:
+            cur = await self.db.execute("""
+                SELECT MAX(end_id - next_id + 1, 0) AS n FROM usage_backfill
+                """)
+            row = await cur.fetchone()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return row["n"] if row is not None else 0
+
+    async def usage_backfill(self, chunk=100000):
+        """Roll up the next ``chunk`` event ids that predate the rollup table.
+        Each chunk is aggregated by SQLite and committed together with the
+        progress marker, so memory stays bounded and an interrupted backfill
+        resumes without double counting. Returns the ids still remaining."""
+        try:
+            cur = await self.db.execute(
+                "SELECT next_id, end_id FROM usage_backfill")
+            row = await cur.fetchone()
+            await cur.close()
+            if row is None or row["next_id"] > row["end_id"]:
+                return 0
+
+            stop = min(row["next_id"] + chunk, row["end_id"] + 1)
+            await self.db.execute("""
+                INSERT INTO usage_hourly (api_key, product, hour, quantity,
+                    requests)
+                SELECT api_key, product, %s AS h, SUM(quantity), COUNT(*)
+                FROM event_oneoff
+                WHERE id >= ? AND id < ?
+                    AND api_key IS NOT NULL AND product IS NOT NULL
+                GROUP BY api_key, product, h
+                ON CONFLICT (api_key, product, hour) DO UPDATE SET
+                    quantity = quantity + excluded.quantity,
+                    requests = requests + excluded.requests
+                """ % _SQLITE_HOUR.format("created"),
+                (row["next_id"], stop))
+            await self.db.execute("UPDATE usage_backfill SET next_id = ?",
+                (stop,))
+            await self.db.commit()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return row["end_id"] + 1 - stop
+
+    async def billing_export(self, after=None, since=None, until=None,
+            api_keys=None, limit=1000):
+        """Return up to ``limit`` billing events (dicts with id, created,
+        api_key, product, quantity and rid) after the cursor ``after``, in id
+        order, and the cursor to pass for the next batch (None once there
+        are no more). Each batch is one short read, which doesn't block
+        writers in WAL mode."""
+        where = ["id > ?"]
+        params = [int(after) if after is not None else -1]
+        if since is not None:
+            where.append("datetime(created) >= datetime(?)")
+            params.append(since.isoformat())
+        if until is not None:
+            where.append("datetime(created) < datetime(?)")
+            params.append(until.isoformat())
+        if api_keys is not None:
+            where.append("api_key IN (%s)" % ", ".join("?" * len(api_keys)))
+            params.extend(api_keys)
+
+        try:
+            cur = await self.db.execute("""
+                SELECT id, created, api_key, product, quantity, rid
+                FROM event_oneoff
+                WHERE %s
+                ORDER BY id
+                LIMIT ?
+                """ % " AND ".join(where), params + [limit])
+            rows = await cur.fetchall()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return rows, str(rows[-1]["id"]) if rows else None
+
+    async def billing_archive(self, before, directory, limit=10000):
+        """Move up to ``limit`` events created before the date ``before``
+        into per-month archive databases in ``directory`` (named after this
+        database, e.g. db-2025-01.sqlite). Returns the number moved, 0 when
+        there are none left.
+
+        Each month's rows are committed to its archive before they are
+        deleted here, and the archive ignores ids it already has, so an
+        interrupted run can simply be repeated. The newest event is never
+        moved, so ids (and export cursors) are not reused. The usage rollups
+        are kept; events not rolled up yet must be backfilled first."""
+        stem = os.path.splitext(os.path.basename(self.path))[0]
+        try:
+            cur = await self.db.execute("""
+                SELECT id, substr(created, 1, 7) AS month FROM event_oneoff
+                WHERE created < ?
+                    AND id < (SELECT MAX(id) FROM event_oneoff)
+                ORDER BY created
+                LIMIT ?
+                """, (before.isoformat(), limit))
+            rows = await cur.fetchall()
+            await cur.close()
+
+            months = {}
+            for row in rows:
+                months.setdefault(row["month"], []).append(row["id"])
+
+            for month, ids in months.items():
+                path = os.path.join(directory, "%s-%s.sqlite" % (stem, month))
+                await self.db.execute("ATTACH DATABASE ? AS archive", (path,))
+                try:
+                    await self.db.execute("""
+                        CREATE TABLE IF NOT EXISTS archive.event_oneoff (
+                            id INTEGER PRIMARY KEY,
+                            created TEXT,
+                            api_key TEXT,
+                            product TEXT,
+                            quantity INTEGER,
+                            rid TEXT
+                        )""")
+                    await self.db.execute("""
+                        INSERT OR IGNORE INTO archive.event_oneoff
+                        SELECT id, created, api_key, product, quantity, rid
+                        FROM main.event_oneoff
+                        WHERE id IN (SELECT value FROM json_each(?))
+                        """, (json.dumps(ids),))
+                    await self.db.commit()
+                finally:
+                    if self.db.in_transaction:
+                        await self.db.rollback()
+                    await self.db.execute("DETACH DATABASE archive")
+
+            await self.db.execute("""
+                DELETE FROM event_oneoff
+                WHERE id IN (SELECT value FROM json_each(?))
+                """, (json.dumps([row["id"] for row in rows]),))
+            await self.db.commit()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return len(rows)
+
+    async def vacuum_step(self, pages=1000):
+        """Return up to ``pages`` free pages to the filesystem (incremental
+        auto-vacuum only) in one short write. Returns the free pages left and
+        whether they can be reclaimed this way at all."""
+        try:
+            cur = await self.db.execute("PRAGMA auto_vacuum")
+            mode, = (await cur.fetchone()).values()
+            if mode == 2:  # INCREMENTAL
+                cur = await self.db.execute("PRAGMA incremental_vacuum(%d)"
+                    % pages)
+                await cur.fetchall()  # runs one page per row
+            cur = await self.db.execute("PRAGMA freelist_count")
+            free, = (await cur.fetchone()).values()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return free, mode == 2
+
+    async def vacuum(self):
+        """Rewrite the whole database with incremental auto-vacuum enabled.
+        Blocks writers for the duration."""
+        try:
+            await self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await self.db.execute("VACUUM")
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+    async def size(self):
+        """Size of the database in bytes, excluding the WAL."""
+        try:
+            cur = await self.db.execute("PRAGMA page_count")
+            count, = (await cur.fetchone()).values()
+            cur = await self.db.execute("PRAGMA page_size")
+            size, = (await cur.fetchone()).values()
+            await cur.close()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
+
+        return count * size
+
+    async def billing_record_add(self, user, time, resources, request_id):
+        await self.billing_records_add([{"rid": str(request_id), "time": time,
+            "user": user, "resources": resources}])
+
+    async def billing_records_add(self, records, dedupe=False):
+        """Insert billing records (dicts with rid, time, user and resources)
+        in one transaction. With ``dedupe``, resources already stored for the
+        same request id are skipped."""
+        rows = [(r["time"], r["user"]["id"], name, quant, r["rid"])
+            for r in records for name, quant in r["resources"].items()]
+
+        try:
+            # Duplicates hit the unique (rid, product) index.
+            await self.db.executemany("""
+                INSERT %s INTO event_oneoff
+                    (created, api_key, product, quantity, rid)
+                VALUES (?, ?, ?, ?, ?)
+                """ % ("OR IGNORE" if dedupe else ""), rows)
+            await self.db.commit()
+        except sqlite3.DatabaseError as e:
+            raise DatabaseError(e) from e
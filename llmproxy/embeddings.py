@@ -1,9 +1,6 @@
-import decimal
-import json
-
 import aiohttp
 
-from . import auth, billing, metrics, proxy
+from . import auth, billing, jsonscan, metrics, proxy
 
 
 # Frontend related variables are prefixed with f_.
@@ -20,11 +17,10 @@ async def embeddings(f_req):
             request_id=f_req["request_id"])
 
         body = await b_res.content.read()
-        data = json.loads(body, parse_float=decimal.Decimal)
+        usage = jsonscan.top_level_member(body, "usage")
         f_hdrs = {"Content-Type":
             b_res.headers.get("Content-Type", "application/octet-stream")}
         f_res = aiohttp.web.Response(body=body, headers=f_hdrs)
-        usage = data["usage"]
 
         await billing.record(f_req, user, {
             "%s/%s/embedding" % (b_name, b_cfg["device"]):
@@ -0,0 +1,207 @@
+"""Streaming multipart/form-data pass-through (audio uploads).
+
+Instead of spooling the whole upload with ``request.post()`` and sending it
+again as a new ``FormData``, ``FormStream`` reads the parts with aiohttp's
+``MultipartReader`` and forwards them to the backend as they arrive, so the
+first bytes reach the backend while the client is still uploading.
+
+Only the leading fields (the ones before the first file) are read up front;
+they are what the proxy routes on (``model``) and rewrites (``model``,
+``response_format``). Clients normally send fields before files; if a file
+comes before ``model`` it is spooled to a temporary file until ``model`` shows
+up, exactly what ``post()`` would have done. Rewritten fields are sent first
+and any later copy of them is dropped (the first value wins, as with
+``post()``); a late copy is still run through the body transform so an invalid
+value is rejected.
+"""
+
+import tempfile
+import uuid
+
+import aiohttp.web
+
+# Largest non-file field we read into memory.
+FIELD_LIMIT = 1024 * 1024
+
+# Spooled file parts stay in memory up to this size.
+SPOOL_MEMORY = 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _part_header(boundary, headers):
+    lines = [b"--" + boundary]
+    lines += [("%s: %s" % (k, v)).encode() for k, v in headers.items()]
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+def _field_header(boundary, name):
+    return _part_header(boundary,
+        {"Content-Disposition": 'form-data; name="%s"' % name})
+
+
+class FormStream:
+    """Dict-like view of the leading form fields plus an async generator
+    (``body()``) producing the rewritten multipart body for the backend.
+
+    ``error`` is set when the upload has to be rejected after forwarding
+    began (too large, or an invalid late field); ``proxy.request`` raises it
+    instead of the backend outcome.
+    """
+
+    def __init__(self, reader, limit):
+        self._reader = reader
+        self._limit = limit
+        self._size = 0
+        self._parts = []  # leading parts: (name, headers, bytes | file)
+        self._fields = {}  # first value of each leading non-file field
+        self._overrides = {}
+        self._pending = None  # first part not read up front
+        self._transform = None
+        self.boundary = uuid.uuid4().hex.encode()
+        self.error = None
+
+    @classmethod
+    async def read(cls, f_req, limit):
+        """Read the leading fields of ``f_req``'s multipart body, up to the
+        first file part after ``model`` (spooling earlier file parts)."""
+        self = cls(await f_req.multipart(), limit)
+
+        try:
+            while (part := await self._reader.next()) is not None:
+                if isinstance(part, aiohttp.MultipartReader):
+                    raise aiohttp.web.HTTPBadRequest(
+                        text="Nested multipart is not supported")
+
+                if part.filename is None:
+                    value = await self._read_field(part)
+                    self._parts.append((part.name, part.headers, value))
+                    self._fields.setdefault(part.name,
+                        value.decode(part.get_charset("utf-8")))
+                elif "model" in self._fields:
+                    self._pending = part
+                    break
+                else:
+                    self._parts.append((part.name, part.headers,
+                        await self._spool(part)))
+        except BaseException:
+            self.close()
+            raise
+
+        return self
+
+    def _count(self, n):
+        self._size += n
+        if self._size > self._limit:
+            raise aiohttp.web.HTTPRequestEntityTooLarge(self._limit,
+                self._size)
+
+    async def _read_field(self, part):
+        value = bytearray()
+        while chunk := await part.read_chunk(CHUNK_SIZE):
+            self._count(len(chunk))
+            value += chunk
+            if len(value) > FIELD_LIMIT:
+                raise aiohttp.web.HTTPRequestEntityTooLarge(FIELD_LIMIT,
+                    len(value))
+        return bytes(value)
+
+    async def _spool(self, part):
+        f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        try:
+            while chunk := await part.read_chunk(CHUNK_SIZE):
+                self._count(len(chunk))
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+
+    def __contains__(self, key):
+        return key in self._overrides or key in self._fields
+
+    def __getitem__(self, key):
+        if key in self._overrides:
+            return self._overrides[key]
+        return self._fields[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._overrides[key] = value
+
+    def apply(self, body_transform):
+        """Run ``body_transform`` on the leading fields and remember it for
+        copies of the rewritten fields that arrive later in the stream."""
+        body_transform(self)
+        self._transform = body_transform
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary=%s" % self.boundary.decode()
+
+    def _check_late(self, name, value):
+        if self._transform is None or self.error is not None:
+            return
+        try:
+            self._transform({name: value})
+        except aiohttp.web.HTTPException as e:
+            self.error = e
+
+    async def body(self):
+        """Yield the backend body: overridden fields, the leading parts, then
+        the rest of the client's stream as it arrives."""
+        b = self.boundary
+        try:
+            for name, value in self._overrides.items():
+                yield _field_header(b, name) + str(value).encode() + b"\r\n"
+
+            for name, headers, content in self._parts:
+                if name in self._overrides:
+                    continue
+                yield _part_header(b, headers)
+                if isinstance(content, bytes):
+                    yield content
+                else:
+                    while chunk := content.read(CHUNK_SIZE):
+                        yield chunk
+                yield b"\r\n"
+
+            part = self._pending
+            while part is not None:
+                if isinstance(part, aiohttp.MultipartReader):
+                    raise aiohttp.web.HTTPBadRequest(
+                        text="Nested multipart is not supported")
+                if part.filename is None:
+                    value = await self._read_field(part)
+                    if part.name in self._overrides:
+                        self._check_late(part.name,
+                            value.decode(part.get_charset("utf-8")))
+                    else:
+                        yield _part_header(b, part.headers) + value + b"\r\n"
+                else:
+                    yield _part_header(b, part.headers)
+                    while chunk := await part.read_chunk(CHUNK_SIZE):
+                        self._count(len(chunk))
+                        yield chunk
+                    yield b"\r\n"
+                part = await self._reader.next()
+
+            yield b"--" + b + b"--\r\n"
+        except aiohttp.web.HTTPException as e:
+            # Abort the backend upload; proxy.request raises self.error.
+            self.error = e
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the spooled file parts (safe to call more than once)."""
+        for _, _, content in self._parts:
+            if not isinstance(content, bytes):
+                content.close()
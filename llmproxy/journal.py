@@ -0,0 +1,211 @@
+"""Append-only, fsync-batched journal for write-behind billing.
+
+Records are appended as JSON lines to the current segment file. A single
+writer task writes and fsyncs whatever has queued up since its last write, so
+concurrent requests share one fsync (group commit); ``append()`` returns once
+the record is on disk. ``rotate()`` seals the current segment; a sealed
+segment is deleted (``discard()``) once all its records are in the database.
+Segments left over from a previous run are loaded by ``open()`` and replayed.
+
+A lock file keeps a second process from using (and replaying) the same
+journal.
+"""
+
+import asyncio
+import datetime
+import decimal
+import fcntl
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".journal"
+
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return {"$decimal": str(obj)}
+    if isinstance(obj, datetime.datetime):
+        return {"$datetime": obj.isoformat()}
+    if type(obj).__name__ == "ObjectId":  # Mongo ids in user rows
+        return {"$oid": str(obj)}
+    raise TypeError("Cannot journal %r" % type(obj))
+
+
+def _object_hook(d):
+    if len(d) == 1:
+        (key, value), = d.items()
+        if key == "$decimal":
+            return decimal.Decimal(value)
+        if key == "$datetime":
+            return datetime.datetime.fromisoformat(value)
+        if key == "$oid":
+            import bson
+            return bson.ObjectId(value)
+    return d
+
+
+def encode(record):
+    return json.dumps(record, default=_default, separators=(",", ":")) + "\n"
+
+
+def decode(line):
+    return json.loads(line, object_hook=_object_hook)
+
+
+def _write(f, data):
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Segment:
+    def __init__(self, path, records=None):
+        self.path = path
+        self.records = records if records is not None else []
+        self.flushed = 0  # records already committed to the database
+        # Some records may be in the database already (replayed segment, or
+        # a failed non-atomic insert): skip those by request id.
+        self.dedupe = False
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.sealed = []  # oldest first
+        self.current = None
+        self._seq = 0
+        self._file = None
+        self._pending = []  # (line, record, future)
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._writer = None
+        self._lockfile = None
+
+    @classmethod
+    async def open(cls, path):
+        self = cls(path)
+
+        os.makedirs(path, exist_ok=True)
+        self._lockfile = open(os.path.join(path, "lock"), "w")
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lockfile.close()
+            raise RuntimeError(
+                "Billing journal %s is in use by another process" % path)
+
+        seqs = sorted(int(name.removesuffix(SUFFIX))
+            for name in os.listdir(path) if name.endswith(SUFFIX))
+        for seq in seqs:
+            segment = Segment(self._segment_path(seq),
+                self._load(self._segment_path(seq)))
+            segment.dedupe = True
+            self.sealed.append(segment)
+        self._seq = seqs[-1] if seqs else 0
+
+        await self._new_segment()
+        self._writer = asyncio.create_task(self._write_loop())
+        return self
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, "%016d%s" % (seq, SUFFIX))
+
+    @staticmethod
+    def _load(path):
+        records = []
+        with open(path) as f:
+            for n, line in enumerate(f, 1):
+                try:
+                    records.append(decode(line))
+                except ValueError:
+                    # A torn write from a crash; it was never acknowledged.
+                    logger.warning("Skipping corrupt journal line %s:%d",
+                        path, n)
+        return records
+
+    async def _new_segment(self):
+        self._seq += 1
+        path = self._segment_path(self._seq)
+        self._file = open(path, "ab")
+        await asyncio.to_thread(_fsync_dir, self.path)
+        self.current = Segment(path)
+
+    async def append(self, record):
+        """Write ``record`` to the journal; returns once it is fsynced.
+        Raises OSError if it could not be written."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((encode(record), record, future))
+        self._wakeup.set()
+        await future
+
+    async def _write_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            async with self._lock:
+                await self._write_pending()
+
+    async def _write_pending(self):
+        """Write and fsync the queued records and resolve their appends.
+        Called with ``_lock`` held."""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        data = "".join(line for line, _, _ in batch).encode()
+        try:
+            await asyncio.to_thread(_write, self._file, data)
+        except OSError as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.current.records.extend(record for _, record, _ in batch)
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def rotate(self):
+        """Seal the current segment (if it has records) and start a new one."""
+        async with self._lock:
+            if not self.current.records:
+                return
+            self._file.close()
+            self.sealed.append(self.current)
+            await self._new_segment()
+
+    def discard(self, segment):
+        """Delete a sealed segment whose records are all in the database."""
+        os.unlink(segment.path)
+        self.sealed.remove(segment)
+
+    async def close(self):
+        """Stop the writer and close the journal, once the write in progress
+        and the records still queued are on disk; the current segment is
+        deleted if it is left empty."""
+        # Holding the lock, the writer is never cancelled mid-write.
+        async with self._lock:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            await self._write_pending()
+
+        self._file.close()
+        if not self.current.records:
+            os.unlink(self.current.path)
+
+        self._lockfile.close()  # releases the lock
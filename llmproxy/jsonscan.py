@@ -0,0 +1,263 @@
+"""Read (and rewrite) top-level members of JSON bodies without decoding the
+rest.
+
+The billed handlers only need `usage` (or `duration`) from backend bodies, but
+a full ``json.loads(body, parse_float=decimal.Decimal)`` turns every float of
+the body into a Decimal — for an embeddings batch that is millions of them.
+vLLM serializes `usage` near the end of the object, so we look for the member
+from the tail, decode just its value and prove it belongs to the top-level
+object by parsing the (short) rest of the body up to the closing brace. When
+that is not possible (the member sits mid-object, the body is not an object,
+...) we fall back to the full parse, so the result is always the same.
+
+``RawObject`` does the same for client request bodies: it indexes the
+top-level members of the raw bytes, decodes only the ones asked for and
+applies assignments as splices, so a multi-MB prompt is forwarded verbatim.
+"""
+
+import decimal
+import json
+import re
+
+_DECODER = json.JSONDecoder(parse_float=decimal.Decimal)
+_WS = re.compile(r"[ \t\n\r]*")
+_COLON = re.compile(r"[ \t\n\r]*:[ \t\n\r]*")
+
+_MISSING = object()
+
+# Byte-level tokens for skipping values in RawObject. A string is matched
+# whole; a lone quote therefore means an unterminated string.
+_B_WS = re.compile(rb"[ \t\n\r]*")
+_B_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_B_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|["\[\]{}]')
+_B_SCALAR = re.compile(rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?"
+    rb"|true|false|null|NaN|-?Infinity")
+_CLOSING = {ord("{"): ord("}"), ord("["): ord("]")}
+
+
+def _decode_value(text, pos):
+    """Decode the value of the member whose key ends at ``pos``; return
+    (value, end) or None."""
+    m = _COLON.match(text, pos)
+    if m is None:
+        return None
+    try:
+        return _DECODER.raw_decode(text, m.end())
+    except json.JSONDecodeError:
+        return None
+
+
+def _closes_object(text, pos):
+    """Whether ``text[pos:]`` is the remaining members of an object, its
+    closing brace and nothing else, i.e. the member just before ``pos`` belongs
+    to the outermost object."""
+    while True:
+        pos = _WS.match(text, pos).end()
+        if text.startswith("}", pos):
+            return _WS.match(text, pos + 1).end() == len(text)
+        if not text.startswith(",", pos):
+            return False
+        pos = _WS.match(text, pos + 1).end()
+        try:
+            key, pos = _DECODER.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            return False
+        if not isinstance(key, str):
+            return False
+        found = _decode_value(text, pos)
+        if found is None:
+            return False
+        _, pos = found
+
+
+def _from_tail(body, needle):
+    i = body.rfind(needle)
+    if i == -1:
+        return _MISSING
+
+    # Must be in key position: preceded by "," or "{" (checked in place; a
+    # slice of the prefix would copy the whole body).
+    j = i - 1
+    while j >= 0 and body[j] in b" \t\n\r":
+        j -= 1
+    if j < 0 or body[j] not in b",{":
+        return _MISSING
+
+    # The needle is ASCII, so slicing at it cannot split a UTF-8 sequence.
+    try:
+        text = body[i + len(needle):].decode()
+    except UnicodeDecodeError:
+        return _MISSING
+
+    found = _decode_value(text, 0)
+    if found is None:
+        return _MISSING
+    value, end = found
+    if not _closes_object(text, end):
+        return _MISSING
+    return value
+
+
+def _from_head(body, needle):
+    head = body.lstrip()
+    if not head.startswith(b"{"):
+        return _MISSING
+    head = head[1:].lstrip()
+    if not head.startswith(needle):
+        return _MISSING
+
+    try:
+        text = head[len(needle):].decode()
+    except UnicodeDecodeError:
+        return _MISSING
+
+    found = _decode_value(text, 0)
+    if found is None:
+        return _MISSING
+    return found[0]
+
+
+def top_level_member(body, key, default=_MISSING):
+    """Return the value of member ``key`` of the JSON object ``body`` (bytes),
+    decoded with Decimal floats like ``json.loads(body,
+    parse_float=decimal.Decimal)[key]``.
+
+    Missing members raise KeyError unless ``default`` is given; a body that is
+    not valid JSON raises JSONDecodeError, as the full parse would.
+    """
+    needle = b'"%s"' % key.encode()
+
+    for scan in (_from_tail, _from_head):
+        value = scan(body, needle)
+        if value is not _MISSING:
+            return value
+
+    data = json.loads(body, parse_float=decimal.Decimal)
+    if default is _MISSING:
+        return data[key]
+    return data.get(key, default)
+
+
+def _skip_value(body, pos):
+    """Return the offset just past the JSON value at ``body[pos]``. Strings
+    and brackets are checked for balance, scalars inside containers are not
+    (the backend still parses the body and rejects anything malformed)."""
+    c = body[pos:pos + 1]
+    if c == b'"':
+        m = _B_STRING.match(body, pos)
+        if m is None:
+            raise ValueError("unterminated string at %d" % pos)
+        return m.end()
+
+    if c in (b"{", b"["):
+        stack = []
+        for m in _B_TOKEN.finditer(body, pos):
+            ch = body[m.start()]
+            if ch == 0x22:  # '"'
+                if m.end() - m.start() == 1:
+                    raise ValueError("unterminated string at %d" % m.start())
+                continue
+            if ch in _CLOSING:
+                stack.append(_CLOSING[ch])
+            elif not stack or stack.pop() != ch:
+                raise ValueError("unbalanced %r at %d" % (chr(ch), m.start()))
+            if not stack:
+                return m.end()
+        raise ValueError("unterminated value at %d" % pos)
+
+    m = _B_SCALAR.match(body, pos)
+    if m is None:
+        raise ValueError("invalid value at %d" % pos)
+    return m.end()
+
+
+class RawObject:
+    """Dict-like view of a JSON object body (bytes) for ``proxy.request``.
+
+    Indexes the top-level members without decoding them; ``get``/``[]``
+    decode a single member and assignments are recorded and spliced into the
+    original bytes by ``encode()``. Supports what the ``body_transform``
+    functions use, so they work on it unchanged. Raises ValueError if the body
+    is not a JSON object it can index (the caller then falls back to the full
+    parse, which reports the error).
+    """
+
+    def __init__(self, body):
+        self._body = body
+        self._spans = {}  # key -> (start, end) of the value
+        self._edits = {}  # key -> encoded new value
+
+        pos = _B_WS.match(body, 0).end()
+        if body[pos:pos + 1] != b"{":
+            raise ValueError("not a JSON object")
+        pos = _B_WS.match(body, pos + 1).end()
+
+        if body[pos:pos + 1] != b"}":
+            while True:
+                m = _B_STRING.match(body, pos)
+                if m is None:
+                    raise ValueError("expected a member name at %d" % pos)
+                key = json.loads(m.group())
+                pos = _B_WS.match(body, m.end()).end()
+                if body[pos:pos + 1] != b":":
+                    raise ValueError("expected ':' at %d" % pos)
+                pos = _B_WS.match(body, pos + 1).end()
+                end = _skip_value(body, pos)
+                # Last duplicate wins, as with json.loads.
+                self._spans[key] = (pos, end)
+                pos = _B_WS.match(body, end).end()
+                if body[pos:pos + 1] == b",":
+                    pos = _B_WS.match(body, pos + 1).end()
+                    continue
+                if body[pos:pos + 1] == b"}":
+                    break
+                raise ValueError("expected ',' or '}' at %d" % pos)
+
+        self._close = pos
+        if _B_WS.match(body, pos + 1).end() != len(body):
+            raise ValueError("extra data after the object")
+
+    def __contains__(self, key):
+        return key in self._edits or key in self._spans
+
+    def __getitem__(self, key):
+        if key in self._edits:
+            return json.loads(self._edits[key], parse_float=decimal.Decimal)
+        start, end = self._spans[key]
+        return json.loads(self._body[start:end], parse_float=decimal.Decimal)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._edits[key] = json.dumps(value).encode()
+
+    def encode(self):
+        """Return the body with all assignments applied."""
+        if not self._edits:
+            return self._body
+
+        body = self._body
+        out = []
+        pos = 0
+        for start, end, value in sorted(
+                (*self._spans[k], v) for k, v in self._edits.items()
+                if k in self._spans):
+            out += [body[pos:start], value]
+            pos = end
+        out.append(body[pos:self._close])
+
+        members = bool(self._spans)
+        for key, value in self._edits.items():
+            if key in self._spans:
+                continue
+            if members:
+                out.append(b", ")
+            out += [json.dumps(key).encode(), b": ", value]
+            members = True
+
+        out.append(body[self._close:])
+        return b"".join(out)
@@ -11,13 +11,14 @@ double-count input. Mapped to the existing `model/device/prompt|completion`
 products (cache tokens folded into prompt); no new rate.
 """
 
-import decimal
-import json
-
 import aiohttp
 import aiohttp.web
 
-from . import auth, billing, metrics, proxy, streaming
+from . import auth, billing, jsonscan, metrics, proxy, streaming
+
+
+# The only events carrying usage; everything else is skipped undecoded.
+_USAGE_EVENT_NAMES = (b"message_start", b"message_delta")
 
 
 def _input_tokens(usage):
@@ -41,11 +42,15 @@ class _MessagesStreamUsage:
     missing usage instead of under-billing a paying customer.
     """
 
+    skim = _USAGE_EVENT_NAMES
+
     def __init__(self):
         self._start_usage = None
         self._output = None
 
     def __call__(self, chunk):
+        if not streaming.may_be_event(chunk, _USAGE_EVENT_NAMES):
+            return
         obj = streaming.parse_sse_event(chunk)
         if not isinstance(obj, dict):
             return
@@ -83,17 +88,17 @@ async def messages(f_req):
 
         if "text/event-stream" in b_res.headers.get("Content-Type", ""):
             usage_acc = _MessagesStreamUsage()
-            f_res = await streaming.stream_through(f_req, b_res, usage_acc)
+            f_res = await streaming.stream_through(f_req, b_res, usage_acc,
+                b_name, b_cfg)
             usage = usage_acc.usage()
         else:
             body = await b_res.content.read()
-            data = json.loads(body, parse_float=decimal.Decimal)
+            u = jsonscan.top_level_member(body, "usage")
             f_hdrs = {"Content-Type":
                 b_res.headers.get("Content-Type", "application/octet-stream")}
             f_res = aiohttp.web.Response(body=body, headers=f_hdrs)
             # Fail loud on a usage-less 200 (like chat.py's data["usage"]),
             # never silently under-bill to zero.
-            u = data["usage"]
             usage = {"prompt_tokens": _input_tokens(u),
                 "completion_tokens": u["output_tokens"]}
 
@@ -108,6 +113,7 @@ async def messages(f_req):
             usage["prompt_tokens"], usage["completion_tokens"], b_name)
 
         metrics.observe_text_tokens(b_name,
-            usage["prompt_tokens"], usage["completion_tokens"])
+            usage["prompt_tokens"], usage["completion_tokens"],
+            f_req.get("generation_seconds"))
 
         return f_res
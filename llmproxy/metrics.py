@@ -12,15 +12,81 @@ Prometheus.  The following metric families are provided:
   llmproxy_active_requests
       Gauge — number of in-flight requests.
 
-  llmproxy_backend_requests_total{model, status}
+  llmproxy_backend_requests_total{model, replica, status}
       Counter — total requests forwarded to backends.
 
-  llmproxy_backend_duration_seconds{model}
+  llmproxy_backend_duration_seconds{model, replica}
       Histogram — backend response latency (time to receive response
       headers, not full body transfer).
 
-  llmproxy_backend_errors_total{model, error_type}
-      Counter — backend errors by type (timeout, connection, client_error).
+  llmproxy_backend_errors_total{model, replica, error_type}
+      Counter — backend errors by type (timeout, connection, client_error,
+      unavailable). Unavailable (no replica with a closed circuit) has an
+      empty replica label.
+
+  llmproxy_backend_retries_total{model, reason}
+      Counter — backend requests retried before the response headers, by
+      reason: connection (refused, reset or timed out connecting), status
+      (503 from the backend).
+
+  llmproxy_backend_retries_denied_total{model}
+      Counter — retries not made because the backend's retry budget was
+      spent.
+
+  llmproxy_backend_connection_limit{model}
+      Gauge — connection pool size of a backend (0 = unlimited). Pool
+      saturation is the sum of llmproxy_backend_in_flight over its replicas
+      divided by this.
+
+  llmproxy_backend_connection_wait_seconds{model}
+      Histogram — time requests waited for a connection from a full backend
+      connection pool.
+
+  llmproxy_backend_connections_total{model, kind}
+      Counter — backend connections used by requests, by kind: new or
+      reused (kept alive).
+
+  llmproxy_backend_concurrency_limit{model}
+      Gauge — requests a backend admits at a time (0 = unlimited); an
+      adaptive limit moves with the backend's latency.
+
+  llmproxy_backend_queue_depth{model}
+      Gauge — requests waiting to be admitted to a backend.
+
+  llmproxy_backend_queue_wait_seconds{model}
+      Histogram — time requests waited to be admitted to a backend (queued
+      requests only, including those that gave up).
+
+  llmproxy_backend_rejected_total{model, reason}
+      Counter — requests turned away with 429 because a backend was at its
+      concurrency limit, by reason: queue_full, queue_timeout.
+
+  llmproxy_backend_in_flight{model, replica}
+      Gauge — requests in flight to a backend replica, until their response
+      has been fully read.
+
+  llmproxy_backend_state{model, replica}
+      Gauge — circuit breaker state of a backend replica: 0 closed
+      (healthy), 1 half-open, 2 open.
+
+  llmproxy_backend_health_checks_total{model, replica, result}
+      Counter — background health checks of backend replicas by result (ok,
+      failed).
+
+  llmproxy_stream_first_event_seconds{model}
+      Histogram — time from sending the backend request to the first SSE
+      event of a streamed response (time to first token, incl. queueing).
+
+  llmproxy_stream_event_gap_seconds{model}
+      Histogram — time between consecutive SSE events of a stream.
+
+  llmproxy_stream_duration_seconds{model}
+      Histogram — time from sending the backend request to the end of the
+      streamed response.
+
+  llmproxy_generation_tokens_per_second{model}
+      Histogram — billed completion tokens divided by the time from the first
+      to the last event of a streamed response.
 
   llmproxy_tokens_total{model, type}
       Counter — tokens processed, labelled by type: prompt, completion,
@@ -28,6 +94,65 @@ Prometheus.  The following metric families are provided:
 
   llmproxy_audio_seconds_total{model}
       Counter — seconds of audio transcribed.
+
+  llmproxy_auth_cache_lookups_total{result}
+      Counter — API key cache lookups by result (hit, miss). Hits include
+      cached unknown keys.
+
+  llmproxy_auth_cache_evictions_total
+      Counter — API keys evicted from the full cache (least recently used).
+
+  llmproxy_auth_filter_checks_total{result}
+      Counter — API key filter checks on a cache miss: rejected (no database
+      lookup), looked_up (not in the filter, but looked up in case the key
+      is new) or passed.
+
+  llmproxy_auth_filter_false_positives_total
+      Counter — passed keys the database did not know. The observed false
+      positive rate is false_positives / (false_positives + rejected).
+
+  llmproxy_auth_filter_keys
+      Gauge — API keys in the key filter at its last build.
+
+  llmproxy_auth_filter_fp_rate
+      Gauge — expected false positive rate of the key filter as built.
+
+  llmproxy_auth_signed_keys_total{result}
+      Counter — signed API keys checked without a database lookup, by
+      result: valid, invalid (bad signature), expired, revoked.
+
+  llmproxy_auth_revoked_keys
+      Gauge — API keys in the revocation list at its last refresh.
+
+  llmproxy_rate_limited_total{scope, kind}
+      Counter — requests answered with 429 because an API key (scope key)
+      or its tier (scope tier) ran out of requests or tokens per minute.
+
+  llmproxy_rate_limit_buckets
+      Gauge — API keys and tiers with rate limit buckets in memory.
+
+  llmproxy_billing_queue_depth
+      Gauge — billing records journaled but not yet written to the database
+      (write-behind billing only).
+
+  llmproxy_billing_flush_duration_seconds
+      Histogram — time to write one batch of billing records.
+
+  llmproxy_billing_flush_batch_size
+      Histogram — billing records per batch written.
+
+  llmproxy_billing_flush_errors_total
+      Counter — failed billing flushes (retried; records stay journaled).
+
+  llmproxy_db_pool_wait_seconds
+      Histogram — time spent waiting for a free database connection.
+
+  llmproxy_db_pool_size
+      Gauge — number of connections in the database pool.
+
+  llmproxy_db_pool_in_use
+      Gauge — database connections currently handed out (utilization is
+      in_use / size).
 """
 
 import time
@@ -72,14 +197,14 @@ ACTIVE_REQUESTS = prometheus_client.Gauge(
 BACKEND_REQUESTS_TOTAL = prometheus_client.Counter(
     "llmproxy_backend_requests_total",
     "Total number of requests forwarded to backends.",
-    labelnames=("model", "status"),
+    labelnames=("model", "replica", "status"),
     registry=_REGISTRY,
 )
 
 BACKEND_DURATION_SECONDS = prometheus_client.Histogram(
     "llmproxy_backend_duration_seconds",
     "Backend response latency in seconds (time to response headers).",
-    labelnames=("model",),
+    labelnames=("model", "replica"),
     buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
              10, 30, 60, 120),
     registry=_REGISTRY,
@@ -88,7 +213,130 @@ BACKEND_DURATION_SECONDS = prometheus_client.Histogram(
 BACKEND_ERRORS_TOTAL = prometheus_client.Counter(
     "llmproxy_backend_errors_total",
     "Total number of backend errors by type.",
-    labelnames=("model", "error_type"),
+    labelnames=("model", "replica", "error_type"),
+    registry=_REGISTRY,
+)
+
+BACKEND_RETRIES_TOTAL = prometheus_client.Counter(
+    "llmproxy_backend_retries_total",
+    "Backend requests retried before the response headers, by reason.",
+    labelnames=("model", "reason"),
+    registry=_REGISTRY,
+)
+
+BACKEND_RETRIES_DENIED_TOTAL = prometheus_client.Counter(
+    "llmproxy_backend_retries_denied_total",
+    "Backend retries not made because the retry budget was spent.",
+    labelnames=("model",),
+    registry=_REGISTRY,
+)
+
+BACKEND_CONNECTION_LIMIT = prometheus_client.Gauge(
+    "llmproxy_backend_connection_limit",
+    "Connection pool size of a backend (0 = unlimited).",
+    labelnames=("model",),
+    registry=_REGISTRY,
+)
+
+BACKEND_CONNECTION_WAIT_SECONDS = prometheus_client.Histogram(
+    "llmproxy_backend_connection_wait_seconds",
+    "Time spent waiting for a connection from a full backend pool.",
+    labelnames=("model",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+             10, 30),
+    registry=_REGISTRY,
+)
+
+BACKEND_CONNECTIONS_TOTAL = prometheus_client.Counter(
+    "llmproxy_backend_connections_total",
+    "Backend connections used by requests, new or reused (kept alive).",
+    labelnames=("model", "kind"),
+    registry=_REGISTRY,
+)
+
+BACKEND_CONCURRENCY_LIMIT = prometheus_client.Gauge(
+    "llmproxy_backend_concurrency_limit",
+    "Requests a backend admits at a time (0 = unlimited), adaptive or "
+    "static.",
+    labelnames=("model",),
+    registry=_REGISTRY,
+)
+
+BACKEND_QUEUE_DEPTH = prometheus_client.Gauge(
+    "llmproxy_backend_queue_depth",
+    "Requests waiting to be admitted to a backend.",
+    labelnames=("model",),
+    registry=_REGISTRY,
+)
+
+BACKEND_QUEUE_WAIT_SECONDS = prometheus_client.Histogram(
+    "llmproxy_backend_queue_wait_seconds",
+    "Time requests waited to be admitted to a backend.",
+    labelnames=("model",),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+             10, 30, 60),
+    registry=_REGISTRY,
+)
+
+BACKEND_REJECTED_TOTAL = prometheus_client.Counter(
+    "llmproxy_backend_rejected_total",
+    "Requests turned away because a backend was at its concurrency limit.",
+    labelnames=("model", "reason"),
+    registry=_REGISTRY,
+)
+
+BACKEND_IN_FLIGHT = prometheus_client.Gauge(
+    "llmproxy_backend_in_flight",
+    "Requests in flight to a backend replica.",
+    labelnames=("model", "replica"),
+    registry=_REGISTRY,
+)
+
+BACKEND_STATE = prometheus_client.Gauge(
+    "llmproxy_backend_state",
+    "Circuit breaker state of a backend replica (0 closed, 1 half-open, "
+    "2 open).",
+    labelnames=("model", "replica"),
+    registry=_REGISTRY,
+)
+
+BACKEND_HEALTH_CHECKS_TOTAL = prometheus_client.Counter(
+    "llmproxy_backend_health_checks_total",
+    "Background health checks of backend replicas by result.",
+    labelnames=("model", "replica", "result"),
+    registry=_REGISTRY,
+)
+
+STREAM_FIRST_EVENT_SECONDS = prometheus_client.Histogram(
+    "llmproxy_stream_first_event_seconds",
+    "Time from backend request to the first SSE event of a stream.",
+    labelnames=("model",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),
+    registry=_REGISTRY,
+)
+
+STREAM_EVENT_GAP_SECONDS = prometheus_client.Histogram(
+    "llmproxy_stream_event_gap_seconds",
+    "Time between consecutive SSE events of a stream.",
+    labelnames=("model",),
+    buckets=(0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 5, 30),
+    registry=_REGISTRY,
+)
+
+STREAM_DURATION_SECONDS = prometheus_client.Histogram(
+    "llmproxy_stream_duration_seconds",
+    "Time from backend request to the end of a streamed response.",
+    labelnames=("model",),
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+    registry=_REGISTRY,
+)
+
+GENERATION_TOKENS_PER_SECOND = prometheus_client.Histogram(
+    "llmproxy_generation_tokens_per_second",
+    "Completion tokens per second of a streamed response (first to last "
+    "event).",
+    labelnames=("model",),
+    buckets=(1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400, 1000),
     registry=_REGISTRY,
 )
 
@@ -110,6 +358,132 @@ AUDIO_SECONDS_TOTAL = prometheus_client.Counter(
     registry=_REGISTRY,
 )
 
+# ---------------------------------------------------------------------------
+# API key cache metrics
+# ---------------------------------------------------------------------------
+
+AUTH_CACHE_LOOKUPS_TOTAL = prometheus_client.Counter(
+    "llmproxy_auth_cache_lookups_total",
+    "API key cache lookups by result.",
+    labelnames=("result",),
+    registry=_REGISTRY,
+)
+
+AUTH_CACHE_EVICTIONS_TOTAL = prometheus_client.Counter(
+    "llmproxy_auth_cache_evictions_total",
+    "API keys evicted from the full cache.",
+    registry=_REGISTRY,
+)
+
+AUTH_FILTER_CHECKS_TOTAL = prometheus_client.Counter(
+    "llmproxy_auth_filter_checks_total",
+    "API key filter checks by result.",
+    labelnames=("result",),
+    registry=_REGISTRY,
+)
+
+AUTH_FILTER_FALSE_POSITIVES_TOTAL = prometheus_client.Counter(
+    "llmproxy_auth_filter_false_positives_total",
+    "Unknown API keys the key filter let through to the database.",
+    registry=_REGISTRY,
+)
+
+AUTH_FILTER_KEYS = prometheus_client.Gauge(
+    "llmproxy_auth_filter_keys",
+    "API keys in the key filter.",
+    registry=_REGISTRY,
+)
+
+AUTH_FILTER_FP_RATE = prometheus_client.Gauge(
+    "llmproxy_auth_filter_fp_rate",
+    "Expected false positive rate of the key filter.",
+    registry=_REGISTRY,
+)
+
+AUTH_SIGNED_KEYS_TOTAL = prometheus_client.Counter(
+    "llmproxy_auth_signed_keys_total",
+    "Signed API keys checked, by result.",
+    labelnames=("result",),
+    registry=_REGISTRY,
+)
+
+AUTH_REVOKED_KEYS = prometheus_client.Gauge(
+    "llmproxy_auth_revoked_keys",
+    "API keys in the revocation list for signed keys.",
+    registry=_REGISTRY,
+)
+
+# ---------------------------------------------------------------------------
+# Rate limit metrics
+# ---------------------------------------------------------------------------
+
+RATE_LIMITED_TOTAL = prometheus_client.Counter(
+    "llmproxy_rate_limited_total",
+    "Requests over a per API key or per tier rate limit.",
+    labelnames=("scope", "kind"),
+    registry=_REGISTRY,
+)
+
+RATE_LIMIT_BUCKETS = prometheus_client.Gauge(
+    "llmproxy_rate_limit_buckets",
+    "API keys and tiers with rate limit buckets in memory.",
+    registry=_REGISTRY,
+)
+
+# ---------------------------------------------------------------------------
+# Write-behind billing metrics
+# ---------------------------------------------------------------------------
+
+BILLING_QUEUE_DEPTH = prometheus_client.Gauge(
+    "llmproxy_billing_queue_depth",
+    "Billing records journaled but not yet written to the database.",
+    registry=_REGISTRY,
+)
+
+BILLING_FLUSH_DURATION_SECONDS = prometheus_client.Histogram(
+    "llmproxy_billing_flush_duration_seconds",
+    "Time to write one batch of billing records to the database.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=_REGISTRY,
+)
+
+BILLING_FLUSH_BATCH_SIZE = prometheus_client.Histogram(
+    "llmproxy_billing_flush_batch_size",
+    "Billing records per batch written to the database.",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000),
+    registry=_REGISTRY,
+)
+
+BILLING_FLUSH_ERRORS_TOTAL = prometheus_client.Counter(
+    "llmproxy_billing_flush_errors_total",
+    "Failed billing flushes (retried; the records stay journaled).",
+    registry=_REGISTRY,
+)
+
+# ---------------------------------------------------------------------------
+# Database pool metrics
+# ---------------------------------------------------------------------------
+
+DB_POOL_WAIT_SECONDS = prometheus_client.Histogram(
+    "llmproxy_db_pool_wait_seconds",
+    "Time spent waiting for a free database connection.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+             1, 5),
+    registry=_REGISTRY,
+)
+
+DB_POOL_SIZE = prometheus_client.Gauge(
+    "llmproxy_db_pool_size",
+    "Number of connections in the database pool.",
+    registry=_REGISTRY,
+)
+
+DB_POOL_IN_USE = prometheus_client.Gauge(
+    "llmproxy_db_pool_in_use",
+    "Number of database connections currently in use.",
+    registry=_REGISTRY,
+)
+
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
@@ -127,7 +501,8 @@ def _normalize_path(path, known_paths):
     return path if path in known_paths else "unknown"
 
 
-def observe_text_tokens(model, prompt_tokens, completion_tokens):
+def observe_text_tokens(model, prompt_tokens, completion_tokens,
+        generation_seconds=None):
     """Record prompt/completion token usage for a text-generation endpoint.
 
     Shared by chat, messages and responses so that a text endpoint which bills
@@ -141,9 +516,16 @@ def observe_text_tokens(model, prompt_tokens, completion_tokens):
     Counts are coerced to int (token counts are integers) so a stray Decimal —
     billable as Decimal128 on Mongo — cannot raise inside ``.inc()`` and turn an
     already-billed request into a 500.
+
+    ``generation_seconds`` is the decode time of a streamed response (set by
+    ``streaming.stream_through`` in ``req["generation_seconds"]``); when given,
+    the generation rate is observed too.
     """
     TOKENS_TOTAL.labels(model, "prompt").inc(int(prompt_tokens))
     TOKENS_TOTAL.labels(model, "completion").inc(int(completion_tokens))
+    if generation_seconds:
+        GENERATION_TOKENS_PER_SECOND.labels(model).observe(
+            int(completion_tokens) / generation_seconds)
 
 
 # ---------------------------------------------------------------------------
@@ -1,11 +1,13 @@
+import asyncio
 import contextlib
 import json
+import random
 import time
 
 import aiohttp
 import yarl
 
-from . import metrics
+from . import balancer, formstream, jsonscan, metrics, ratelimit
 
 
 CONTEXT_LENGTH_MARKERS = (
@@ -18,6 +20,11 @@ CONTEXT_LENGTH_MARKERS = (
 )
 
 
+# Backend answers that mean it's overloaded; they lower an adaptive
+# concurrency limit.
+OVERLOAD_STATUSES = (429, 503, 504)
+
+
 def looks_like_context_length_error(body):
     text = body.decode("utf-8", errors="replace").lower()
     return any(marker in text for marker in CONTEXT_LENGTH_MARKERS)
@@ -30,88 +37,298 @@ async def request(f_req, body_transform=None):
     app = f_req.app
 
     if f_req.content_type == "application/json":
-        try:
-            f_body = await f_req.json()
-        except json.decoder.JSONDecodeError as e:
-            raise aiohttp.web.HTTPBadRequest(text="JSON decode error: %s" % e)
+        f_body = None
+        if app["config"].get("splice_json_body", False):
+            # Index the raw body and splice the few fields we rewrite instead
+            # of decoding and re-encoding the whole (possibly multi-MB) prompt.
+            try:
+                f_body = jsonscan.RawObject(await f_req.read())
+            except ValueError:
+                pass  # the full parse below reports (or handles) it
+        if f_body is None:
+            try:
+                f_body = await f_req.json()
+            except json.decoder.JSONDecodeError as e:
+                raise aiohttp.web.HTTPBadRequest(
+                    text="JSON decode error: %s" % e)
     elif f_req.content_type == "multipart/form-data":
-        f_body = await f_req.post()
+        # Streamed to the backend part by part (see formstream).
+        f_body = await formstream.FormStream.read(f_req,
+            f_req.client_max_size)
     else:
         raise aiohttp.web.HTTPUnsupportedMediaType()
 
     try:
-        b_name = f_body["model"]
-        b_cfg = app["config"].get("backends", {})[b_name]
+        async with _forward(f_req, f_body, body_transform) as result:
+            yield result
+    finally:
+        # Spooled parts are closed by the body once sent; also close them if
+        # the request never got that far.
+        if isinstance(f_body, formstream.FormStream):
+            f_body.close()
+        # No-op once billed.
+        ratelimit.refund(f_req)
+
+
+@contextlib.asynccontextmanager
+async def _forward(f_req, f_body, body_transform):
+    """The rest of ``request``: forward the parsed ``f_body``."""
+    app = f_req.app
+
+    try:
+        f_name = f_body["model"]
+        f_cfg = app["config"].get("backends", {})[f_name]
     except KeyError:
         raise aiohttp.web.HTTPUnauthorized(text="Incorrect model")
 
     app.logger.debug("Frontend request: request_id=%s path=%s model=%s",
-        f_req["request_id"], f_req.rel_url.path, b_name)
+        f_req["request_id"], f_req.rel_url.path, f_name)
+
+    upload = f_body if isinstance(f_body, formstream.FormStream) else None
+    # Transform (and so validate) the body before it takes a rate limit
+    # charge or a place in the backend's queue; a fallback backend gets its
+    # own copy if it is picked.
+    bodies = {f_name: _backend_body(f_req, f_body, f_name, f_name, f_cfg,
+        body_transform)}
 
-    b_url = yarl.URL(b_cfg["url"]) / str(f_req.rel_url)[1:]
-    b_hdrs = {"Authorization": "Bearer %s" % b_cfg["token"]}
+    if (rate_limiter := app.get("rate_limiter")) is not None \
+            and "user" in f_req:
+        tokens = 0
+        if upload is None:
+            tokens = ratelimit.estimate_tokens(f_body,
+                len(await f_req.read()))
+        try:
+            f_req["rate_limit_charge"] = rate_limiter.charge(f_req["user"],
+                tokens)
+        except ratelimit.RateLimited as e:
+            app.logger.warning("Rate limited: request_id=%s model=%s "
+                "limit=%s", f_req["request_id"], f_name, e.kind)
+            raise _too_many_requests("Rate limit reached for %s per minute."
+                % e.kind, e.headers) from e
+    # A streamed upload can't be sent again.
+    retries = 0 if upload is not None else f_cfg.get("retries",
+        app["config"].get("retries", 1))
+    backoff = f_cfg.get("retry_backoff", app["config"].get("retry_backoff",
+        0.1))
+    budget = app["balancer"].budgets[f_name]
+    budget.deposit()
+
+    def retry(reason):
+        if attempt > retries:
+            return False
+        if not budget.withdraw():
+            metrics.BACKEND_RETRIES_DENIED_TOTAL.labels(f_name).inc()
+            return False
+        metrics.BACKEND_RETRIES_TOTAL.labels(f_name, reason).inc()
+        app.logger.warning("Retrying backend request: request_id=%s "
+            "model=%s replica=%s reason=%s", f_req["request_id"], b_name,
+            b_replica, reason)
+        return True
+
+    limiter = app["balancer"].limiters[f_name]
+    try:
+        admitted = await limiter.acquire()
+    except balancer.Overloaded as e:
+        app.logger.warning("Backend overloaded: request_id=%s model=%s "
+            "reason=%s", f_req["request_id"], f_name, e.reason)
+        raise _too_many_requests("The model is overloaded, retry later.",
+            {"Retry-After": str(e.retry_after)}) from e
+
+    tried = []
+    attempt = 0
+    latency = None
+    overloaded = False
+    try:
+        while True:
+            attempt += 1
+            b_name, b_cfg, replica = _pick(app, f_name, tried)
+            if replica is None:
+                metrics.BACKEND_ERRORS_TOTAL.labels(f_name, "",
+                    "unavailable").inc()
+                app.logger.error("Backend unavailable: request_id=%s "
+                    "model=%s", f_req["request_id"], f_name)
+                raise aiohttp.web.HTTPServiceUnavailable(
+                    text="Backend unavailable")
+            tried.append(replica)
+            b_replica = replica.url
+
+            if b_name not in bodies:
+                bodies[b_name] = _backend_body(f_req, f_body, f_name, b_name,
+                    b_cfg, body_transform)
+            b_body, b_type = bodies[b_name]
+            b_url = yarl.URL(replica.url) / str(f_req.rel_url)[1:]
+            b_hdrs = {"Authorization": "Bearer %s" % replica.token,
+                "Content-Type": b_type}
+
+            app.logger.debug("Sending backend request: model=%s replica=%s",
+                b_name, b_replica)
+            # Per-backend response timeout overrides the global sock_read
+            # (e.g. audio transcription is silent for minutes; the global
+            # timeout would 504 it).
+            timeout = aiohttp.ClientTimeout(
+                connect=app["config"]["timeout_connect"],
+                sock_read=b_cfg.get("timeout", app["config"]["timeout_read"]))
+            b_start = f_req["backend_start"] = time.monotonic()
+            b_client = replica.acquire()
+            try:
+                b_res = await b_client.session.post(b_url, headers=b_hdrs,
+                    data=b_body, timeout=timeout)
+            except (aiohttp.ClientConnectorError,
+                    aiohttp.ConnectionTimeoutError):
+                replica.release(b_client)
+                # Counts towards opening the replica's circuit; failures
+                # after connecting may be the request's own fault.
+                replica.failure()
+                if upload is None and retry("connection"):
+                    await _backoff(backoff, attempt)
+                    continue
+                raise
+            except aiohttp.ServerTimeoutError:
+                # The backend may still be working on it; don't double the
+                # load.
+                replica.release(b_client)
+                raise
+            except aiohttp.ClientConnectionError:
+                # Connection reset or closed before the response headers.
+                replica.release(b_client)
+                if upload is None and retry("connection"):
+                    await _backoff(backoff, attempt)
+                    continue
+                raise
+            except BaseException:
+                replica.release(b_client)
+                raise
+            replica.success()
 
-    b_body = f_body.copy()
+            # vLLM answers 503 when its queue is full. Only the answer used
+            # tells the limiter of an overload; a retried 503 doesn't.
+            if b_res.status == 503 and upload is None and retry("status"):
+                metrics.BACKEND_REQUESTS_TOTAL.labels(
+                    b_name, b_replica, "503").inc()
+                b_res.release()
+                replica.release(b_client)
+                await _backoff(backoff, attempt)
+                continue
+            break
+
+        try:
+            async with b_res:
+                # The upload was rejected after the backend got all of it
+                # (an invalid late field); don't use its answer.
+                if upload is not None and upload.error is not None:
+                    raise upload.error
+                b_latency = time.monotonic() - b_start
+                metrics.BACKEND_DURATION_SECONDS.labels(
+                    b_name, b_replica).observe(b_latency)
+                metrics.BACKEND_REQUESTS_TOTAL.labels(
+                    b_name, b_replica, str(b_res.status)).inc()
+                if b_res.status in OVERLOAD_STATUSES:
+                    overloaded = True
+                yield b_res, b_name, b_cfg
+                # Time to the first token of a stream, else to the answer.
+                latency = f_req.get("first_event_seconds") or b_latency
+        finally:
+            replica.release(b_client)
+    except aiohttp.ClientError as e:
+        # A rejected upload aborts the backend request mid-body; report
+        # the client's error rather than a backend failure.
+        if upload is not None and upload.error is not None:
+            raise upload.error from e
+        if isinstance(e, aiohttp.ServerTimeoutError):
+            overloaded = True
+        _backend_error(f_req, e, b_name, b_replica, b_start)
+    finally:
+        limiter.release(admitted, latency, overloaded)
+
+
+def _too_many_requests(message, headers):
+    return aiohttp.web.HTTPTooManyRequests(
+        headers=headers,
+        text=json.dumps({
+            "error": {
+                "message": message,
+                "type": "rate_limit_error",
+                "code": "rate_limit_exceeded",
+            },
+        }),
+        content_type="application/json",
+    )
+
+
+def _pick(app, name, tried):
+    """The backend and replica for the next attempt at a request for backend
+    ``name``: a replica not ``tried`` yet, of the backend or else of its
+    ``fallback``; if all were tried, any of them again."""
+    backends = app["config"]["backends"]
+    names = [name]
+    if (fallback := backends[name].get("fallback")) in backends:
+        names.append(fallback)
+    for avoid in (tried, ()):
+        for n in names:
+            if (replica := app["balancer"].pick(n, avoid)) is not None:
+                return n, backends[n], replica
+    return name, backends[name], None
+
+
+async def _backoff(base, attempt):
+    # Full jitter, so retries of requests that failed together spread out.
+    await asyncio.sleep(random.uniform(0, base * 2 ** (attempt - 1)))
+
+
+def _backend_body(f_req, f_body, f_name, b_name, b_cfg, body_transform):
+    """The body to send to backend ``b_name`` and its content type. A
+    fallback backend without ``model`` gets its own name as the model."""
+    # RawObject and FormStream keep their edits apart from the client's
+    # bytes; no copy needed.
+    if isinstance(f_body, (jsonscan.RawObject, formstream.FormStream)):
+        b_body = f_body
+    else:
+        b_body = f_body.copy()
     if (m := b_cfg.get("model")) is not None:
         b_body["model"] = m
+    elif b_name != f_name:
+        b_body["model"] = b_name
 
-    if body_transform is not None:
+    if isinstance(b_body, formstream.FormStream):
+        if body_transform is not None:
+            b_body.apply(body_transform)
+    elif body_transform is not None:
         body_transform(b_body)
 
-    if f_req.content_type == "application/json":
-        b_body = json.dumps(b_body)
-        b_hdrs["Content-Type"] = "application/json"
-    elif f_req.content_type == "multipart/form-data":
-        # Manually add fields to FormData as aiohttp can't serialize FileField
-        d = aiohttp.FormData()
-        for key, value in b_body.items():
-            if isinstance(value, aiohttp.web.FileField):
-                d.add_field(key, value.file, content_type=value.content_type,
-                    filename=value.filename)
-            else:
-                d.add_field(key, value)
-        b_body = d
+    if isinstance(b_body, jsonscan.RawObject):
+        return b_body.encode(), "application/json"
+    elif isinstance(b_body, formstream.FormStream):
+        return b_body.body(), b_body.content_type
+    return json.dumps(b_body), "application/json"
 
-    try:
-        app.logger.debug("Sending backend request")
-        ssl = None if b_cfg.get("verify_ssl", True) else False
-        # Per-backend response timeout overrides the global sock_read (e.g. audio
-        # transcription is silent for minutes; the global timeout would 504 it).
-        timeout = aiohttp.ClientTimeout(
-            connect=app["config"]["timeout_connect"],
-            sock_read=b_cfg.get("timeout", app["config"]["timeout_read"]))
-        b_start = time.monotonic()
-        async with app["client"].post(
-                b_url, headers=b_hdrs, data=b_body, ssl=ssl,
-                timeout=timeout) as b_res:
-            metrics.BACKEND_DURATION_SECONDS.labels(b_name).observe(
-                time.monotonic() - b_start)
-            metrics.BACKEND_REQUESTS_TOTAL.labels(
-                b_name, str(b_res.status)).inc()
-            yield b_res, b_name, b_cfg
-    except aiohttp.ServerTimeoutError as e:
-        metrics.BACKEND_DURATION_SECONDS.labels(b_name).observe(
-            time.monotonic() - b_start)
-        metrics.BACKEND_ERRORS_TOTAL.labels(b_name, "timeout").inc()
-        app.logger.error("Backend timeout: request_id=%s model=%s error=%s",
-            f_req["request_id"], b_name, e)
+
+def _backend_error(f_req, e, b_name, b_replica, b_start):
+    """Record a failed backend request and raise the matching HTTP error."""
+    app = f_req.app
+    metrics.BACKEND_DURATION_SECONDS.labels(b_name, b_replica).observe(
+        time.monotonic() - b_start)
+
+    if isinstance(e, aiohttp.ServerTimeoutError):
+        metrics.BACKEND_ERRORS_TOTAL.labels(b_name, b_replica,
+            "timeout").inc()
+        app.logger.error("Backend timeout: request_id=%s model=%s replica=%s "
+            "error=%s", f_req["request_id"], b_name, b_replica, e)
         raise aiohttp.web.HTTPGatewayTimeout() from e
-    except (aiohttp.ClientConnectorError, aiohttp.ServerConnectionError,
-            aiohttp.ClientPayloadError, aiohttp.ClientResponseError,
-            aiohttp.InvalidURL) as e:
-        metrics.BACKEND_DURATION_SECONDS.labels(b_name).observe(
-            time.monotonic() - b_start)
-        metrics.BACKEND_ERRORS_TOTAL.labels(b_name, "connection").inc()
-        app.logger.error("Backend error: request_id=%s model=%s error=%s",
-            f_req["request_id"], b_name, e)
+
+    if isinstance(e, (aiohttp.ClientConnectorError,
+            aiohttp.ServerConnectionError, aiohttp.ClientPayloadError,
+            aiohttp.ClientResponseError, aiohttp.InvalidURL)):
+        metrics.BACKEND_ERRORS_TOTAL.labels(b_name, b_replica,
+            "connection").inc()
+        app.logger.error("Backend error: request_id=%s model=%s replica=%s "
+            "error=%s", f_req["request_id"], b_name, b_replica, e)
         raise aiohttp.web.HTTPBadGateway() from e
-    except aiohttp.ClientError as e:
-        metrics.BACKEND_DURATION_SECONDS.labels(b_name).observe(
-            time.monotonic() - b_start)
-        metrics.BACKEND_ERRORS_TOTAL.labels(b_name, "client_error").inc()
-        app.logger.error("HTTP client error: request_id=%s model=%s error=%s",
-            f_req["request_id"], b_name, e)
-        raise aiohttp.web.HTTPInternalServerError() from e
+
+    metrics.BACKEND_ERRORS_TOTAL.labels(b_name, b_replica,
+        "client_error").inc()
+    app.logger.error("HTTP client error: request_id=%s model=%s "
+        "replica=%s error=%s", f_req["request_id"], b_name, b_replica, e)
+    raise aiohttp.web.HTTPInternalServerError() from e
 
 
 async def check_response(app, b_name, b_res, expected_status=200,
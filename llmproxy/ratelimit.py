@@ -0,0 +1,179 @@
+"""Per API key rate limits: token buckets of requests and tokens per minute.
+
+Every API key gets ``requests_per_minute`` requests and ``tokens_per_minute``
+tokens (``[rate_limit]``; 0 = unlimited), refilled continuously, with at most
+a minute's worth saved up. A tier (``[rate_limit.tiers.<name>]``, matched
+against the key's ``_tier``) can set its own limits for its keys and, with
+``tier_requests_per_minute`` and ``tier_tokens_per_minute``, buckets shared by
+all of them.
+
+``proxy.request`` charges a request before it is forwarded: one request and
+an estimate of its tokens (see ``estimate_tokens``). ``billing.record``
+replaces the estimate with the tokens billed; a request that used more than
+estimated leaves its buckets in debt, of at most a minute of tokens. A
+request that fails without being billed gets its tokens back. Requests the
+buckets can't pay for are answered with 429 and ``x-ratelimit-*``
+headers without reaching a backend.
+
+Buckets live in one dict of three-item lists and are dropped once idle for
+long enough to be full again.
+"""
+
+import math
+import time
+
+from . import metrics
+
+# Request body fields capping the completion.
+MAX_TOKENS_FIELDS = ("max_tokens", "max_completion_tokens",
+    "max_output_tokens")
+
+# Billed products (the last part of their names) counted in tokens.
+TOKEN_PRODUCTS = ("prompt", "completion", "embedding")
+
+# A bucket idle this long is full (debt is at most a minute), so it can go.
+IDLE_SECONDS = 120
+
+
+def estimate_tokens(body, size):
+    """Tokens a request may use: its ``size`` bytes at about four bytes per
+    token, plus the completion tokens it allows."""
+    tokens = size // 4
+    for field in MAX_TOKENS_FIELDS:
+        value = body.get(field)
+        if type(value) is int and value > 0:
+            tokens += value
+            break
+    return tokens
+
+
+class RateLimited(Exception):
+    """A request went over a rate limit. ``headers`` are the ``x-ratelimit-*``
+    and ``Retry-After`` headers for the 429 response."""
+
+    def __init__(self, kind, headers):
+        super().__init__(kind)
+        self.kind = kind
+        self.headers = headers
+
+
+class RateLimiter:
+    """The token buckets of all API keys and tiers, configured by the
+    ``[rate_limit]`` table ``cfg``."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._buckets = {}  # (scope, id) -> [requests, tokens, updated]
+        self._swept = time.monotonic()
+
+    def _scopes(self, user):
+        """(bucket key, requests per minute, tokens per minute) of each
+        bucket limiting ``user``."""
+        cfg = self.cfg
+        tier = user.get("_tier") or ""
+        t_cfg = cfg.get("tiers", {}).get(tier, {})
+        scopes = [(("key", user["id"]),
+            t_cfg.get("requests_per_minute",
+                cfg.get("requests_per_minute", 0)),
+            t_cfg.get("tokens_per_minute", cfg.get("tokens_per_minute", 0)))]
+        if t_cfg:
+            scopes.append((("tier", tier),
+                t_cfg.get("tier_requests_per_minute", 0),
+                t_cfg.get("tier_tokens_per_minute", 0)))
+        return [s for s in scopes if s[1] or s[2]]
+
+    def _bucket(self, key, rpm, tpm, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [rpm, tpm, now]
+            metrics.RATE_LIMIT_BUCKETS.set(len(self._buckets))
+        else:
+            elapsed = now - bucket[2]
+            bucket[0] = min(rpm, bucket[0] + elapsed * rpm / 60)
+            bucket[1] = min(tpm, bucket[1] + elapsed * tpm / 60)
+            bucket[2] = now
+        return bucket
+
+    def _sweep(self, now):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+            if now - bucket[2] < IDLE_SECONDS}
+        self._swept = now
+        metrics.RATE_LIMIT_BUCKETS.set(len(self._buckets))
+
+    def charge(self, user, tokens):
+        """Take one request and ``tokens`` from the buckets of ``user``.
+        Returns the charge for ``reconcile``, or None if no limit applies.
+        Raises ``RateLimited`` (and takes nothing) if a bucket is short; a
+        request estimated at more than a minute of tokens needs a full
+        bucket."""
+        now = time.monotonic()
+        if now - self._swept >= IDLE_SECONDS:
+            self._sweep(now)
+
+        scopes = self._scopes(user)
+        if not scopes:
+            return None
+        buckets = [self._bucket(key, rpm, tpm, now)
+            for key, rpm, tpm in scopes]
+
+        for (key, rpm, tpm), bucket in zip(scopes, buckets):
+            if rpm and bucket[0] < 1:
+                kind, limit, need = "requests", rpm, 1 - bucket[0]
+            elif tpm and bucket[1] < min(tokens, tpm):
+                kind, limit, need = "tokens", tpm, min(tokens, tpm) - bucket[1]
+            else:
+                continue
+            metrics.RATE_LIMITED_TOTAL.labels(key[0], kind).inc()
+            headers = _headers(scopes, buckets)
+            headers["Retry-After"] = str(max(1, math.ceil(need * 60 / limit)))
+            raise RateLimited(kind, headers)
+
+        for (key, rpm, tpm), bucket in zip(scopes, buckets):
+            if rpm:
+                bucket[0] -= 1
+            if tpm:
+                bucket[1] = max(-tpm, bucket[1] - tokens)
+        return [(bucket, tpm) for (key, rpm, tpm), bucket
+            in zip(scopes, buckets) if tpm], tokens
+
+    def reconcile(self, charge, tokens):
+        """Correct a ``charge`` by the ``tokens`` the request really used."""
+        buckets, estimate = charge
+        for bucket, tpm in buckets:
+            bucket[1] = min(tpm, max(-tpm, bucket[1] - tokens + estimate))
+
+
+def _headers(scopes, buckets):
+    """The ``x-ratelimit-*`` headers for the bucket of each kind with the
+    least left."""
+    headers = {}
+    for i, kind in ((0, "requests"), (1, "tokens")):
+        limited = [(bucket[i], scope[i + 1])
+            for scope, bucket in zip(scopes, buckets) if scope[i + 1]]
+        if not limited:
+            continue
+        level, limit = min(limited)
+        headers["x-ratelimit-limit-%s" % kind] = str(limit)
+        headers["x-ratelimit-remaining-%s" % kind] = str(max(0,
+            math.floor(level)))
+        headers["x-ratelimit-reset-%s" % kind] = "%gs" % round(
+            (limit - level) * 60 / limit, 3)
+    return headers
+
+
+def reconcile(req, resources):
+    """Correct the rate limit charge of ``req`` by the tokens among the billed
+    ``resources``; see ``billing.record``."""
+    if (charge := req.pop("rate_limit_charge", None)) is None:
+        return
+    used = [quantity for product, quantity in resources.items()
+        if product.rpartition("/")[2] in TOKEN_PRODUCTS]
+    if used:
+        req.app["rate_limiter"].reconcile(charge, int(sum(used)))
+
+
+def refund(req):
+    """Give back the tokens charged for ``req`` if it wasn't billed (it
+    failed); see ``proxy.request``."""
+    if (charge := req.pop("rate_limit_charge", None)) is not None:
+        req.app["rate_limiter"].reconcile(charge, 0)
@@ -13,13 +13,12 @@ rejected fail-loud with a 400 rather than silently dropped (a stateful client
 would otherwise get a context-less answer and only notice on the 2nd turn).
 """
 
-import decimal
 import json
 
 import aiohttp
 import aiohttp.web
 
-from . import auth, billing, metrics, proxy, streaming
+from . import auth, billing, jsonscan, metrics, proxy, streaming
 
 
 # Terminal Responses events carrying final usage. `response.incomplete`
@@ -27,6 +26,7 @@ from . import auth, billing, metrics, proxy, streaming
 # generated billable output before failing) carry usage and are billed too.
 RESPONSES_TERMINAL_EVENTS = ("response.completed", "response.incomplete",
     "response.failed")
+_TERMINAL_EVENT_NAMES = tuple(e.encode() for e in RESPONSES_TERMINAL_EVENTS)
 
 
 def usage_from_event(obj):
@@ -103,10 +103,14 @@ class _ResponsesStreamUsage:
     `data: [DONE]` sentinel, the terminal event itself is the end.
     """
 
+    skim = _TERMINAL_EVENT_NAMES
+
     def __init__(self):
         self._usage = None
 
     def __call__(self, chunk):
+        if not streaming.may_be_event(chunk, _TERMINAL_EVENT_NAMES):
+            return
         found = usage_from_event(streaming.parse_sse_event(chunk))
         if found is not None:
             self._usage = found
@@ -141,16 +145,16 @@ async def responses(f_req):
 
             if "text/event-stream" in b_res.headers.get("Content-Type", ""):
                 usage_acc = _ResponsesStreamUsage()
-                f_res = await streaming.stream_through(f_req, b_res, usage_acc)
+                f_res = await streaming.stream_through(f_req, b_res,
+                    usage_acc, b_name, b_cfg)
                 usage = usage_acc.usage()
             else:
                 body = await b_res.content.read()
-                data = json.loads(body, parse_float=decimal.Decimal)
+                usage = jsonscan.top_level_member(body, "usage")
                 f_hdrs = {"Content-Type":
                     b_res.headers.get("Content-Type",
                         "application/octet-stream")}
                 f_res = aiohttp.web.Response(body=body, headers=f_hdrs)
-                usage = data["usage"]
 
             billed = to_billing_tokens(usage)
             await billing.record(f_req, user,
@@ -160,7 +164,8 @@ async def responses(f_req):
                 billed["prompt_tokens"], billed["completion_tokens"], b_name)
 
             metrics.observe_text_tokens(b_name,
-                billed["prompt_tokens"], billed["completion_tokens"])
+                billed["prompt_tokens"], billed["completion_tokens"],
+                f_req.get("generation_seconds"))
 
             return f_res
     except StatefulNotSupported as e:
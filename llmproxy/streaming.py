@@ -1,19 +1,208 @@
+import asyncio
 import contextlib
 import decimal
+import functools
 import json
+import time
 
+import aiohttp
 import aiohttp.web
 
+from . import metrics
 
-async def readuntil(stream, separator: bytes = b"\n") -> bytes:
-    result = bytearray()
-    while not result.endswith(separator):
-        b = await stream.read(1)
-        if not b:
-            break
-        result += b
 
-    return result
+# Default cap on a single SSE block. A terminal Responses event repeats the
+# whole output, so this is generous; it only exists so a backend that never
+# sends a blank line cannot grow the buffer without bound.
+SSE_FRAME_LIMIT = 16 * 1024 * 1024
+
+# How much to ask the StreamReader for at once. read(n) returns whatever is
+# already buffered (up to n) without waiting for n bytes.
+SSE_READ_SIZE = 64 * 1024
+
+# Read size once the client is gone and the stream is only skimmed for usage.
+SKIM_READ_SIZE = 1024 * 1024
+
+SSE_SEPARATORS = (b"\n\n", b"\r\n\r\n")
+
+# SSEReader.skim() selector for accumulators that only need the last blocks of
+# the stream (chat: usage rides in the final chunk before [DONE]).
+SKIM_LAST = "last"
+
+
+class FrameTooLarge(aiohttp.ClientPayloadError):
+    """The backend sent more than the frame limit without a block separator.
+
+    A ClientPayloadError so proxy.request maps it like any other broken backend
+    body (logged, counted as a connection error)."""
+
+
+class SSEReader:
+    """Split a backend ``StreamReader`` into SSE blocks (separator included).
+
+    Pulls whatever the stream has buffered instead of a byte at a time and
+    searches only the bytes not yet scanned, so a block costs O(len) work and a
+    handful of awaits regardless of how the backend chunked it. Accepts both
+    ``\\n\\n`` and ``\\r\\n\\r\\n`` separators. A trailing partial block is
+    returned at EOF and ``b""`` afterwards.
+    """
+
+    def __init__(self, stream, max_frame_size=SSE_FRAME_LIMIT):
+        self._stream = stream
+        self._max_frame_size = max_frame_size
+        self._buf = bytearray()
+        self._scanned = 0  # bytes of _buf known to contain no separator
+        self._eof = False
+
+    def _find_end(self):
+        # Back off by len(longest separator) - 1 so a separator split across
+        # two reads is still found.
+        start = max(self._scanned - 3, 0)
+        end = -1
+        for sep in SSE_SEPARATORS:
+            i = self._buf.find(sep, start)
+            if i != -1 and (end == -1 or i + len(sep) < end):
+                end = i + len(sep)
+        if end == -1:
+            self._scanned = len(self._buf)
+        return end
+
+    async def read_block(self):
+        while True:
+            end = self._find_end()
+            if end != -1:
+                block = bytes(self._buf[:end])
+                del self._buf[:end]
+                self._scanned = 0
+                return block
+
+            if self._eof:
+                block = bytes(self._buf)
+                self._buf.clear()
+                self._scanned = 0
+                return block
+
+            if len(self._buf) > self._max_frame_size:
+                raise FrameTooLarge("SSE block exceeds %d bytes" %
+                    self._max_frame_size)
+
+            data = await self._stream.read(SSE_READ_SIZE)
+            if not data:
+                self._eof = True
+            self._buf += data
+
+    async def skim(self, on_chunk, events):
+        """Consume the rest of the stream in large reads, feeding ``on_chunk``
+        only the blocks it can need instead of every block.
+
+        ``events`` is either a tuple of event names (every block that
+        ``may_be_event`` one of them is fed, in stream order) or ``SKIM_LAST``
+        (each read's last two complete blocks are fed, so an accumulator that
+        keeps the last non-``[DONE]`` block ends with the same one it would
+        have seen live). Used after the client disconnects, when nothing is
+        written any more and only usage matters.
+        """
+        while True:
+            cut = -1
+            for sep in SSE_SEPARATORS:
+                i = self._buf.rfind(sep)
+                if i != -1:
+                    cut = max(cut, i + len(sep))
+            if self._eof:
+                cut = len(self._buf)
+
+            if cut > 0:
+                region = bytes(self._buf[:cut])
+                del self._buf[:cut]
+                for block in _pick_blocks(region, events):
+                    on_chunk(block)
+
+            if self._eof:
+                return
+
+            if len(self._buf) > self._max_frame_size:
+                raise FrameTooLarge("SSE block exceeds %d bytes" %
+                    self._max_frame_size)
+
+            data = await self._stream.read(SKIM_READ_SIZE)
+            if not data:
+                self._eof = True
+            self._buf += data
+
+
+def _block_start(region, pos):
+    """Offset of the block containing ``region[pos]``."""
+    start = 0
+    for sep in SSE_SEPARATORS:
+        i = region.rfind(sep, 0, pos)
+        if i != -1:
+            start = max(start, i + len(sep))
+    return start
+
+
+def _block_end(region, pos):
+    """Offset just past the block containing ``region[pos]``."""
+    end = len(region)
+    for sep in SSE_SEPARATORS:
+        i = region.find(sep, pos)
+        if i != -1:
+            end = min(end, i + len(sep))
+    return end
+
+
+def _pick_blocks(region, events):
+    """Select from ``region`` (whole SSE blocks) the ones SSEReader.skim()
+    feeds to the accumulator, in stream order."""
+    if events == SKIM_LAST:
+        start = _block_start(region, len(region) - 1)
+        if start == 0:
+            return [region]
+        prev = _block_start(region, start - 1)
+        return [region[prev:start], region[start:]]
+
+    bounds = set()
+    for name in events:
+        pos = region.find(name)
+        while pos != -1:
+            bounds.add((_block_start(region, pos), _block_end(region, pos)))
+            pos = region.find(name, pos + len(name))
+
+    blocks = (region[start:end] for start, end in sorted(bounds))
+    return [b for b in blocks if may_be_event(b, events)]
+
+
+def sse_event_name(raw_event):
+    """Return the ``event:`` field of one SSE block as bytes, or None if the
+    block has no ``event:`` line. Looks only at that one line, so it costs a
+    couple of ``find`` calls however large the ``data:`` payload is."""
+    if raw_event.startswith(b"event:"):
+        start = 0
+    else:
+        start = raw_event.find(b"\nevent:")
+        if start == -1:
+            return None
+        start += 1
+
+    end = raw_event.find(b"\n", start)
+    if end == -1:
+        end = len(raw_event)
+    name = raw_event[start + len(b"event:"):end].rstrip(b"\r")
+    if name.startswith(b" "):
+        name = name[1:]
+    return name
+
+
+def may_be_event(raw_event, names):
+    """Cheap pre-classifier: can this SSE block be one of the event ``names``
+    (bytes)? Lets the usage accumulators skip ``parse_sse_event`` (a full
+    Decimal JSON decode) for the content deltas that make up almost every
+    block. Trusts the ``event:`` line when there is one; otherwise falls back
+    to a substring search, which may say yes to a block that is not (the caller
+    still checks the decoded ``type``) but never no to one that is."""
+    name = sse_event_name(raw_event)
+    if name is not None:
+        return name in names
+    return any(n in raw_event for n in names)
 
 
 def parse_sse_event(raw_event):
@@ -46,7 +235,7 @@ def parse_sse_event(raw_event):
 
 
 async def drain(read_block, write_block, on_chunk, on_disconnect=None,
-        disconnected=False):
+        disconnected=False, skim=None):
     """Forward SSE blocks from a backend to the client without ever losing usage.
 
     Reads blocks via ``read_block()`` until it returns ``b""`` (backend EOF),
@@ -59,7 +248,15 @@ async def drain(read_block, write_block, on_chunk, on_disconnect=None,
     and unit-testable without a real connection. Pass ``disconnected=True`` to
     start already disconnected (e.g. the client vanished during the header
     flush): we then drain the backend for usage without writing.
+
+    ``skim``, if given, is awaited instead of the block loop once disconnected:
+    a cheaper drain that still feeds ``on_chunk`` every block carrying usage
+    (see ``SSEReader.skim``).
     """
+    if disconnected and skim is not None:
+        await skim()
+        return
+
     while (chunk := await read_block()):
         on_chunk(chunk)
         if disconnected:
@@ -70,17 +267,119 @@ async def drain(read_block, write_block, on_chunk, on_disconnect=None,
             disconnected = True
             if on_disconnect is not None:
                 on_disconnect(e)
+            if skim is not None:
+                await skim()
+                return
+
+
+def coalesce(read_block, on_chunk, max_bytes, max_delay=0):
+    """Wrap ``read_block`` so each call returns several SSE blocks joined into
+    one write: every block the backend has already delivered, plus whatever
+    arrives within ``max_delay`` seconds of the first one, up to ``max_bytes``
+    (exceeded by at most one block). With ``max_delay=0`` nothing is held back
+    waiting; only blocks that are already buffered are batched.
+
+    ``on_chunk`` is called here for each block individually, so the caller
+    passes ``drain`` a no-op instead. A read interrupted by the deadline is
+    safe to abandon: ``SSEReader`` only changes state after its read returns.
+    """
+    loop = asyncio.get_running_loop()
+    eof = False
+
+    async def read_batch():
+        nonlocal eof
+        if eof:
+            return b""
+
+        block = await read_block()
+        if not block:
+            return block
+        on_chunk(block)
+
+        batch = [block]
+        size = len(block)
+        deadline = loop.time() + max_delay
+        while size < max_bytes:
+            try:
+                async with asyncio.timeout_at(deadline):
+                    block = await read_block()
+            except TimeoutError:
+                break
+            if not block:
+                eof = True
+                break
+            on_chunk(block)
+            batch.append(block)
+            size += len(block)
 
+        return b"".join(batch)
 
-async def stream_through(f_req, b_res, on_chunk):
+    return read_batch
+
+
+class _StreamClock:
+    """Stream latency histograms for one backend stream: time to the first
+    event, gaps between events and total duration, all measured where the
+    proxy reads the events (not where the client receives them)."""
+
+    def __init__(self, model, start):
+        self._model = model
+        self._start = start
+        self._first = None
+        self._last = None
+        self._gap = metrics.STREAM_EVENT_GAP_SECONDS.labels(model)
+
+    def event(self, gap=True):
+        """Time one event. With ``gap=False`` the gap since the previous
+        event is not observed: skimmed blocks arrive batched per read, so
+        their spacing says nothing about the backend."""
+        now = time.monotonic()
+        if self._first is None:
+            self._first = now
+            metrics.STREAM_FIRST_EVENT_SECONDS.labels(self._model).observe(
+                now - self._start)
+        elif gap:
+            self._gap.observe(now - self._last)
+        self._last = now
+
+    def done(self):
+        """Observe the stream duration; return the generation time (first
+        event to end of stream), or None if no event was timed."""
+        now = time.monotonic()
+        metrics.STREAM_DURATION_SECONDS.labels(self._model).observe(
+            now - self._start)
+        if self._first is None:
+            return None
+        return now - self._first
+
+    def first_event(self):
+        """Seconds from the backend request to the first event, or None."""
+        if self._first is None:
+            return None
+        return self._first - self._start
+
+
+async def stream_through(f_req, b_res, on_chunk, b_name=None, b_cfg=None):
     """Wire a chunked backend response to the client, invoking ``on_chunk`` for
     every SSE block (including during the post-disconnect drain). Returns the
     prepared client ``StreamResponse``.
 
     ``on_chunk`` is a per-format usage accumulator, so the same pump/drain logic
     serves chat, Anthropic messages and OpenAI responses.
+
+    With ``coalesce_bytes`` set (globally or in ``b_cfg``) blocks are batched
+    into fewer client writes, see ``coalesce``. An ``on_chunk`` with a ``skim``
+    attribute (event names or ``SKIM_LAST``) gets the cheaper post-disconnect
+    drain, see ``SSEReader.skim``.
+
+    Given ``b_name``, the stream latency histograms are recorded and the
+    generation time is left in ``f_req["generation_seconds"]`` for
+    ``metrics.observe_text_tokens``, also when the stream fails, and the time
+    to the first event in ``f_req["first_event_seconds"]`` for the backend's
+    adaptive concurrency limit. Event gaps are not observed while skimming.
     """
     app = f_req.app
+    b_cfg = b_cfg or {}
     headers = {"Content-Type":
         b_res.headers.get("Content-Type", "application/octet-stream")}
     headers["X-Request-ID"] = str(f_req["request_id"])
@@ -102,12 +401,51 @@ async def stream_through(f_req, b_res, on_chunk):
         app.logger.info("Client disconnected: %s", e)
         disconnected = True
 
-    async def read_block():
-        return await readuntil(b_res.content, b"\n\n")
+    reader = SSEReader(b_res.content,
+        app["config"].get("max_sse_frame", SSE_FRAME_LIMIT))
+    read_block = reader.read_block
+    feed = on_chunk
+
+    clock = None
+    if b_name is not None:
+        clock = _StreamClock(b_name,
+            f_req.get("backend_start", time.monotonic()))
+
+        def feed(chunk):
+            clock.event()
+            on_chunk(chunk)
 
-    await drain(read_block, f_res.write, on_chunk,
-        on_disconnect=lambda e: app.logger.info("Client disconnected: %s", e),
-        disconnected=disconnected)
+    flush_bytes = b_cfg.get("coalesce_bytes",
+        app["config"].get("coalesce_bytes", 0))
+    if flush_bytes:
+        flush_ms = b_cfg.get("coalesce_ms",
+            app["config"].get("coalesce_ms", 0))
+        read_block = coalesce(read_block, feed, flush_bytes,
+            flush_ms / 1000)
+        feed = lambda chunk: None  # coalesce() already fed on_chunk
+
+    skim = None
+    if (events := getattr(on_chunk, "skim", None)) is not None:
+        skim_feed = on_chunk
+        if clock is not None:
+            # Skimming only sees some blocks, so no gaps are observed, but a
+            # first event that arrives after the disconnect is still timed.
+            def skim_feed(chunk):
+                clock.event(gap=False)
+                on_chunk(chunk)
+        skim = functools.partial(reader.skim, skim_feed, events)
+
+    try:
+        await drain(read_block, f_res.write, feed,
+            on_disconnect=lambda e: app.logger.info("Client disconnected: %s",
+                e),
+            disconnected=disconnected, skim=skim)
+    finally:
+        # Also when the backend stream fails, so aborted streams show up in
+        # the duration histogram.
+        if clock is not None:
+            f_req["generation_seconds"] = clock.done()
+            f_req["first_event_seconds"] = clock.first_event()
 
     with contextlib.suppress(OSError):
         await f_res.write_eof()
@@ -1,10 +1,15 @@
 import asyncio
 import json
+import time
 
 import aiohttp
 import aiohttp.web_exceptions
 
 
+# "_id"s of the "503once" requests already answered with 503.
+_overloaded_once = set()
+
+
 async def health(req):
     return aiohttp.web.Response()
 
@@ -55,6 +60,19 @@ async def chat(req):
             return aiohttp.web.json_response(
                 {"error": {"message": "Internal server error"}},
                 status=500)
+        if err == "503once" and b["_id"] not in _overloaded_once:
+            _overloaded_once.add(b["_id"])
+            return aiohttp.web.json_response(
+                {"error": {"message": "Service unavailable"}},
+                status=503)
+        if err == 503:
+            # vLLM's answer when its queue is full.
+            return aiohttp.web.json_response(
+                {"error": {"message": "Service unavailable"}},
+                status=503)
+
+    if "_tokens" in b:
+        return await synthetic_stream(req, b, "chat")
 
     msg = b["messages"][0]["content"]
 
@@ -93,6 +111,79 @@ async def _chat_stream(req, msg, mode):
     return res
 
 
+def synthetic_events(shape, tokens, token_size):
+    """SSE blocks of a generated stream: ``tokens`` content deltas of
+    ``token_size`` characters in the given wire ``shape`` (chat, messages or
+    responses), framed and terminated with usage like the real backend. Each
+    delta's ``t`` is left as a placeholder for the send time."""
+    text = "x" * token_size
+
+    def sse(event, obj):
+        head = b"event: " + event.encode() + b"\n" if event else b""
+        return head + b"data: " + json.dumps(obj).encode() + b"\n\n"
+
+    if shape == "chat":
+        start = []
+        delta = sse(None, {"t": 0, "choices": [{"delta": {"content": text}}]})
+        end = [sse(None, {"choices": [], "usage":
+            {"prompt_tokens": 1, "completion_tokens": tokens}}),
+            b"data: [DONE]\n\n"]
+    elif shape == "messages":
+        start = [sse("message_start", {"type": "message_start",
+            "message": {"usage": {"input_tokens": 1, "output_tokens": 1}}})]
+        delta = sse("content_block_delta", {"type": "content_block_delta",
+            "t": 0, "delta": {"type": "text_delta", "text": text}})
+        end = [sse("message_delta", {"type": "message_delta",
+            "usage": {"output_tokens": tokens}}),
+            sse("message_stop", {"type": "message_stop"})]
+    elif shape == "responses":
+        start = [sse("response.created", {"type": "response.created",
+            "response": {"id": "resp_1"}})]
+        delta = sse("response.output_text.delta",
+            {"type": "response.output_text.delta", "t": 0, "delta": text})
+        end = [sse("response.completed", {"type": "response.completed",
+            "response": {"usage": {"input_tokens": 1,
+                "output_tokens": tokens}}})]
+    else:
+        raise ValueError("unknown stream shape: %s" % shape)
+
+    return start, delta, end
+
+
+async def synthetic_stream(req, b, shape):
+    """Stream a generated response for benchmarks. Body fields: ``_tokens``
+    (number of deltas), ``_token_size`` (characters per delta), ``_chunk``
+    (deltas per backend write) and ``_delay`` (seconds between writes). Every
+    delta carries its send time (time.monotonic()) in ``t``."""
+    tokens = b["_tokens"]
+    per_write = b.get("_chunk", 1)
+    delay = b.get("_delay", 0)
+    start, delta, end = synthetic_events(shape, tokens,
+        b.get("_token_size", 4))
+    head, _, tail = delta.partition(b'"t": 0')
+
+    res = aiohttp.web.StreamResponse(
+        headers={"Content-Type": "text/event-stream"})
+    res.enable_chunked_encoding()
+    await res.prepare(req)
+    for block in start:
+        await res.write(block)
+
+    sent = 0
+    while sent < tokens:
+        n = min(per_write, tokens - sent)
+        stamp = b'"t": ' + repr(time.monotonic()).encode()
+        await res.write((head + stamp + tail) * n)
+        sent += n
+        if delay:
+            await asyncio.sleep(delay)
+
+    for block in end:
+        await res.write(block)
+    await res.write_eof()
+    return res
+
+
 async def embeddings(req):
     b = await req.json()
     if b["model"] != "mymodel":
@@ -123,12 +214,19 @@ async def transcriptions(req):
         "inf": float("inf"), "true": True}
     duration = unbillable.get(post.get("_duration"), 12.5)
 
+    # Echo what arrived so tests can check the form the proxy rebuilt.
+    fields = {k: v for k, v in post.items() if isinstance(v, str)}
+    files = {k: len(v.file.read()) for k, v in post.items()
+        if isinstance(v, aiohttp.web.FileField)}
+
     return aiohttp.web.json_response({
         "task": "transcribe",
         "language": "pl",
         "duration": duration,
         "text": "you said something",
         "segments": [],
+        "_fields": fields,
+        "_files": files,
     })
 
 
@@ -149,6 +247,9 @@ async def messages(req):
     if b["model"] != "mymodel":
         raise aiohttp.web_exceptions.HTTPBadRequest(body="bad model")
 
+    if "_tokens" in b:
+        return await synthetic_stream(req, b, "messages")
+
     if b.get("stream"):
         # Anthropic splits usage: input (+cache) in message_start, cumulative
         # output in the final message_delta.
@@ -187,6 +288,9 @@ async def responses(req):
     if b["model"] != "mymodel":
         raise aiohttp.web_exceptions.HTTPBadRequest(body="bad model")
 
+    if "_tokens" in b:
+        return await synthetic_stream(req, b, "responses")
+
     if b.get("stream"):
         # Usage only in the terminal event; no [DONE]. `_terminal` lets tests
         # end the stream with response.completed / .incomplete / .failed.
@@ -0,0 +1,276 @@
+import asyncio
+import datetime
+import hashlib
+import random
+import types
+import unittest
+from unittest import mock
+
+from llmproxy.app import clear_key_cache, open_key_filter, open_revoked_keys
+from llmproxy.auth import (_MISSING, KeyCache, KeyFilter, RevokedKeys,
+    _signed_user, sign_key, verify_key)
+from llmproxy.db import SqliteDatabase, _billing_document, get_db
+
+from tests.test_proxy import LLMProxyAppTestCase
+
+
+class TestKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("llmproxy.auth.time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_hit_within_ttl(self):
+        cache = KeyCache(size=10, ttl=60)
+        user = {"id": "u", "expires": None}
+        cache.put("d", user)
+        self.now += 59
+        self.assertIs(cache.get("d"), user)
+        self.now += 1
+        self.assertIs(cache.get("d"), _MISSING)
+
+    def test_negative_entry(self):
+        cache = KeyCache(size=10, negative_ttl=5)
+        cache.put("d", None)
+        self.assertIsNone(cache.get("d"))
+        self.now += 5
+        self.assertIs(cache.get("d"), _MISSING)
+
+    def test_key_expiry_honoured(self):
+        # SQLite stores ISO strings, Mongo returns datetimes.
+        cache = KeyCache(size=10, ttl=60)
+        expires = datetime.datetime.fromtimestamp(self.now + 10, datetime.UTC)
+        for value in (expires, expires.isoformat(),
+                expires.replace(tzinfo=None).isoformat()):
+            with self.subTest(expires=value):
+                cache.put("d", {"id": "u", "expires": value})
+                self.now += 9
+                self.assertIsNot(cache.get("d"), _MISSING)
+                self.now += 1
+                self.assertIs(cache.get("d"), _MISSING)
+                self.now -= 10
+
+    def test_already_expired_not_cached(self):
+        cache = KeyCache(size=10, ttl=60)
+        expires = datetime.datetime.fromtimestamp(self.now - 1, datetime.UTC)
+        cache.put("d", {"id": "u", "expires": expires})
+        self.assertIs(cache.get("d"), _MISSING)
+
+    def test_lru_eviction(self):
+        cache = KeyCache(size=2)
+        cache.put("a", None)
+        cache.put("b", None)
+        cache.get("a")
+        cache.put("c", None)
+        self.assertIsNone(cache.get("a"))
+        self.assertIs(cache.get("b"), _MISSING)
+        self.assertIsNone(cache.get("c"))
+
+    def test_disabled(self):
+        cache = KeyCache(size=0)
+        cache.put("d", {"id": "u", "expires": None})
+        self.assertIs(cache.get("d"), _MISSING)
+
+
+class TestKeyFilter(unittest.TestCase):
+    @staticmethod
+    def digest(i):
+        return hashlib.sha256(b"%d" % i).hexdigest()
+
+    def test_no_false_negatives(self):
+        f = KeyFilter(1000)
+        for i in range(1000):
+            f.add(self.digest(i))
+        f.add("not-a-digest")
+        self.assertTrue(all(self.digest(i) in f for i in range(1000)))
+        self.assertIn("not-a-digest", f)
+
+    def test_false_positive_rate(self):
+        f = KeyFilter(10000, fp_rate=0.01)
+        for i in range(10000):
+            f.add(self.digest(i))
+        rng = random.Random(0)
+        fp = sum(rng.randbytes(32).hex() in f for _ in range(20000))
+        self.assertLess(fp / 20000, 0.02)
+        self.assertAlmostEqual(f.fp_rate(), 0.01, delta=0.005)
+
+
+class TestFilteredAuth(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        app["config"]["auth"] = {"key_filter": True,
+            "key_filter_interval": 3600, "key_filter_miss_lookups": 0}
+        await open_key_filter(app)
+        return app
+
+    async def models(self, token="mytoken"):
+        async with self.client.request("GET", "/v1/models",
+                headers={"Authorization": "Bearer %s" % token}) as res:
+            return res.status
+
+    async def test_unknown_key_rejected_without_lookup(self):
+        with mock.patch.object(SqliteDatabase, "user_list", autospec=True,
+                side_effect=SqliteDatabase.user_list) as user_list:
+            self.assertEqual(await self.models("badtoken"), 401)
+            user_list.assert_not_called()
+            self.assertEqual(await self.models(), 200)
+            user_list.assert_called_once()
+
+    async def test_new_key_accepted_after_rebuild(self):
+        db = await get_db(self.app["config"]["db"]["uri"])
+        await db.user_create(hashlib.sha256(b"newtoken").hexdigest())
+        await db.close()
+
+        self.assertEqual(await self.models("newtoken"), 401)
+        clear_key_cache(self.app)
+        for _ in range(100):
+            if self.app["key_filter"].count == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(await self.models("newtoken"), 200)
+
+    async def test_new_key_looked_up_at_bounded_rate(self):
+        self.app["key_filter"].miss_lookups = 1
+        self.app["key_filter"]._allowance = 1
+        db = await get_db(self.app["config"]["db"]["uri"])
+        await db.user_create(hashlib.sha256(b"newtoken").hexdigest())
+        await db.close()
+
+        with mock.patch.object(SqliteDatabase, "user_list", autospec=True,
+                side_effect=SqliteDatabase.user_list) as user_list:
+            self.assertEqual(await self.models("newtoken"), 200)
+            self.assertIn(hashlib.sha256(b"newtoken").hexdigest(),
+                self.app["key_filter"])
+            # The allowance is spent: unknown keys are rejected unseen.
+            for i in range(5):
+                self.assertEqual(await self.models("bad%d" % i), 401)
+            user_list.assert_called_once()
+
+
+class TestCachedAuth(LLMProxyAppTestCase):
+    async def models(self, token="mytoken"):
+        async with self.client.request("GET", "/v1/models",
+                headers={"Authorization": "Bearer %s" % token}) as res:
+            return res.status
+
+    async def test_lookup_cached(self):
+        with mock.patch.object(SqliteDatabase, "user_list", autospec=True,
+                side_effect=SqliteDatabase.user_list) as user_list:
+            for token in ("mytoken", "mytoken", "badtoken", "badtoken"):
+                await self.models(token)
+        self.assertEqual(user_list.call_count, 2)
+
+    async def test_revocation_applies_after_clear(self):
+        self.assertEqual(await self.models(), 200)
+
+        db = await get_db(self.app["config"]["db"]["uri"])
+        await db.db.execute("UPDATE api_key SET expires = '2000-01-01'")
+        await db.db.commit()
+        await db.close()
+
+        self.assertEqual(await self.models(), 200)  # still cached
+        clear_key_cache(self.app)
+        self.assertEqual(await self.models(), 401)
+
+
+SIGNING_KEY = "k" * 32
+
+
+class TestSignedKeys(unittest.TestCase):
+    def test_round_trip(self):
+        claims = {"id": "u", "exp": 1700000000, "tier": "pro"}
+        token = sign_key(SIGNING_KEY, claims)
+        self.assertTrue(token.startswith("llmp1."))
+        self.assertEqual(verify_key(SIGNING_KEY, token), claims)
+
+    def test_rejected(self):
+        token = sign_key(SIGNING_KEY, {"id": "u"})
+        payload, sig = token.removeprefix("llmp1.").split(".")
+        forged = sign_key(SIGNING_KEY, {"id": "admin"}).split(".")[1]
+        for bad in (token[:-2], "llmp1." + forged + "." + sig,
+                "llmp1.%s" % payload, "llmp1.!!.!!", "llmp1."):
+            with self.subTest(token=bad):
+                self.assertIsNone(verify_key(SIGNING_KEY, bad))
+        self.assertIsNone(verify_key("x" * 32, token))
+
+    def test_billed_on_mongo(self):
+        req = types.SimpleNamespace(app={
+            "config": {"auth": {"signing_key": SIGNING_KEY}},
+            "revoked_keys": RevokedKeys()})
+        now = datetime.datetime.now(datetime.UTC)
+
+        token = sign_key(SIGNING_KEY, {"id": "k", "uid": "u", "org": "7",
+            "ns": "ns", "tier": "pro"})
+        doc = _billing_document(_signed_user(req, token), now,
+            {"m/none/prompt": 1}, "r")
+        self.assertEqual((doc["api_key_id"], doc["user_id"], doc["org_id"],
+            doc["namespace"], doc["tier"]), ("k", "u", "7", "ns", "pro"))
+
+        # Without the identity claims it is still billed, to the key.
+        token = sign_key(SIGNING_KEY, {"id": "k"})
+        doc = _billing_document(_signed_user(req, token), now, {}, "r")
+        self.assertEqual((doc["api_key_id"], doc["user_id"], doc["tier"]),
+            ("k", None, ""))
+
+
+class TestSignedAuth(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        app["config"]["auth"] = {"signing_key": SIGNING_KEY,
+            "revocation_interval": 3600}
+        await open_revoked_keys(app)
+        return app
+
+    async def create(self, **claims):
+        claims.setdefault("id", "signeduser")
+        token = sign_key(SIGNING_KEY, claims)
+        db = await get_db(self.app["config"]["db"]["uri"])
+        await db.user_create(hashlib.sha256(token.encode()).hexdigest(),
+            id_=claims["id"])
+        await db.close()
+        return token
+
+    async def chat(self, token):
+        body = {"model": "mymodel",
+            "messages": [{"role": "user", "content": "hi"}]}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer %s" % token},
+                json=body) as res:
+            return res.status
+
+    async def test_verified_without_lookup_and_billed(self):
+        token = await self.create(tier="pro")
+        with mock.patch.object(SqliteDatabase, "user_list",
+                autospec=True) as user_list:
+            self.assertEqual(await self.chat(token), 200)
+        user_list.assert_not_called()
+
+        db = await get_db(self.app["config"]["db"]["uri"])
+        cur = await db.db.execute("SELECT DISTINCT api_key FROM event_oneoff")
+        rows = await cur.fetchall()
+        await db.close()
+        self.assertEqual(rows, [{"api_key": "signeduser"}])
+
+    async def test_expired_and_forged_rejected(self):
+        token = await self.create(exp=1)
+        self.assertEqual(await self.chat(token), 401)
+        self.assertEqual(await self.chat(token[:-2] + "AA"), 401)
+        self.assertEqual(await self.chat("mytoken"), 200)  # plain keys work
+
+    async def test_revoked_after_refresh(self):
+        token = await self.create()
+        self.assertEqual(await self.chat(token), 200)
+
+        db = await get_db(self.app["config"]["db"]["uri"])
+        await db.db.execute("UPDATE api_key SET expires = '2000-01-01' "
+            "WHERE id = 'signeduser'")
+        await db.db.commit()
+        await db.close()
+
+        clear_key_cache(self.app)
+        for _ in range(100):
+            if "signeduser" in self.app["revoked_keys"]:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(await self.chat(token), 401)
@@ -0,0 +1,557 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import aiohttp.web
+
+from llmproxy.app import reload_config
+from llmproxy import metrics
+from llmproxy.balancer import (CLOSED, HALF_OPEN, OPEN, Balancer, Limiter,
+    Overloaded, RetryBudget)
+
+from tests import mockbackend
+from tests.test_proxy import LLMProxyAppTestCase
+
+DEAD_URL = "http://127.0.0.1:1"
+
+
+def _config(**backend):
+    return {"backends": {"m": {"token": "t", "health_interval": 0,
+        **backend}}}
+
+
+class TestBalancer(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("llmproxy.balancer.time.monotonic",
+            lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_least_outstanding(self):
+        balancer = Balancer()
+        balancer.update(_config(replicas=[{"url": "http://a"},
+            {"url": "http://b", "weight": 2}]))
+        a, b = balancer.backends["m"]
+
+        picked = []
+        for _ in range(3):
+            replica = balancer.pick("m")
+            replica.in_flight += 1
+            picked.append(replica)
+        # b takes two for each of a's.
+        self.assertEqual(picked.count(a), 1)
+        self.assertEqual(picked.count(b), 2)
+
+    def test_power_of_two_prefers_less_loaded(self):
+        balancer = Balancer()
+        balancer.update(_config(balance="power_of_two", replicas=[
+            {"url": "http://%d" % i} for i in range(4)]))
+        busy = balancer.backends["m"][0]
+        busy.in_flight = 10
+        for _ in range(50):
+            self.assertIsNot(balancer.pick("m"), busy)
+
+    def test_use_counts_in_flight(self):
+        balancer = Balancer()
+        balancer.update(_config(url="http://a"))
+        replica = balancer.pick("m")
+        with replica.use():
+            self.assertEqual(replica.in_flight, 1)
+        self.assertEqual(replica.in_flight, 0)
+
+    def test_circuit_breaker(self):
+        balancer = Balancer()
+        balancer.update(_config(url="http://a", circuit_failures=2,
+            circuit_open_seconds=30))
+        replica = balancer.backends["m"][0]
+
+        replica.failure()
+        self.assertIs(balancer.pick("m"), replica)
+        replica.failure()
+        self.assertEqual(replica.state, OPEN)
+        self.assertIsNone(balancer.pick("m"))
+
+        # Half-open: one trial request at a time.
+        self.now += 30
+        self.assertIs(balancer.pick("m"), replica)
+        self.assertEqual(replica.state, HALF_OPEN)
+        with replica.use():
+            self.assertIsNone(balancer.pick("m"))
+            replica.failure()
+        self.assertEqual(replica.state, OPEN)
+
+        self.now += 30
+        self.assertIs(balancer.pick("m"), replica)
+        replica.success()
+        self.assertEqual(replica.state, CLOSED)
+
+    def test_open_replica_skipped(self):
+        balancer = Balancer()
+        balancer.update(_config(circuit_failures=1, replicas=[
+            {"url": "http://a"}, {"url": "http://b"}]))
+        a, b = balancer.backends["m"]
+        a.failure()
+        for _ in range(10):
+            self.assertIs(balancer.pick("m"), b)
+
+    def test_update_keeps_replica_state(self):
+        balancer = Balancer()
+        balancer.update(_config(circuit_failures=1, replicas=[
+            {"url": "http://a"}, {"url": "http://b"}]))
+        a, b = balancer.backends["m"]
+        a.failure()
+        b.in_flight = 1
+
+        balancer.update(_config(circuit_failures=1, replicas=[
+            {"url": "http://a"}, {"url": "http://c"}]))
+        self.assertIs(balancer.backends["m"][0], a)
+        self.assertEqual(a.state, OPEN)
+        self.assertEqual(balancer.backends["m"][1].url, "http://c")
+        self.assertTrue(b.retired)
+
+        # A request to the removed replica still finishes.
+        b.in_flight -= 1
+        b._publish()
+
+    def test_replica_max_concurrency(self):
+        balancer = Balancer()
+        balancer.update(_config(replicas=[
+            {"url": "http://a", "max_concurrency": 1},
+            {"url": "http://b", "max_concurrency": 2}]))
+        self.assertEqual(balancer.limiters["m"].limit, 3)
+        for _ in range(3):
+            balancer.pick("m").in_flight += 1
+        self.assertIsNone(balancer.pick("m"))
+
+
+class TestRetryBudget(unittest.TestCase):
+    def test_reserve_then_ratio(self):
+        budget = RetryBudget(ratio=0.5, reserve=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_reserve_caps_savings(self):
+        budget = RetryBudget(ratio=1, reserve=2)
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 2)
+
+
+class TestLimiter(unittest.IsolatedAsyncioTestCase):
+    def limiter(self, limit, max_queue=100, max_wait=30):
+        limiter = Limiter("m")
+        limiter.configure(limit, max_queue, max_wait)
+        return limiter
+
+    async def test_fifo(self):
+        limiter = self.limiter(1)
+        first = await limiter.acquire()
+        order = []
+
+        async def wait(i):
+            acquired = await limiter.acquire()
+            order.append(i)
+            limiter.release(acquired)
+        tasks = [asyncio.create_task(wait(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        limiter.release(first)
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, [0, 1, 2])
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_queue_full(self):
+        limiter = self.limiter(1, max_queue=0)
+        acquired = await limiter.acquire()
+        with self.assertRaises(Overloaded) as cm:
+            await limiter.acquire()
+        self.assertEqual(cm.exception.reason, "queue_full")
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+        limiter.release(acquired)
+        limiter.release(await limiter.acquire())
+
+    async def test_queue_timeout(self):
+        limiter = self.limiter(1, max_wait=0.01)
+        await limiter.acquire()
+        with self.assertRaises(Overloaded) as cm:
+            await limiter.acquire()
+        self.assertEqual(cm.exception.reason, "queue_timeout")
+        self.assertFalse(limiter._waiters)
+
+    async def test_cancelled_waiter_gives_up_place(self):
+        limiter = self.limiter(1)
+        acquired = await limiter.acquire()
+        task = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        limiter.release(acquired)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_unlimited(self):
+        limiter = self.limiter(0, max_queue=0)
+        for _ in range(10):
+            await limiter.acquire()
+        self.assertEqual(limiter.in_flight, 10)
+
+
+class TestAdaptiveLimiter(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.limiter = Limiter("m")
+        self.limiter.configure(20, 100, 30, adaptive=True, min_limit=2)
+
+    async def fill(self):
+        return [await self.limiter.acquire()
+            for _ in range(self.limiter.limit)]
+
+    async def test_starts_at_max(self):
+        self.assertEqual(self.limiter.limit, 20)
+        self.assertEqual(metrics.BACKEND_CONCURRENCY_LIMIT.labels(
+            "m")._value.get(), 20)
+
+    async def test_overload_cuts_once_per_round_trip(self):
+        slots = await self.fill()
+        for acquired in slots:
+            self.limiter.release(acquired, overloaded=True)
+        self.assertEqual(self.limiter.limit, 18)
+
+        acquired = await self.limiter.acquire()
+        self.limiter.release(acquired, overloaded=True)
+        self.assertEqual(self.limiter.limit, 16)
+
+    async def test_rising_latency_shrinks_limit(self):
+        for _ in range(50):
+            slots = await self.fill()
+            for acquired in slots:
+                self.limiter.release(acquired, 1.0)
+        self.assertEqual(self.limiter.limit, 20)
+
+        for _ in range(50):
+            slots = await self.fill()
+            for acquired in slots:
+                self.limiter.release(acquired, 10.0)
+        self.assertLess(self.limiter.limit, 10)
+
+    async def test_steady_latency_grows_limit(self):
+        self.limiter._estimate = self.limiter.limit = 5
+        for _ in range(50):
+            slots = await self.fill()
+            for acquired in slots:
+                self.limiter.release(acquired, 1.0)
+        self.assertEqual(self.limiter.limit, 20)
+
+    async def test_idle_limit_not_grown(self):
+        self.limiter._estimate = self.limiter.limit = 5
+        for _ in range(50):
+            self.limiter.release(await self.limiter.acquire(), 1.0)
+        self.assertEqual(self.limiter.limit, 5)
+
+    async def test_reload_keeps_limit_within_bounds(self):
+        self.limiter._estimate = 15
+        self.limiter.configure(20, 100, 30, adaptive=True)
+        self.assertEqual(self.limiter.limit, 15)
+        self.limiter.configure(10, 100, 30, adaptive=True)
+        self.assertEqual(self.limiter.limit, 10)
+        self.limiter.configure(10, 100, 30)
+        self.assertFalse(self.limiter.adaptive)
+
+
+class TestHealthCheck(LLMProxyAppTestCase):
+    async def test_check_records_result(self):
+        balancer = Balancer()
+        balancer.update({"backends": {
+            "up": {"url": "http://%s:%d" % (self.backend.host,
+                self.backend.port)},
+            "down": {"url": DEAD_URL},
+        }, "health_interval": 0, "circuit_failures": 1})
+
+        up, = balancer.backends["up"]
+        down, = balancer.backends["down"]
+        self.assertTrue(await up.check())
+        self.assertFalse(await down.check())
+        self.assertEqual(up.state, CLOSED)
+        self.assertEqual(down.state, OPEN)
+        await balancer.close()
+
+
+class TestReplicas(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        backends = app["config"]["backends"]
+        backends["replicated"] = {
+            "replicas": [
+                {"url": "http://%s:%d" % (self.backend.host,
+                    self.backend.port)},
+                {"url": DEAD_URL},
+            ],
+            "token": "mybackendtoken", "device": "none", "model": "mymodel",
+            "circuit_failures": 1, "health_interval": 0, "retries": 0,
+        }
+        backends["dead"] = {"url": DEAD_URL, "token": "mybackendtoken",
+            "device": "none", "circuit_failures": 1, "health_interval": 0,
+            "retries": 0}
+        app["balancer"].update(app["config"])
+        return app
+
+    async def chat(self, model):
+        body = {"model": model,
+            "messages": [{"role": "user", "content": "hi"}]}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer mytoken"},
+                json=body) as res:
+            return res.status
+
+    async def test_dead_replica_taken_out_of_rotation(self):
+        # Ties are broken at random; the dead replica fails once.
+        for _ in range(50):
+            if await self.chat("replicated") == 502:
+                break
+        self.assertEqual([await self.chat("replicated") for _ in range(4)],
+            [200] * 4)
+
+    async def test_all_replicas_down_fails_fast(self):
+        self.assertEqual(await self.chat("dead"), 502)
+        self.assertEqual(await self.chat("dead"), 503)
+
+    async def test_reload_adds_replica(self):
+        fd, path = tempfile.mkstemp(suffix=".toml")
+        with os.fdopen(fd, "w") as f:
+            f.write('[backends.dead]\nreplicas = [{url = "%s"}, '
+                '{url = "http://%s:%d"}]\ntoken = "mybackendtoken"\n'
+                'device = "none"\nmodel = "mymodel"\n' % (DEAD_URL,
+                self.backend.host, self.backend.port))
+        self.addCleanup(os.unlink, path)
+        self.app["config"]["_path"] = path
+
+        dead = self.app["balancer"].backends["dead"][0]
+        self.assertEqual(await self.chat("dead"), 502)
+        reload_config(self.app)
+
+        self.assertIs(self.app["balancer"].backends["dead"][0], dead)
+        self.assertEqual(dead.state, OPEN)
+        self.assertEqual(await self.chat("dead"), 200)
+        self.assertNotIn("replicated", self.app["balancer"].backends)
+
+
+class TestRetries(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        good = "http://%s:%d" % (self.backend.host, self.backend.port)
+        backends = app["config"]["backends"]
+        backends["flaky"] = {
+            "replicas": [{"url": good}, {"url": DEAD_URL}],
+            "token": "mybackendtoken", "device": "none", "model": "mymodel",
+            "circuit_failures": 0, "health_interval": 0, "retries": 1,
+            "retry_backoff": 0,
+        }
+        backends["down"] = {"url": DEAD_URL, "token": "mybackendtoken",
+            "device": "none", "health_interval": 0, "retry_backoff": 0,
+            "fallback": "mymodel"}
+        app["balancer"].update(app["config"])
+        return app
+
+    async def chat(self, model, **extra):
+        body = {"model": model,
+            "messages": [{"role": "user", "content": "hi"}], **extra}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer mytoken"},
+                json=body) as res:
+            return res.status
+
+    async def test_failed_connection_retried_on_other_replica(self):
+        statuses = [await self.chat("flaky") for _ in range(8)]
+        self.assertEqual(statuses, [200] * 8)
+        # Billed once per request.
+        self.assertEqual(len(await self.get_events()), 16)
+
+    async def test_fallback_backend(self):
+        self.assertEqual(await self.chat("down"), 200)
+        self.assertListEqual(await self.get_events(), [
+            {"product": "mymodel/none/prompt", "quantity": 1},
+            {"product": "mymodel/none/completion", "quantity": 2},
+        ])
+
+    async def test_queue_full_retried(self):
+        retries = metrics.BACKEND_RETRIES_TOTAL.labels("mymodel", "status")
+        before = retries._value.get()
+        self.assertEqual(await self.chat("mymodel", _trigger_error=503), 502)
+        self.assertEqual(retries._value.get() - before, 1)
+
+    async def test_retry_budget(self):
+        budget = self.app["balancer"].budgets["flaky"]
+        budget.ratio = 0
+        budget.tokens = 0
+        denied = metrics.BACKEND_RETRIES_DENIED_TOTAL.labels("flaky")
+        before = denied._value.get()
+        statuses = [await self.chat("flaky") for _ in range(30)]
+        self.assertIn(502, statuses)
+        self.assertEqual(denied._value.get() - before, statuses.count(502))
+
+
+class TestConnections(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        app["config"]["backends"]["mymodel"]["connection_limit"] = 7
+
+        self.socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.socket_dir.cleanup)
+        path = os.path.join(self.socket_dir.name, "vllm.sock")
+        self.sidecar = aiohttp.web.AppRunner(mockbackend.create_app())
+        await self.sidecar.setup()
+        await aiohttp.web.UnixSite(self.sidecar, path).start()
+        app["config"]["backends"]["sidecar"] = {"url": "http://localhost",
+            "unix_socket": path, "token": "mybackendtoken", "device": "none",
+            "model": "mymodel", "health_interval": 0}
+
+        app["balancer"].update(app["config"])
+        return app
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        await self.sidecar.cleanup()
+
+    async def chat(self, model):
+        body = {"model": model,
+            "messages": [{"role": "user", "content": "hi"}]}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer mytoken"},
+                json=body) as res:
+            return res.status
+
+    async def test_connection_pool_per_backend(self):
+        self.assertEqual(await self.chat("mymodel"), 200)
+        self.assertEqual(await self.chat("nolimit"), 200)
+        clients = self.app["balancer"].clients
+        self.assertIsNot(clients["mymodel"].session,
+            clients["nolimit"].session)
+        self.assertEqual(clients["mymodel"].session.connector.limit, 7)
+        self.assertEqual(clients["nolimit"].session.connector.limit, 100)
+
+    async def test_keepalive(self):
+        reused = metrics.BACKEND_CONNECTIONS_TOTAL.labels("mymodel", "reused")
+        before = reused._value.get()
+        self.assertEqual(await self.chat("mymodel"), 200)
+        self.assertEqual(await self.chat("mymodel"), 200)
+        self.assertGreater(reused._value.get(), before)
+
+    async def test_unix_socket(self):
+        self.assertEqual(await self.chat("sidecar"), 200)
+
+    async def test_changed_pool_closed_when_idle(self):
+        balancer = self.app["balancer"]
+        replica, = balancer.backends["mymodel"]
+        old = balancer.clients["mymodel"]
+        client = replica.acquire()
+        session = client.session
+
+        self.app["config"]["backends"]["mymodel"]["connection_limit"] = 8
+        balancer.update(self.app["config"])
+        self.assertIsNot(balancer.clients["mymodel"], old)
+        self.assertFalse(session.closed)
+
+        replica.release(client)
+        await old._closing
+        self.assertTrue(session.closed)
+
+
+class TestAdmission(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        app["config"]["backends"]["slowok"].update(max_concurrency=1,
+            max_queue=0)
+        app["balancer"].update(app["config"])
+        return app
+
+    async def chat(self, **extra):
+        body = {"model": "slowok",
+            "messages": [{"role": "user", "content": "hi"}], **extra}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer mytoken"},
+                json=body) as res:
+            return res.status, res.headers, await res.read()
+
+    async def test_overload_shed_with_429(self):
+        slow = asyncio.create_task(self.chat(_trigger_error="slow"))
+        limiter = self.app["balancer"].limiters["slowok"]
+        while not limiter.in_flight:
+            await asyncio.sleep(0.01)
+
+        status, headers, body = await self.chat()
+        self.assertEqual(status, 429)
+        self.assertGreaterEqual(int(headers["Retry-After"]), 1)
+        self.assertEqual(json.loads(body)["error"]["code"],
+            "rate_limit_exceeded")
+
+        self.assertEqual((await slow)[0], 200)
+        self.assertEqual((await self.chat())[0], 200)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_invalid_request_not_queued(self):
+        slow = asyncio.create_task(self.chat(_trigger_error="slow"))
+        limiter = self.app["balancer"].limiters["slowok"]
+        while not limiter.in_flight:
+            await asyncio.sleep(0.01)
+
+        # Rejected by the body transform, not shed by the full limiter.
+        body = {"model": "slowok", "previous_response_id": "resp_x",
+            "input": [{"role": "user", "content": "hi"}]}
+        async with self.client.request("POST", "/v1/responses",
+                headers={"Authorization": "Bearer mytoken"},
+                json=body) as res:
+            self.assertEqual(res.status, 400)
+        self.assertEqual((await slow)[0], 200)
+
+
+class TestAdaptiveAdmission(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        app["config"]["backends"]["mymodel"].update(
+            adaptive_concurrency=True, max_concurrency=8)
+        app["balancer"].update(app["config"])
+        return app
+
+    async def test_stream_time_to_first_token_sampled(self):
+        limiter = self.app["balancer"].limiters["mymodel"]
+        self.assertEqual(limiter.limit, 8)
+        body = {"model": "mymodel", "stream": True,
+            "messages": [{"role": "user", "content": "hi"}]}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer mytoken"},
+                json=body) as res:
+            self.assertEqual(res.status, 200)
+            await res.read()
+        # The handler bills after the client has the whole stream.
+        while limiter.in_flight:
+            await asyncio.sleep(0.01)
+        self.assertIsNotNone(limiter._baseline)
+
+    async def test_success_after_503_retry_not_overload(self):
+        limiter = self.app["balancer"].limiters["mymodel"]
+        body = {"model": "mymodel", "_trigger_error": "503once",
+            "_id": self.id(), "messages": [{"role": "user", "content": "hi"}]}
+        with mock.patch.object(limiter, "release",
+                wraps=limiter.release) as release:
+            async with self.client.request("POST", "/v1/chat/completions",
+                    headers={"Authorization": "Bearer mytoken"},
+                    json=body) as res:
+                self.assertEqual(res.status, 200)
+            while limiter.in_flight:
+                await asyncio.sleep(0.01)
+        release.assert_called_once()
+        self.assertFalse(release.call_args.args[2])
+        self.assertEqual(limiter.limit, 8)
+
+    async def test_default_max_is_connection_limit(self):
+        self.app["config"]["backends"]["mymodel"].update(
+            max_concurrency=0, connection_limit=7)
+        self.app["balancer"].update(self.app["config"])
+        self.assertEqual(self.app["balancer"].limiters["mymodel"].limit, 7)
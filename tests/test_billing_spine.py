@@ -1,6 +1,13 @@
+import asyncio
 import datetime
 import decimal
+import logging
 import unittest
+from unittest import mock
+
+import aiohttp
+import aiohttp.web
+import prometheus_client
 
 from llmproxy import streaming
 from llmproxy.chat import _ChatStreamUsage
@@ -79,6 +86,171 @@ class TestDrain(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(written, [])
 
 
+class _PieceContent:
+    """StreamReader stand-in returning the body in fixed-size pieces, so
+    blocks straddle read boundaries."""
+
+    def __init__(self, data, piece):
+        self._d = data
+        self._piece = piece
+
+    async def read(self, n):
+        chunk, self._d = self._d[:self._piece], self._d[self._piece:]
+        return chunk
+
+
+class TestSkim(unittest.IsolatedAsyncioTestCase):
+    CHAT = (b'data: {"choices":[{"delta":{"content":"hi"}}]}\n\n' * 50
+        + b'data: {"choices":[],"usage":'
+        b'{"prompt_tokens":1,"completion_tokens":2}}\n\n'
+        b"data: [DONE]\n\n")
+
+    MESSAGES = (b'event: message_start\ndata: {"type":"message_start",'
+        b'"message":{"usage":{"input_tokens":3,"output_tokens":1}}}\n\n'
+        + b'event: content_block_delta\ndata: {"type":"content_block_delta",'
+        b'"delta":{"text":"message_delta"}}\n\n' * 50
+        + b'event: message_delta\ndata: {"type":"message_delta",'
+        b'"usage":{"output_tokens":4}}\n\n'
+        b'event: message_delta\ndata: {"type":"message_delta",'
+        b'"usage":{"output_tokens":5}}\n\n'
+        b'event: message_stop\ndata: {"type":"message_stop"}\n\n')
+
+    async def _skim(self, data, acc, piece):
+        reader = streaming.SSEReader(_PieceContent(data, piece))
+        seen = []
+
+        def on_chunk(chunk):
+            seen.append(chunk)
+            acc(chunk)
+
+        await reader.skim(on_chunk, acc.skim)
+        return seen
+
+    async def test_chat_last_block(self):
+        for piece in (7, 100, 1 << 20):
+            with self.subTest(piece=piece):
+                acc = _ChatStreamUsage()
+                seen = await self._skim(self.CHAT, acc, piece)
+                self.assertEqual(acc.usage(),
+                    {"prompt_tokens": 1, "completion_tokens": 2})
+                self.assertLess(len(seen), 60)
+
+    async def test_messages_usage_events_only(self):
+        from llmproxy.messages import _MessagesStreamUsage
+
+        for piece in (7, 100, 1 << 20):
+            with self.subTest(piece=piece):
+                acc = _MessagesStreamUsage()
+                seen = await self._skim(self.MESSAGES, acc, piece)
+                self.assertEqual(acc.usage(),
+                    {"prompt_tokens": 3, "completion_tokens": 5})
+                self.assertEqual(len(seen), 3)
+
+    async def test_skim_after_partial_read(self):
+        # Blocks already split off before the disconnect are not re-fed, and
+        # the buffered remainder is skimmed.
+        from llmproxy.messages import _MessagesStreamUsage
+
+        acc = _MessagesStreamUsage()
+        reader = streaming.SSEReader(_PieceContent(self.MESSAGES, 1000))
+        acc(await reader.read_block())  # message_start, written live
+        await reader.skim(acc, acc.skim)
+        self.assertEqual(acc.usage(),
+            {"prompt_tokens": 3, "completion_tokens": 5})
+
+    async def test_drain_switches_to_skim_on_disconnect(self):
+        chunks = [b"data: a\n\n", b"data: b\n\n", b""]
+        it = iter(chunks)
+        skimmed = []
+
+        async def read_block():
+            return next(it)
+
+        async def write_block(c):
+            raise ConnectionResetError("client gone")
+
+        async def skim():
+            skimmed.append(True)
+
+        seen = []
+        await streaming.drain(read_block, write_block, seen.append,
+            skim=skim)
+
+        self.assertEqual(seen, chunks[:1])
+        self.assertEqual(skimmed, [True])
+
+
+class TestCoalesce(unittest.IsolatedAsyncioTestCase):
+    @staticmethod
+    def _reader(chunks, delay=None):
+        # Like SSEReader, only consumes a block once the read completes, so a
+        # read abandoned at the coalescing deadline loses nothing.
+        pending = list(chunks)
+
+        async def read_block():
+            if delay is not None and pending[0] == delay[0]:
+                await asyncio.sleep(delay[1])
+            return pending.pop(0)
+
+        return read_block
+
+    async def test_available_blocks_written_once(self):
+        chunks = [b"data: a\n\n", b"data: b\n\n", b"data: c\n\n", b""]
+        written = []
+        seen = []
+
+        async def write_block(c):
+            written.append(c)
+
+        read = streaming.coalesce(self._reader(chunks), seen.append, 1024)
+        await streaming.drain(read, write_block, lambda chunk: None)
+
+        self.assertEqual(seen, chunks[:3])            # each block fed
+        self.assertEqual(written, [b"".join(chunks)])  # one write
+
+    async def test_byte_limit_splits_batches(self):
+        chunks = [b"a" * 10, b"b" * 10, b"c" * 10, b""]
+        written = []
+
+        async def write_block(c):
+            written.append(c)
+
+        read = streaming.coalesce(self._reader(chunks), lambda c: None, 15)
+        await streaming.drain(read, write_block, lambda chunk: None)
+
+        self.assertEqual(written, [b"a" * 10 + b"b" * 10, b"c" * 10])
+
+    async def test_late_block_not_held_back(self):
+        # A block that is not yet available starts a new write instead of
+        # delaying the ones already read.
+        chunks = [b"data: a\n\n", b"data: b\n\n", b""]
+        written = []
+
+        async def write_block(c):
+            written.append(c)
+
+        read = streaming.coalesce(
+            self._reader(chunks, delay=(b"data: b\n\n", 0.05)),
+            lambda c: None, 1024, max_delay=0.01)
+        await streaming.drain(read, write_block, lambda chunk: None)
+
+        self.assertEqual(written, chunks[:2])
+
+    async def test_blocks_within_delay_are_batched(self):
+        chunks = [b"data: a\n\n", b"data: b\n\n", b""]
+        written = []
+
+        async def write_block(c):
+            written.append(c)
+
+        read = streaming.coalesce(
+            self._reader(chunks, delay=(b"data: b\n\n", 0.01)),
+            lambda c: None, 1024, max_delay=1)
+        await streaming.drain(read, write_block, lambda chunk: None)
+
+        self.assertEqual(written, [chunks[0] + chunks[1]])
+
+
 class TestStreamThroughPrepareDisconnect(unittest.IsolatedAsyncioTestCase):
     async def test_prepare_time_disconnect_still_captures_usage(self):
         # Regression guard: if the client vanishes as headers are flushed,
@@ -138,6 +310,79 @@ class TestStreamThroughPrepareDisconnect(unittest.IsolatedAsyncioTestCase):
             {"prompt_tokens": 1, "completion_tokens": 2})
 
 
+class TestStreamThroughClock(unittest.IsolatedAsyncioTestCase):
+    class FakeApp(dict):
+        logger = logging.getLogger("test")
+
+    class FakeReq(dict):
+        def __init__(self):
+            super().__init__(request_id="rid")
+            self.app = TestStreamThroughClock.FakeApp(config={})
+
+    class FakeBackendResp:
+        headers = {}
+
+        def __init__(self, content):
+            self.content = content
+
+    class FailingContent:
+        async def read(self, n):
+            raise aiohttp.ClientPayloadError("backend went away")
+
+    @staticmethod
+    def count(name):
+        return prometheus_client.REGISTRY.get_sample_value(name,
+            {"model": "clockmodel"}) or 0
+
+    def patch_response(self, prepare_error=None):
+        patchers = (
+            mock.patch.object(aiohttp.web.StreamResponse, "prepare",
+                side_effect=prepare_error),
+            mock.patch.object(aiohttp.web.StreamResponse, "write",
+                new=mock.AsyncMock()),
+            mock.patch.object(aiohttp.web.StreamResponse, "write_eof",
+                new=mock.AsyncMock()),
+        )
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    async def test_skimmed_stream_timed_without_gaps(self):
+        from llmproxy.messages import _MessagesStreamUsage
+
+        self.patch_response(ConnectionResetError("client gone"))
+        first = self.count("llmproxy_stream_first_event_seconds_count")
+        gaps = self.count("llmproxy_stream_event_gap_seconds_count")
+
+        f_req = self.FakeReq()
+        acc = _MessagesStreamUsage()
+        await streaming.stream_through(f_req,
+            self.FakeBackendResp(_PieceContent(TestSkim.MESSAGES, 100)), acc,
+            "clockmodel")
+
+        self.assertEqual(acc.usage(),
+            {"prompt_tokens": 3, "completion_tokens": 5})
+        self.assertIsNotNone(f_req["generation_seconds"])
+        self.assertEqual(
+            self.count("llmproxy_stream_first_event_seconds_count"), first + 1)
+        self.assertEqual(
+            self.count("llmproxy_stream_event_gap_seconds_count"), gaps)
+
+    async def test_failed_stream_duration_observed(self):
+        self.patch_response()
+        duration = self.count("llmproxy_stream_duration_seconds_count")
+
+        f_req = self.FakeReq()
+        with self.assertRaises(aiohttp.ClientPayloadError):
+            await streaming.stream_through(f_req,
+                self.FakeBackendResp(self.FailingContent()),
+                _ChatStreamUsage(), "clockmodel")
+
+        self.assertEqual(self.count("llmproxy_stream_duration_seconds_count"),
+            duration + 1)
+        self.assertIsNone(f_req["generation_seconds"])
+
+
 class TestChatStreamUsage(unittest.TestCase):
     def test_usage_read_from_trailing_chunk(self):
         acc = _ChatStreamUsage()
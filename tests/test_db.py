@@ -1,10 +1,23 @@
+import asyncio
+import datetime
 import importlib.resources
 import os
+import shutil
 import sqlite3
 import tempfile
 import unittest
+from unittest import mock
 
-from llmproxy.db import SqliteDatabase
+import prometheus_client
+
+from llmproxy.db import (SCHEMA_VERSION, DatabaseError, MongoDatabase, Pool,
+    SqliteDatabase, _billing_document, _user_from_document, _user_pipeline)
+
+try:
+    import pymongo  # noqa: F401
+    HAS_PYMONGO = True
+except ImportError:
+    HAS_PYMONGO = False
 
 
 def _user_version(path):
@@ -28,7 +41,7 @@ class TestSqliteInit(unittest.IsolatedAsyncioTestCase):
     documented `sqlite3 db.sqlite < schema.sql` setup produces (the sqlite CLI
     does not stamp user_version). Re-applying the schema must not crash, so the
     schema is idempotent (CREATE TABLE IF NOT EXISTS) and the initializer heals
-    the version marker to 1.
+    the version marker (and then migrates on to the latest version).
     """
 
     def setUp(self):
@@ -38,7 +51,7 @@ class TestSqliteInit(unittest.IsolatedAsyncioTestCase):
     def tearDown(self):
         os.unlink(self.path)
 
-    async def test_empty_db_is_initialized_to_version_1(self):
+    async def test_empty_db_is_initialized_to_latest_version(self):
         self.assertEqual(_user_version(self.path), 0)  # precondition
 
         db = await SqliteDatabase.create("sqlite://%s" % self.path)
@@ -48,7 +61,7 @@ class TestSqliteInit(unittest.IsolatedAsyncioTestCase):
         finally:
             await db.close()
 
-        self.assertEqual(_user_version(self.path), 1)
+        self.assertEqual(_user_version(self.path), SCHEMA_VERSION)
 
     async def test_preexisting_schema_does_not_crash(self):
         # Simulate `sqlite3 db.sqlite < schema.sql`: tables exist, version 0.
@@ -64,17 +77,17 @@ class TestSqliteInit(unittest.IsolatedAsyncioTestCase):
             await db.close()
 
         # Version healed so subsequent boots skip re-initialization.
-        self.assertEqual(_user_version(self.path), 1)
+        self.assertEqual(_user_version(self.path), SCHEMA_VERSION)
 
-    async def test_reopen_at_version_1_is_noop(self):
-        # First create() initializes to v1; a second create() must take the
-        # skip path (user_version already 1) without error and preserve data.
+    async def test_reopen_at_latest_version_is_noop(self):
+        # First create() migrates to the latest version; a second create()
+        # must take the skip path without error and preserve data.
         db = await SqliteDatabase.create("sqlite://%s" % self.path)
         await db.db.execute(
             "INSERT INTO api_key (id, secret, type) VALUES ('u', 'abc', 'LLM')")
         await db.db.commit()
         await db.close()
-        self.assertEqual(_user_version(self.path), 1)
+        self.assertEqual(_user_version(self.path), SCHEMA_VERSION)
 
         db = await SqliteDatabase.create("sqlite://%s" % self.path)
         try:
@@ -101,7 +114,7 @@ class TestSqliteInit(unittest.IsolatedAsyncioTestCase):
         finally:
             await db.close()
 
-        self.assertEqual(_user_version(self.path), 1)
+        self.assertEqual(_user_version(self.path), SCHEMA_VERSION)
 
     async def test_preexisting_data_is_preserved(self):
         # Healing an un-versioned database must never drop existing rows.
@@ -119,8 +132,527 @@ class TestSqliteInit(unittest.IsolatedAsyncioTestCase):
             await db.close()
 
         self.assertEqual(len(rows), 1)
+        self.assertEqual(_user_version(self.path), SCHEMA_VERSION)
+
+
+class TestSqliteMigrations(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def _make_v1(self, *events):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(_schema_sql())
+        conn.execute(
+            "INSERT INTO api_key (id, secret, type) VALUES ('u', 'abc', 'LLM')")
+        conn.executemany("INSERT INTO event_oneoff (rid, product, quantity) "
+            "VALUES (?, ?, 1)", events)
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+        conn.close()
+
+    async def test_v1_migrated(self):
+        self._make_v1(("r1", "p"), ("r1", "c"))
+
+        db = await SqliteDatabase.create("sqlite://%s" % self.path)
+        await db.close()
+
+        conn = sqlite3.connect(self.path)
+        try:
+            indexes = {name for name, in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+            mode, = conn.execute("PRAGMA journal_mode").fetchone()
+            events, = conn.execute(
+                "SELECT COUNT(*) FROM event_oneoff").fetchone()
+        finally:
+            conn.close()
+        self.assertLessEqual({"api_key_secret", "event_oneoff_api_key_created",
+            "event_oneoff_created", "event_oneoff_rid_product"}, indexes)
+        self.assertEqual(mode, "wal")
+        self.assertEqual(events, 2)
+        self.assertEqual(_user_version(self.path), SCHEMA_VERSION)
+
+    async def test_duplicate_billing_rows_block_migration(self):
+        self._make_v1(("r1", "p"), ("r1", "p"))
+
+        with self.assertRaises(DatabaseError):
+            await SqliteDatabase.create("sqlite://%s" % self.path)
         self.assertEqual(_user_version(self.path), 1)
 
+    async def test_existing_events_backfilled(self):
+        self._make_v1(*(("r%d" % i, "p") for i in range(5)))
+        conn = sqlite3.connect(self.path)
+        conn.execute("UPDATE event_oneoff SET api_key = 'u', "
+            "created = '2026-01-01T10:30:00+00:00'")
+        conn.commit()
+        conn.close()
+
+        db = await SqliteDatabase.create("sqlite://%s" % self.path)
+        try:
+            await db.billing_records_add([{"rid": "new", "user": {"id": "u"},
+                "time": datetime.datetime(2026, 1, 1, 10, 45,
+                    tzinfo=datetime.UTC), "resources": {"p": 1}}])
+            self.assertEqual(await db.usage_backfill_remaining(), 5)
+            # The new event is rolled up by the trigger, the old ones not yet.
+            self.assertEqual(await db.usage_report(period="total"), [
+                {"period": "", "api_key": "u", "product": "p", "requests": 1,
+                    "quantity": 1, "secret": "abc"}])
+
+            self.assertEqual(await db.usage_backfill(chunk=2), 3)
+            self.assertEqual(await db.usage_backfill(chunk=2), 1)
+            self.assertEqual(await db.usage_backfill(chunk=2), 0)
+            self.assertEqual(await db.usage_backfill(chunk=2), 0)
+            rows = await db.usage_report(period="hour")
+        finally:
+            await db.close()
+        self.assertEqual([(r["period"], r["requests"], r["quantity"])
+            for r in rows], [("2026-01-01 10:00:00", 6, 6)])
+
+    async def test_newer_version_refused(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA user_version = %d" % (SCHEMA_VERSION + 1))
+        conn.close()
+
+        with self.assertRaises(DatabaseError):
+            await SqliteDatabase.create("sqlite://%s" % self.path)
+
+
+class TestSqliteQueries(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.db = await SqliteDatabase.create("sqlite://%s" % self.path)
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        os.unlink(self.path)
+
+    async def test_exact_and_prefix_lookup(self):
+        await self.db.user_create("abcdef")
+        self.assertEqual(len(await self.db.user_list("abc")), 1)
+        self.assertEqual(await self.db.user_list("abc", exact=True), [])
+        self.assertEqual(len(await self.db.user_list("abcdef", exact=True)),
+            1)
+
+    async def test_exact_lookup_uses_index(self):
+        statements = []
+        await self.db.db.set_trace_callback(statements.append)
+        await self.db.user_list("abcdef", exact=True)
+        await self.db.db.set_trace_callback(None)
+
+        sql, = (s for s in statements if "FROM api_key" in s)
+        conn = sqlite3.connect(self.path)
+        try:
+            plan = " ".join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN " + sql))
+        finally:
+            conn.close()
+        self.assertIn("USING INDEX api_key_secret", plan)
+
+    async def test_key_digests_paged(self):
+        now = datetime.datetime.now(datetime.UTC)
+        for secret in ("c", "a", "b", "d"):
+            await self.db.user_create(secret)
+        await self.db.user_create("gone", now - datetime.timedelta(hours=1))
+
+        self.assertEqual(await self.db.key_count(), 4)
+        self.assertEqual(await self.db.key_digests(limit=3), ["a", "b", "c"])
+        self.assertEqual(await self.db.key_digests("c", limit=3), ["d"])
+
+    async def test_expiry_compared_as_time(self):
+        # expires is stored as ISO 8601, which doesn't compare as text with
+        # SQLite's "YYYY-MM-DD HH:MM:SS".
+        now = datetime.datetime.now(datetime.UTC)
+        await self.db.user_create("soon", now + datetime.timedelta(hours=1))
+        await self.db.user_create("gone", now - datetime.timedelta(hours=1))
+        self.assertEqual(len(await self.db.user_list("soon", exact=True)), 1)
+        self.assertEqual(await self.db.user_list("gone", exact=True), [])
+        rows = await self.db.user_list("gone", include_expired=True)
+        self.assertEqual(rows[0]["status"], "expired")
+
+    async def test_duplicate_billing_row(self):
+        record = {"rid": "r1", "time": None, "user": {"id": "u"},
+            "resources": {"p": 1}}
+        await self.db.billing_records_add([record])
+        await self.db.billing_records_add([record], dedupe=True)
+        with self.assertRaises(DatabaseError):
+            await self.db.billing_records_add([record])
+        await self.db.reset()
+
+        cur = await self.db.db.execute("SELECT COUNT(*) AS n FROM event_oneoff")
+        self.assertEqual((await cur.fetchone())["n"], 1)
+
+    async def test_key_ids_by_hash_prefix(self):
+        await self.db.user_create("abc1", id_="k1")
+        await self.db.user_create("abc2", expires=datetime.datetime(2000, 1,
+            1, tzinfo=datetime.UTC), id_="k2")
+        await self.db.user_create("def3", id_="k3")
+        self.assertEqual(sorted(await self.db.key_ids("abc")), ["k1", "k2"])
+
+    async def test_billing_export_pages_by_id(self):
+        start = datetime.datetime(2026, 1, 1, tzinfo=datetime.UTC)
+        await self.db.billing_records_add([{"rid": "r%d" % i,
+            "user": {"id": "u%d" % (i % 2)}, "resources": {"p": i},
+            "time": start + datetime.timedelta(hours=i)} for i in range(7)])
+
+        pages, after = [], None
+        while True:
+            rows, after = await self.db.billing_export(after, limit=3,
+                since=start + datetime.timedelta(hours=1),
+                api_keys=["u1"])
+            if after is None:
+                break
+            pages.append([r["rid"] for r in rows])
+        self.assertEqual(pages, [["r1", "r3", "r5"]])
+
+        rows, after = await self.db.billing_export(limit=2,
+            until=start + datetime.timedelta(hours=3))
+        self.assertEqual([r["rid"] for r in rows], ["r0", "r1"])
+        rows, after = await self.db.billing_export(after, limit=2,
+            until=start + datetime.timedelta(hours=3))
+        self.assertEqual([r["rid"] for r in rows], ["r2"])
+        self.assertEqual(rows[0]["quantity"], 2)
+
+    async def test_billing_archive(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        await self.db.billing_records_add([{"rid": "r%d" % i,
+            "user": {"id": "u"}, "resources": {"p": 1, "c": 2},
+            "time": datetime.datetime(2026, 1 + i % 3, 1,
+                tzinfo=datetime.UTC)} for i in range(6)])
+        before = await self.db.usage_report(period="month")
+
+        # As left by a crash after the archive commit, before the delete.
+        january = os.path.join(directory,
+            "%s-2026-01.sqlite" % os.path.basename(self.path))
+        conn = sqlite3.connect(january)
+        try:
+            conn.execute("ATTACH DATABASE ? AS hot", (self.path,))
+            conn.execute(_schema_sql().split(";")[0])  # event_oneoff
+            conn.execute("INSERT INTO event_oneoff "
+                "SELECT * FROM hot.event_oneoff WHERE id = 1")
+            conn.commit()
+        finally:
+            conn.close()
+
+        while await self.db.billing_archive(datetime.date(2026, 3, 1),
+                directory, limit=3):
+            pass
+
+        cur = await self.db.db.execute("SELECT rid FROM event_oneoff")
+        # March is newer; the newest event always stays.
+        self.assertEqual({r["rid"] for r in await cur.fetchall()},
+            {"r2", "r5"})
+        self.assertEqual(sorted(os.listdir(directory)),
+            ["%s-2026-01.sqlite" % os.path.basename(self.path),
+                "%s-2026-02.sqlite" % os.path.basename(self.path)])
+        conn = sqlite3.connect(january)
+        try:
+            archived = conn.execute("SELECT rid, product, quantity "
+                "FROM event_oneoff ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        self.assertEqual(archived, [("r0", "p", 1), ("r0", "c", 2),
+            ("r3", "p", 1), ("r3", "c", 2)])
+        self.assertEqual(await self.db.usage_report(period="month"), before)
+
+        size = await self.db.size()
+        while (await self.db.vacuum_step(pages=1))[0]:
+            pass
+        self.assertEqual(await self.db.vacuum_step(), (0, True))
+        self.assertLessEqual(await self.db.size(), size)
+
+    async def test_usage_rolled_up_on_insert(self):
+        def record(rid, hour, **resources):
+            return {"rid": rid, "user": {"id": "u"}, "resources": resources,
+                "time": datetime.datetime(2026, 1, 1, hour, 5,
+                    tzinfo=datetime.UTC)}
+
+        await self.db.billing_records_add([record("r1", 10, a=1, b=2),
+            record("r2", 10, a=3), record("r3", 11, a=4)])
+        # A replayed record is skipped and not counted twice.
+        await self.db.billing_records_add([record("r3", 11, a=4)],
+            dedupe=True)
+
+        rows = await self.db.usage_report(period="hour")
+        self.assertEqual([(r["period"], r["product"], r["requests"],
+            r["quantity"]) for r in rows], [
+                ("2026-01-01 10:00:00", "a", 2, 4),
+                ("2026-01-01 10:00:00", "b", 1, 2),
+                ("2026-01-01 11:00:00", "a", 1, 4)])
+        self.assertEqual(rows[0]["secret"], "")  # no such key
+
+        # since is rounded down to its hour, which includes r3 at 11:05.
+        rows = await self.db.usage_report(product="a", period="day",
+            since=datetime.datetime(2026, 1, 1, 11, 30, tzinfo=datetime.UTC))
+        self.assertEqual([(r["period"], r["requests"], r["quantity"])
+            for r in rows], [("2026-01-01", 1, 4)])
+        self.assertEqual(await self.db.usage_report(api_keys=[]), [])
+        self.assertEqual(await self.db.usage_backfill_remaining(), 0)
+
+
+class TestPool(unittest.IsolatedAsyncioTestCase):
+    """The app shares a fixed set of connections across requests instead of
+    opening one per request."""
+
+    async def asyncSetUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.pool = await Pool.create("sqlite://%s" % self.path, size=2,
+            check_idle=30)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        os.unlink(self.path)
+
+    async def test_connections_reused(self):
+        async with self.pool.connection() as a:
+            pass
+        async with self.pool.connection() as b:
+            async with self.pool.connection() as c:
+                pass
+        # Two slots, handed out in FIFO order.
+        self.assertIsNot(a, b)
+        self.assertIs(a, c)
+
+    async def test_waits_when_exhausted(self):
+        def in_use():
+            return prometheus_client.REGISTRY.get_sample_value(
+                "llmproxy_db_pool_in_use")
+
+        before = in_use()
+        a = await self.pool.acquire()
+        b = await self.pool.acquire()
+        self.assertEqual(in_use() - before, 2)
+
+        waiter = asyncio.ensure_future(self.pool.acquire())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+
+        await self.pool.release(a)
+        self.assertIs(await waiter, a)
+        await self.pool.release(a)
+        await self.pool.release(b)
+        self.assertEqual(in_use(), before)
+
+    async def test_uncommitted_work_rolled_back_on_release(self):
+        # A failed multi-row write must not be committed by the next user.
+        async with self.pool.connection() as db:
+            await db.db.execute(
+                "INSERT INTO api_key (id, secret, type) VALUES ('u', 'x', 'LLM')")
+        async with self.pool.connection() as db:
+            self.assertEqual(await db.user_list("x"), [])
+
+    async def test_cancelled_ping_keeps_slot(self):
+        self.pool.check_idle = 0
+        a = await self.pool.acquire()
+        b = await self.pool.acquire()
+        await self.pool.release(a)
+
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.Event().wait()
+
+        with mock.patch.object(a, "ping", hang):
+            task = asyncio.ensure_future(self.pool.acquire())
+            await started.wait()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        await asyncio.sleep(0)  # let the shielded close run
+
+        with self.assertRaises(DatabaseError):
+            await a.ping()  # closed, not leaked
+        c = await self.pool.acquire()  # slot came back, reopened
+        self.assertIsNot(c, a)
+        await self.pool.release(b)
+        await self.pool.release(c)
+
+    async def test_cancelled_reset_keeps_slot(self):
+        a = await self.pool.acquire()
+        b = await self.pool.acquire()
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.Event().wait()
+
+        with mock.patch.object(a, "reset", hang):
+            task = asyncio.ensure_future(self.pool.release(a))
+            await started.wait()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        await asyncio.sleep(0)
+
+        with self.assertRaises(DatabaseError):
+            await a.ping()
+        c = await asyncio.wait_for(self.pool.acquire(), 1)
+        self.assertIsNot(c, a)
+        await self.pool.release(b)
+        await self.pool.release(c)
+
+    async def test_broken_connection_reopened(self):
+        self.pool.check_idle = 0
+        async with self.pool.connection() as a:
+            await a.close()  # e.g. the database file went away
+        async with self.pool.connection() as b:
+            pass
+        async with self.pool.connection() as c:
+            self.assertEqual(await c.user_list("x"), [])
+        self.assertIsNot(a, c)
+        self.assertIsNot(b, c)
+
 
 if __name__ == "__main__":
     unittest.main()
+
+
+class _FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    async def to_list(self, length):
+        return self._docs[:length]
+
+
+class _FakeDatabase(dict):
+    def get_collection(self, name, codec_options=None):
+        return self[name]
+
+
+class _FakeCollection:
+    """The few motor collection methods MongoDatabase calls, recorded."""
+
+    def __init__(self, docs=(), indexes=None):
+        self.docs = list(docs)
+        self.indexes = indexes or {"_id_": {"key": [("_id", 1)]}}
+        self.pipelines = []
+        self.queries = []
+        self.created = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return _FakeCursor(self.docs)
+
+    async def find_one(self, *args, **kwargs):
+        raise AssertionError("user_list must not use find_one")
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        return self
+
+    def sort(self, key, direction):
+        return self
+
+    def limit(self, n):
+        return _FakeCursor(self.docs[:n])
+
+    async def to_list(self, length):
+        return self.docs
+
+    async def index_information(self):
+        return self.indexes
+
+    async def create_index(self, keys):
+        self.created.append(keys)
+
+
+class TestMongoQueries(unittest.IsolatedAsyncioTestCase):
+    NOW = datetime.datetime(2026, 1, 1, tzinfo=datetime.UTC)
+
+    DOC = {"_id": "k1", "user_id": "u1", "secret": "abc",
+        "date_expiry": None, "comment": "c",
+        "user": {"namespace": "ns", "org_id": 7,
+            "subscription_level": "pro"}}
+
+    def test_pipeline_matches_live_llm_key(self):
+        pipeline = _user_pipeline("abc", self.NOW)
+        self.assertEqual(pipeline[0]["$match"]["secret"], "abc")
+        self.assertEqual(pipeline[0]["$match"]["access_level"], "LLM")
+        self.assertIn({"date_expiry": {"$gt": self.NOW}},
+            pipeline[0]["$match"]["$or"])
+        self.assertEqual([next(iter(stage)) for stage in pipeline],
+            ["$match", "$limit", "$lookup", "$unwind", "$project"])
+
+    def test_projection_covers_user_row(self):
+        # Every field the mapping reads is projected (or is _id).
+        projected = {"_id"} | set(_user_pipeline("abc", self.NOW)[-1]
+            ["$project"])
+        user = _user_from_document(self.DOC)
+        self.assertEqual(user, {"id": "k1", "_user_id": "u1",
+            "_namespace": "ns", "_org_id": "7", "_tier": "pro",
+            "secret": "abc", "expires": None, "comment": "c"})
+        for field in ("secret", "date_expiry", "comment", "user_id",
+                "user.namespace", "user.org_id", "user.subscription_level"):
+            self.assertIn(field, projected)
+        self.assertEqual(_billing_document(user, self.NOW, {}, "r")["org_id"],
+            "7")
+
+    @unittest.skipUnless(HAS_PYMONGO, "pymongo not installed")
+    async def test_user_list_one_round_trip(self):
+        keys = _FakeCollection([self.DOC])
+        db = MongoDatabase.__new__(MongoDatabase)
+        db.db = {"cgc": _FakeDatabase(api_keys=keys,
+            rest_users=_FakeCollection())}
+
+        self.assertEqual([u["id"] for u in await db.user_list("abc")], ["k1"])
+        self.assertEqual(len(keys.pipelines), 1)
+
+        keys.docs = []
+        self.assertEqual(await db.user_list("abc"), [])
+
+    @unittest.skipUnless(HAS_PYMONGO, "pymongo not installed")
+    async def test_ensure_indexes_creates_missing_only(self):
+        keys = _FakeCollection(indexes={"_id_": {"key": [("_id", 1)]},
+            "by_secret": {"key": [("secret", 1), ("access_level", 1)]}})
+        billing = _FakeCollection()
+        db = MongoDatabase.__new__(MongoDatabase)
+        db.db = {"cgc": _FakeDatabase(api_keys=keys, billing_record=billing)}
+
+        await db.ensure_indexes()
+        self.assertEqual(keys.created, [])
+        self.assertEqual(billing.created, [[("request_id", 1)]])
+
+    @unittest.skipUnless(HAS_PYMONGO, "pymongo not installed")
+    async def test_key_ids_by_hash_prefix(self):
+        import bson
+
+        id_ = bson.ObjectId()
+        keys = _FakeCollection([{"_id": id_}])
+        db = MongoDatabase.__new__(MongoDatabase)
+        db.db = {"cgc": _FakeDatabase(api_keys=keys)}
+
+        self.assertEqual(await db.key_ids("abc"), [id_])
+        self.assertEqual(keys.queries, [{"access_level": "LLM",
+            "secret": {"$regex": "^abc"}}])
+
+    @unittest.skipUnless(HAS_PYMONGO, "pymongo not installed")
+    async def test_billing_export_one_event_per_resource(self):
+        import bson
+
+        ids = [bson.ObjectId() for _ in range(2)]
+        billing = _FakeCollection([
+            {"_id": ids[0], "created_at": self.NOW, "api_key_id": "k1",
+                "resources": {"p": 1, "c": 2}, "request_id": "r1"},
+            {"_id": ids[1], "created_at": self.NOW, "api_key_id": "k1",
+                "resources": {"p": 3}, "request_id": "r2"},
+        ])
+        db = MongoDatabase.__new__(MongoDatabase)
+        db.db = {"cgc": _FakeDatabase(billing_record=billing)}
+        db.copt = None
+
+        rows, after = await db.billing_export(str(ids[0]), until=self.NOW,
+            api_keys=["k1"], limit=2)
+        self.assertEqual([(r["rid"], r["product"]) for r in rows],
+            [("r1", "p"), ("r1", "c"), ("r2", "p")])
+        self.assertEqual(after, str(ids[1]))
+        self.assertEqual(billing.queries, [{"_id": {"$gt": ids[0]},
+            "created_at": {"$lt": self.NOW}, "api_key_id": {"$in": ["k1"]}}])
@@ -0,0 +1,250 @@
+import asyncio
+import datetime
+import decimal
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import aiohttp.web
+
+from llmproxy import billing, journal
+from llmproxy.app import open_billing_queue
+from llmproxy.billing import BillingQueue
+from llmproxy.db import DatabaseError, Pool, SqliteDatabase
+
+from tests.test_proxy import LLMProxyAppTestCase
+
+USER = {"id": "myuser", "secret": "abc", "expires": None}
+
+
+class TestEncoding(unittest.TestCase):
+    def test_round_trip(self):
+        record = {"rid": "r", "resources": {"a": 7, "b": decimal.Decimal("12.5")},
+            "time": datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=datetime.UTC)}
+        line = journal.encode(record)
+        self.assertTrue(line.endswith("\n"))
+        self.assertEqual(journal.decode(line), record)
+        self.assertIsInstance(journal.decode(line)["resources"]["a"], int)
+
+
+class TestBillingQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "journal")
+        self.uri = "sqlite://%s" % os.path.join(self.dir, "db.sqlite")
+        self.pool = await Pool.create(self.uri, size=1)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        shutil.rmtree(self.dir)
+
+    def events(self):
+        conn = sqlite3.connect(self.uri.removeprefix("sqlite://"))
+        try:
+            return conn.execute(
+                "SELECT rid, product, quantity FROM event_oneoff "
+                "ORDER BY id").fetchall()
+        finally:
+            conn.close()
+
+    def segments(self):
+        return sorted(n for n in os.listdir(self.path)
+            if n.endswith(journal.SUFFIX))
+
+    async def add(self, queue, rid, **resources):
+        await queue.add(USER, datetime.datetime.now(datetime.UTC), resources,
+            rid)
+
+    async def test_flushed_in_one_batch(self):
+        queue = await BillingQueue.open(self.pool, self.path,
+            flush_interval=60)
+        await self.add(queue, "r1", prompt=3, completion=4)
+        await self.add(queue, "r2", prompt=5)
+        self.assertEqual(self.events(), [])  # acknowledged, not yet written
+
+        with mock.patch.object(SqliteDatabase, "billing_records_add",
+                autospec=True,
+                side_effect=SqliteDatabase.billing_records_add) as add:
+            await queue.flush()
+        add.assert_called_once()
+        self.assertEqual(self.events(), [("r1", "prompt", 3),
+            ("r1", "completion", 4), ("r2", "prompt", 5)])
+
+        await queue.close()
+        self.assertEqual(self.segments(), [])
+
+    async def test_full_batch_flushed_without_waiting(self):
+        queue = await BillingQueue.open(self.pool, self.path, batch_size=2,
+            flush_interval=60)
+        try:
+            await self.add(queue, "r1", prompt=3)
+            await self.add(queue, "r2", prompt=5)
+            for _ in range(100):
+                if self.events():
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(len(self.events()), 2)
+        finally:
+            await queue.close()
+
+    async def test_crash_replayed_once(self):
+        queue = await BillingQueue.open(self.pool, self.path,
+            flush_interval=60)
+        await self.add(queue, "r1", prompt=3)
+        await queue.flush()
+        await self.add(queue, "r2", prompt=5)
+        # Crash: r2 is only in the journal.
+        queue._task.cancel()
+        queue.journal._writer.cancel()
+        queue.journal._lockfile.close()
+
+        queue = await BillingQueue.open(self.pool, self.path,
+            flush_interval=60)
+        await queue.close()
+        self.assertEqual(self.events(), [("r1", "prompt", 3),
+            ("r2", "prompt", 5)])
+
+    async def test_replay_skips_committed_records(self):
+        # Crash after the database commit but before the segment was deleted.
+        queue = await BillingQueue.open(self.pool, self.path,
+            flush_interval=60)
+        await self.add(queue, "r1", prompt=3, completion=4)
+        await queue.journal.rotate()
+        with mock.patch.object(queue.journal, "discard"):
+            await queue.flush()
+        queue._task.cancel()
+        queue.journal._writer.cancel()
+        queue.journal._lockfile.close()
+        self.assertEqual(len(self.segments()), 2)
+
+        queue = await BillingQueue.open(self.pool, self.path,
+            flush_interval=60)
+        await queue.close()
+        self.assertEqual(self.events(), [("r1", "prompt", 3),
+            ("r1", "completion", 4)])
+
+    async def test_failed_flush_kept_and_retried(self):
+        queue = await BillingQueue.open(self.pool, self.path,
+            flush_interval=60)
+        await self.add(queue, "r1", prompt=3)
+
+        with mock.patch.object(SqliteDatabase, "billing_records_add",
+                side_effect=DatabaseError("disk I/O error")):
+            with self.assertRaises(DatabaseError):
+                await queue.flush()
+        self.assertEqual(len(self.segments()), 2)  # sealed + current
+
+        await self.add(queue, "r2", prompt=5)
+        await queue.flush()
+        await queue.close()
+        self.assertEqual(self.events(), [("r1", "prompt", 3),
+            ("r2", "prompt", 5)])
+        self.assertEqual(self.segments(), [])
+
+    async def test_unexpected_flush_error_retried(self):
+        queue = await BillingQueue.open(self.pool, self.path,
+            flush_interval=0.01)
+        try:
+            await self.add(queue, "r1", prompt=3)
+            with mock.patch.object(SqliteDatabase, "billing_records_add",
+                    side_effect=ValueError("bad record")):
+                with self.assertLogs("llmproxy.billing", "ERROR"):
+                    await asyncio.sleep(0.05)
+            for _ in range(100):
+                if self.events():
+                    break
+                await asyncio.sleep(0.01)
+            self.assertFalse(queue._task.done())
+            self.assertEqual(self.events(), [("r1", "prompt", 3)])
+        finally:
+            await queue.close()
+
+    async def test_close_writes_pending_appends(self):
+        j = await journal.Journal.open(self.path)
+        write = journal._write
+
+        def slow_write(f, data):
+            time.sleep(0.05)
+            write(f, data)
+
+        with mock.patch("llmproxy.journal._write", slow_write):
+            first = asyncio.create_task(j.append({"rid": "r1"}))
+            await asyncio.sleep(0.01)  # being written
+            second = asyncio.create_task(j.append({"rid": "r2"}))
+            await asyncio.sleep(0)
+            await j.close()
+        await asyncio.wait_for(asyncio.gather(first, second), 1)
+
+        segment, = self.segments()
+        self.assertEqual(
+            journal.Journal._load(os.path.join(self.path, segment)),
+            [{"rid": "r1"}, {"rid": "r2"}])
+
+    async def test_journal_failure_kills_worker(self):
+        # Never acknowledge a record that isn't on disk.
+        queue = await BillingQueue.open(self.pool, self.path)
+        app = mock.MagicMock()
+        app.get.return_value = queue
+        f_req = mock.MagicMock(app=app)
+        f_req.__getitem__.return_value = "r1"
+        try:
+            with mock.patch.object(queue.journal, "append",
+                    side_effect=OSError("No space left on device")):
+                with self.assertRaises(aiohttp.web.GracefulExit):
+                    await billing.record(f_req, USER, {"prompt": 3})
+        finally:
+            await queue.close()
+
+    async def test_journal_locked(self):
+        queue = await BillingQueue.open(self.pool, self.path)
+        try:
+            with self.assertRaises(RuntimeError):
+                await BillingQueue.open(self.pool, self.path)
+        finally:
+            await queue.close()
+
+    async def test_corrupt_tail_skipped(self):
+        os.makedirs(self.path)
+        line = journal.encode({"rid": "r1", "user": USER, "resources":
+            {"prompt": 3}, "time": datetime.datetime.now(datetime.UTC)})
+        with open(os.path.join(self.path, "%016d%s" % (1, journal.SUFFIX)),
+                "w") as f:
+            f.write(line + line[:10])
+
+        queue = await BillingQueue.open(self.pool, self.path)
+        await queue.close()
+        self.assertEqual(self.events(), [("r1", "prompt", 3)])
+
+
+class TestWriteBehindBilling(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        self.journal_dir = tempfile.mkdtemp()
+        app["config"]["billing"] = {"journal": self.journal_dir,
+            "flush_interval": 60}
+        await open_billing_queue(app)
+        return app
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        # The app's cleanup flushed and closed the journal.
+        self.assertEqual(os.listdir(self.journal_dir), ["lock"])
+        shutil.rmtree(self.journal_dir)
+
+    async def test_billed_after_flush(self):
+        body = {"model": "mymodel",
+            "messages": [{"role": "user", "content": "hi"}]}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer mytoken"}, json=body) as res:
+            self.assertEqual(res.status, 200)
+
+        self.assertListEqual(await self.get_events(), [])
+        await self.app["billing_queue"].flush()
+        self.assertListEqual(await self.get_events(), [
+            {"product": "mymodel/none/prompt", "quantity": 1},
+            {"product": "mymodel/none/completion", "quantity": 2},
+        ])
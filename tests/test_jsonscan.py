@@ -0,0 +1,112 @@
+import decimal
+import json
+import unittest
+
+from llmproxy.jsonscan import RawObject, top_level_member
+
+
+class TestTopLevelMember(unittest.TestCase):
+    USAGE = {"prompt_tokens": 7, "total_tokens": 7}
+
+    def assertSameAsFullParse(self, body, key="usage"):
+        expected = json.loads(body, parse_float=decimal.Decimal)[key]
+        self.assertEqual(top_level_member(body, key), expected)
+
+    def test_usage_last(self):
+        body = json.dumps({"data": [{"embedding": [0.1, 0.2]}],
+            "usage": self.USAGE}).encode()
+        self.assertEqual(top_level_member(body, "usage"), self.USAGE)
+
+    def test_usage_followed_by_other_members(self):
+        # vLLM chat: usage, then prompt_logprobs / kv_transfer_params.
+        body = (b'{"choices": [], "usage": {"prompt_tokens": 1},\n'
+            b' "prompt_logprobs": null, "kv_transfer_params": {"a": [1]}}\n')
+        self.assertSameAsFullParse(body)
+
+    def test_usage_first(self):
+        body = json.dumps({"usage": self.USAGE,
+            "choices": [{"message": {"content": "hi"}}]}).encode()
+        self.assertSameAsFullParse(body)
+
+    def test_usage_in_the_middle_falls_back(self):
+        body = json.dumps({"id": "x", "usage": self.USAGE,
+            "choices": []}).encode()
+        self.assertSameAsFullParse(body)
+
+    def test_nested_usage_is_not_top_level(self):
+        body = json.dumps({"usage": {"prompt_tokens": 1},
+            "extra": {"usage": {"prompt_tokens": 999}}}).encode()
+        self.assertEqual(top_level_member(body, "usage"), {"prompt_tokens": 1})
+
+    def test_usage_inside_string_is_ignored(self):
+        body = json.dumps({"usage": {"prompt_tokens": 1},
+            "text": '"usage": {"prompt_tokens": 2}}'}).encode()
+        self.assertEqual(top_level_member(body, "usage"), {"prompt_tokens": 1})
+
+    def test_floats_are_decimal(self):
+        body = b'{"text": "x", "duration": 12.5}'
+        value = top_level_member(body, "duration")
+        self.assertIsInstance(value, decimal.Decimal)
+        self.assertEqual(value, decimal.Decimal("12.5"))
+
+    def test_non_ascii(self):
+        body = json.dumps({"text": "zażółć", "usage": self.USAGE},
+            ensure_ascii=False).encode()
+        self.assertEqual(top_level_member(body, "usage"), self.USAGE)
+
+    def test_missing(self):
+        body = b'{"choices": []}'
+        with self.assertRaises(KeyError):
+            top_level_member(body, "usage")
+        self.assertIsNone(top_level_member(body, "usage", None))
+
+    def test_invalid_json(self):
+        with self.assertRaises(json.JSONDecodeError):
+            top_level_member(b'{"choices": [', "usage")
+
+
+class TestRawObject(unittest.TestCase):
+    BODY = (b'{"model": "a", "stream": true, "messages": '
+        b'[{"role": "user", "content": "x\\"]}"}, [1.5, {"a": null}]]}')
+
+    def test_get(self):
+        obj = RawObject(self.BODY)
+        self.assertEqual(obj["model"], "a")
+        self.assertIs(obj.get("stream"), True)
+        self.assertIsNone(obj.get("store"))
+        self.assertNotIn("store", obj)
+        with self.assertRaises(KeyError):
+            obj["store"]
+
+    def test_unchanged_body_is_forwarded_as_is(self):
+        self.assertIs(RawObject(self.BODY).encode(), self.BODY)
+
+    def test_splices_match_dict_rewrite(self):
+        obj = RawObject(self.BODY)
+        obj["model"] = "b"
+        obj["stream_options"] = {"include_usage": True}
+
+        expected = json.loads(self.BODY)
+        expected["model"] = "b"
+        expected["stream_options"] = {"include_usage": True}
+        self.assertEqual(json.loads(obj.encode()), expected)
+
+    def test_insert_into_empty_object(self):
+        obj = RawObject(b" {} ")
+        obj["store"] = False
+        self.assertEqual(json.loads(obj.encode()), {"store": False})
+
+    def test_duplicate_key_last_wins(self):
+        obj = RawObject(b'{"model": "a", "model": "b"}')
+        self.assertEqual(obj["model"], "b")
+
+    def test_unindexable_bodies_raise(self):
+        for body in (b'{"a": [1}', b'{"a": "x', b"[1]", b'{"a": 1} x',
+                b'{"a": ["x]}', b'{"a" 1}', b""):
+            with self.subTest(body=body):
+                with self.assertRaises(ValueError):
+                    RawObject(body)
+
+
+if __name__ == "__main__":
+    unittest.main()
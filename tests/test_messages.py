@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 
 from llmproxy.messages import _MessagesStreamUsage, _input_tokens
 
@@ -23,6 +24,25 @@ class TestMessagesUsage(unittest.TestCase):
         self.assertEqual(acc.usage(),
             {"prompt_tokens": 12, "completion_tokens": 7})
 
+    def test_without_event_lines(self):
+        # Blocks with only a data: line still bill (the prefilter falls back
+        # to a byte search for the type name).
+        acc = _MessagesStreamUsage()
+        acc(b'data: {"type":"message_start",'
+            b'"message":{"usage":{"input_tokens":10,"output_tokens":1}}}\n\n')
+        acc(b'data: {"type":"content_block_delta","delta":{"text":"x"}}\n\n')
+        acc(b'data: {"type":"message_delta","usage":{"output_tokens":4}}\n\n')
+        self.assertEqual(acc.usage(),
+            {"prompt_tokens": 10, "completion_tokens": 4})
+
+    def test_content_deltas_are_not_decoded(self):
+        delta = (b'event: content_block_delta\ndata: {"type":'
+            b'"content_block_delta","delta":{"text":"message_delta"}}\n\n')
+        acc = _MessagesStreamUsage()
+        with mock.patch("llmproxy.streaming.parse_sse_event") as parse:
+            acc(delta)
+        parse.assert_not_called()
+
     def test_input_tokens_folds_cache(self):
         self.assertEqual(_input_tokens(
             {"input_tokens": 5, "cache_creation_input_tokens": 3,
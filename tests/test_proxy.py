@@ -5,6 +5,7 @@ import os
 import sqlite3
 import tempfile
 import unittest
+from unittest import mock
 import warnings
 
 import aiohttp
@@ -435,6 +436,153 @@ class TestChat(LLMProxyAppTestCase):
         ])
 
 
+class TestSpliceJSONBody(LLMProxyAppTestCase):
+    """splice_json_body forwards the client's bytes with only the rewritten
+    fields spliced in; routing and billing must be unchanged."""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.app["config"]["splice_json_body"] = True
+
+    async def test_model_override_spliced(self):
+        # The mock backend rejects any model but "mymodel", so a 200 proves
+        # the backend "model" override reached it.
+        body = {"model": "nolimit", "stream": True,
+            "messages": [{"role": "user", "content": "hi"}]}
+        req = self.client.request("POST", "/v1/chat/completions",
+            headers={"Authorization": "Bearer mytoken"}, json=body)
+
+        async with req as res:
+            self.assertEqual(res.status, 200)
+            self.assertIn("data: [DONE]", await res.text())
+
+        self.assertListEqual(await self.get_events(), [
+            {"product": "nolimit/none/prompt", "quantity": 1},
+            {"product": "nolimit/none/completion", "quantity": 2},
+        ])
+
+    async def test_stateful_responses_still_rejected(self):
+        body = {"model": "mymodel", "input": "hi",
+            "previous_response_id": "resp_1"}
+        req = self.client.request("POST", "/v1/responses",
+            headers={"Authorization": "Bearer mytoken"}, json=body)
+
+        async with req as res:
+            self.assertEqual(res.status, 400)
+
+        self.assertListEqual(await self.get_events(), [])
+
+    async def test_invalid_json_rejected(self):
+        # Not indexable -> falls back to the full parse, which 400s.
+        req = self.client.request("POST", "/v1/chat/completions",
+            headers={"Authorization": "Bearer mytoken",
+                "Content-Type": "application/json"},
+            data=b'{"model": "mymodel", "messages": [')
+
+        async with req as res:
+            self.assertEqual(res.status, 400)
+
+        self.assertListEqual(await self.get_events(), [])
+
+
+class TestStreamedMultipart(LLMProxyAppTestCase):
+    """Audio uploads are forwarded part by part; the backend must still see
+    the same form post() would have rebuilt."""
+
+    def _request(self, *fields):
+        form = aiohttp.FormData()
+        for name, value, *filename in fields:
+            if filename:
+                form.add_field(name, value, filename=filename[0],
+                    content_type="audio/wav")
+            else:
+                form.add_field(name, value)
+        return self.client.request("POST", "/v1/audio/transcriptions",
+            headers={"Authorization": "Bearer mytoken"}, data=form)
+
+    async def test_fields_after_file_forwarded(self):
+        req = self._request(("model", "nolimit"), ("file", b"RIFF" * 100,
+            "a.wav"), ("language", "pl"))
+
+        async with req as res:
+            self.assertEqual(res.status, 200)
+            data = await res.json()
+
+        self.assertDictEqual(data["_fields"], {"model": "mymodel",
+            "response_format": "verbose_json", "language": "pl"})
+        self.assertDictEqual(data["_files"], {"file": 400})
+        self.assertListEqual(await self.get_events(), [
+            {"product": "nolimit/none/transcription", "quantity": 12.5},
+        ])
+
+    async def test_model_after_file_spooled(self):
+        big = b"\x00" * (3 * 1024 * 1024)  # spills to disk
+        req = self._request(("file", big, "a.wav"), ("model", "mymodel"))
+
+        async with req as res:
+            self.assertEqual(res.status, 200)
+            data = await res.json()
+
+        self.assertDictEqual(data["_files"], {"file": len(big)})
+        self.assertListEqual(await self.get_events(), [
+            {"product": "mymodel/none/transcription", "quantity": 12.5},
+        ])
+
+    async def test_invalid_late_field_rejected(self):
+        # response_format after the file is already streaming must still be
+        # validated; the request fails and is not billed.
+        req = self._request(("model", "mymodel"), ("file", b"RIFF", "a.wav"),
+            ("response_format", "srt"))
+
+        async with req as res:
+            self.assertEqual(res.status, 422)
+
+        self.assertListEqual(await self.get_events(), [])
+
+    async def test_upload_over_limit_rejected(self):
+        self.app._client_max_size = 1024 * 1024
+        req = self._request(("model", "mymodel"),
+            ("file", b"\x00" * (2 * 1024 * 1024), "a.wav"))
+
+        async with req as res:
+            self.assertEqual(res.status, 413)
+
+        self.assertListEqual(await self.get_events(), [])
+
+    async def test_missing_model_rejected(self):
+        req = self._request(("file", b"RIFF", "a.wav"))
+
+        async with req as res:
+            self.assertEqual(res.status, 401)
+
+        self.assertListEqual(await self.get_events(), [])
+
+    async def test_spooled_parts_closed_when_rejected(self):
+        spooled = []
+        spooled_file = tempfile.SpooledTemporaryFile
+
+        def spool(*args, **kwargs):
+            f = spooled_file(*args, **kwargs)
+            spooled.append(f)
+            return f
+
+        with mock.patch("llmproxy.formstream.tempfile.SpooledTemporaryFile",
+                spool):
+            # Unknown model: rejected after spooling.
+            async with self._request(("file", b"RIFF", "a.wav"),
+                    ("model", "unknown")) as res:
+                self.assertEqual(res.status, 401)
+            # Too large: rejected while spooling.
+            self.app._client_max_size = 1024 * 1024
+            async with self._request(("file", b"RIFF", "a.wav"),
+                    ("file2", b"\x00" * (2 * 1024 * 1024), "b.wav"),
+                    ("model", "mymodel")) as res:
+                self.assertEqual(res.status, 413)
+
+        self.assertEqual(len(spooled), 3)
+        self.assertTrue(all(f.closed for f in spooled))
+
+
 class TestConfigValidation(unittest.IsolatedAsyncioTestCase):
     def test_validate_accepts_positive_integer_max_model_len(self):
         config.validate({"backends": {"mymodel": {"max_model_len": 131072}}})
@@ -460,6 +608,88 @@ class TestConfigValidation(unittest.IsolatedAsyncioTestCase):
                 with self.assertRaises(config.ConfigError):
                     config.validate({"backends": {"m": {"timeout": value}}})
 
+    def test_validate_rejects_invalid_coalescing(self):
+        for key, value in (("coalesce_bytes", -1), ("coalesce_bytes", 1.5),
+                ("coalesce_ms", -1), ("coalesce_ms", "10")):
+            with self.subTest(key=key, value=value):
+                with self.assertRaises(config.ConfigError):
+                    config.validate({key: value})
+                with self.assertRaises(config.ConfigError):
+                    config.validate({"backends": {"m": {key: value}}})
+
+    def test_validate_rejects_invalid_balancing(self):
+        for key, value in (("balance", "random"), ("health_interval", -1),
+                ("health_timeout", 0), ("circuit_failures", 1.5),
+                ("circuit_open_seconds", "30"), ("retries", -1),
+                ("retry_backoff", -0.1), ("retry_budget", "0.2"),
+                ("max_concurrency", -1), ("max_queue", 1.5),
+                ("max_queue_time", "30"), ("adaptive_concurrency", 1),
+                ("min_concurrency", 0)):
+            with self.subTest(key=key, value=value):
+                with self.assertRaises(config.ConfigError):
+                    config.validate({key: value})
+                with self.assertRaises(config.ConfigError):
+                    config.validate({"backends": {"m": {key: value}}})
+
+    def test_validate_rejects_invalid_connections(self):
+        for key, value in (("connection_limit", -1),
+                ("connection_limit_per_host", 1.5),
+                ("keepalive_timeout", -1), ("dns_cache_ttl", "10")):
+            with self.subTest(key=key, value=value):
+                with self.assertRaises(config.ConfigError):
+                    config.validate({key: value})
+                with self.assertRaises(config.ConfigError):
+                    config.validate({"backends": {"m": {key: value}}})
+
+        with self.assertRaises(config.ConfigError):
+            config.validate({"backends": {"m": {"unix_socket": 1}}})
+
+    def test_validate_rejects_invalid_replicas(self):
+        for meta in ({"replicas": []}, {"replicas": [{"weight": 1}]},
+                {"replicas": [{"url": "http://a", "weight": 0}]},
+                {"replicas": [{"url": "http://a", "max_concurrency": 0}]},
+                {"replicas": [{"url": "http://a"}, {"url": "http://a"}]},
+                {"url": "http://a", "replicas": [{"url": "http://b"}]},
+                {"url": "http://a", "fallback": "m"},
+                {"url": "http://a", "fallback": "missing"}):
+            with self.subTest(meta=meta):
+                with self.assertRaises(config.ConfigError):
+                    config.validate({"backends": {"m": meta}})
+
+        config.validate({"backends": {"m": {"replicas": [
+            {"url": "http://a", "weight": 2}, {"url": "http://b"}]}}})
+
+    def test_validate_rejects_invalid_rate_limits(self):
+        for rate_limit in ({"requests_per_minute": -1},
+                {"tokens_per_minute": 1.5}, {"tiers": []},
+                {"tiers": {"pro": 1}},
+                {"tiers": {"pro": {"tier_tokens_per_minute": "1000"}}}):
+            with self.subTest(rate_limit=rate_limit):
+                with self.assertRaises(config.ConfigError):
+                    config.validate({"rate_limit": rate_limit})
+
+        config.validate({"rate_limit": {"requests_per_minute": 60,
+            "tiers": {"pro": {"tokens_per_minute": 100000}}}})
+
+    def test_validate_rejects_invalid_db_pool(self):
+        for key, value in (("pool_size", 0), ("pool_size", 2.5),
+                ("pool_check_idle", -1), ("pool_check_idle", "30"),
+                ("ensure_indexes", 1)):
+            with self.subTest(key=key, value=value):
+                with self.assertRaises(config.ConfigError):
+                    config.validate({"db": {key: value}})
+
+    def test_validate_rejects_invalid_auth_cache(self):
+        for key, value in (("cache_size", -1), ("cache_size", 1.5),
+                ("cache_ttl", -1), ("cache_negative_ttl", "5"),
+                ("key_filter", "yes"), ("key_filter_interval", 0),
+                ("key_filter_miss_lookups", -1),
+                ("key_filter_fp_rate", 1), ("signing_key", "short"),
+                ("revocation_interval", -1)):
+            with self.subTest(key=key, value=value):
+                with self.assertRaises(config.ConfigError):
+                    config.validate({"auth": {key: value}})
+
     def test_validate_accepts_valid_timeout_and_client_max_size(self):
         config.validate({
             "client_max_size": 2147483648,
@@ -635,6 +865,34 @@ class TestMetrics(LLMProxyAppTestCase):
         self.assertIn("llmproxy_request_duration_seconds_count", text)
         self.assertIn("llmproxy_backend_duration_seconds_count", text)
 
+    async def test_metrics_contain_stream_latency_histograms(self):
+        """A streamed request records time to first event, event gaps, stream
+        duration and the generation rate for its model."""
+        for path, extra in (
+            ("/v1/chat/completions",
+                {"messages": [{"role": "user", "content": "hi"}]}),
+            ("/v1/messages",
+                {"messages": [{"role": "user", "content": "hi"}]}),
+            ("/v1/responses", {"input": "hi"}),
+        ):
+            body = {"model": "mymodel", "stream": True, **extra}
+            async with self.client.request("POST", path,
+                    headers={"Authorization": "Bearer mytoken"},
+                    json=body) as res:
+                self.assertEqual(res.status, 200)
+                await res.read()
+
+        async with self.client.request("GET", "/metrics") as res:
+            parsed = _parse_metrics(await res.text())
+
+        for name in ("llmproxy_stream_first_event_seconds_count",
+                "llmproxy_stream_event_gap_seconds_count",
+                "llmproxy_stream_duration_seconds_count",
+                "llmproxy_generation_tokens_per_second_count"):
+            with self.subTest(name=name):
+                self.assertTrue(any('model="mymodel"' in line
+                    for line in parsed.get(name, [])), name)
+
     async def test_metrics_contain_active_requests_gauge(self):
         """The active requests gauge is present (value 0 when idle)."""
         async with self.client.request("GET", "/metrics") as res:
@@ -0,0 +1,147 @@
+import json
+import unittest
+from unittest import mock
+
+from llmproxy import metrics
+from llmproxy.ratelimit import (IDLE_SECONDS, RateLimited, RateLimiter,
+    estimate_tokens)
+
+from tests.test_proxy import LLMProxyAppTestCase
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("llmproxy.ratelimit.time.monotonic",
+            lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_refill(self):
+        limiter = RateLimiter({"requests_per_minute": 2})
+        user = {"id": "u"}
+        limiter.charge(user, 0)
+        limiter.charge(user, 0)
+        with self.assertRaises(RateLimited) as cm:
+            limiter.charge(user, 0)
+        self.assertEqual(cm.exception.kind, "requests")
+        self.assertEqual(cm.exception.headers["Retry-After"], "30")
+        self.assertEqual(
+            cm.exception.headers["x-ratelimit-remaining-requests"], "0")
+        self.assertEqual(
+            cm.exception.headers["x-ratelimit-reset-requests"], "60s")
+
+        self.now += 30
+        limiter.charge(user, 0)
+        # Other keys have their own buckets.
+        limiter.charge({"id": "v"}, 0)
+
+    def test_tokens_reconciled(self):
+        limiter = RateLimiter({"tokens_per_minute": 1000})
+        user = {"id": "u"}
+        charge = limiter.charge(user, 900)
+        with self.assertRaises(RateLimited) as cm:
+            limiter.charge(user, 200)
+        self.assertEqual(cm.exception.kind, "tokens")
+        self.assertEqual(
+            cm.exception.headers["x-ratelimit-remaining-tokens"], "100")
+
+        limiter.reconcile(charge, 50)
+        limiter.charge(user, 200)
+
+    def test_usage_over_estimate_leaves_debt(self):
+        limiter = RateLimiter({"tokens_per_minute": 1000})
+        user = {"id": "u"}
+        limiter.reconcile(limiter.charge(user, 10), 1500)
+        with self.assertRaises(RateLimited):
+            limiter.charge(user, 1)
+        self.now += 60
+        limiter.charge(user, 1)
+
+    def test_large_request_needs_full_bucket(self):
+        limiter = RateLimiter({"tokens_per_minute": 1000})
+        user = {"id": "u"}
+        limiter.charge(user, 5000)
+        with self.assertRaises(RateLimited):
+            limiter.charge(user, 5000)
+        self.now += 120
+        limiter.charge(user, 5000)
+
+    def test_tiers(self):
+        limiter = RateLimiter({"requests_per_minute": 1, "tiers": {
+            "pro": {"requests_per_minute": 10, "tier_requests_per_minute": 3},
+        }})
+        limiter.charge({"id": "a", "_tier": "free"}, 0)
+        with self.assertRaises(RateLimited):
+            limiter.charge({"id": "a", "_tier": "free"}, 0)
+
+        for _ in range(2):
+            limiter.charge({"id": "b", "_tier": "pro"}, 0)
+        limiter.charge({"id": "c", "_tier": "pro"}, 0)
+        with self.assertRaises(RateLimited) as cm:
+            limiter.charge({"id": "c", "_tier": "pro"}, 0)
+        # The shared bucket is the one with the least left.
+        self.assertEqual(
+            cm.exception.headers["x-ratelimit-limit-requests"], "3")
+
+    def test_unlimited(self):
+        limiter = RateLimiter({})
+        self.assertIsNone(limiter.charge({"id": "u"}, 10 ** 9))
+        self.assertFalse(limiter._buckets)
+
+    def test_idle_buckets_evicted(self):
+        limiter = RateLimiter({"requests_per_minute": 5})
+        for i in range(10):
+            limiter.charge({"id": i}, 0)
+        self.now += IDLE_SECONDS
+        limiter.charge({"id": "new"}, 0)
+        self.assertEqual(list(limiter._buckets), [("key", "new")])
+        self.assertEqual(metrics.RATE_LIMIT_BUCKETS._value.get(), 1)
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens({}, 400), 100)
+        self.assertEqual(estimate_tokens({"max_tokens": 50}, 400), 150)
+        self.assertEqual(
+            estimate_tokens({"max_output_tokens": 50}, 400), 150)
+
+
+class TestRateLimitedRequests(LLMProxyAppTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        app["rate_limiter"] = RateLimiter({"requests_per_minute": 2,
+            "tokens_per_minute": 10000})
+        return app
+
+    async def chat(self, **extra):
+        body = {"model": "mymodel",
+            "messages": [{"role": "user", "content": "hi"}], **extra}
+        async with self.client.request("POST", "/v1/chat/completions",
+                headers={"Authorization": "Bearer mytoken"},
+                json=body) as res:
+            return res.status, res.headers, await res.read()
+
+    async def test_over_limit_gets_429(self):
+        self.assertEqual((await self.chat())[0], 200)
+        self.assertEqual((await self.chat())[0], 200)
+        status, headers, body = await self.chat()
+        self.assertEqual(status, 429)
+        self.assertEqual(headers["x-ratelimit-limit-requests"], "2")
+        self.assertEqual(headers["x-ratelimit-remaining-requests"], "0")
+        self.assertIn("x-ratelimit-remaining-tokens", headers)
+        self.assertGreaterEqual(int(headers["Retry-After"]), 1)
+        self.assertEqual(json.loads(body)["error"]["type"],
+            "rate_limit_error")
+        # Not forwarded, not billed.
+        self.assertEqual(len(await self.get_events()), 4)
+
+    async def test_failed_request_refunded(self):
+        status, _, _ = await self.chat(max_tokens=5000, _trigger_error=500)
+        self.assertEqual(status, 502)
+        bucket, = self.app["rate_limiter"]._buckets.values()
+        self.assertAlmostEqual(bucket[1], 10000, delta=1)
+
+    async def test_tokens_reconciled_with_billing(self):
+        self.assertEqual((await self.chat(max_tokens=5000))[0], 200)
+        bucket, = self.app["rate_limiter"]._buckets.values()
+        # 1 prompt and 2 completion tokens billed.
+        self.assertAlmostEqual(bucket[1], 10000 - 3, delta=1)
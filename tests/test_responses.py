@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 
 from llmproxy.responses import (
     StatefulNotSupported,
@@ -7,7 +8,7 @@ from llmproxy.responses import (
     to_billing_tokens,
     usage_from_event,
 )
-from llmproxy.streaming import parse_sse_event
+from llmproxy.streaming import may_be_event, parse_sse_event, sse_event_name
 
 from tests.test_proxy import LLMProxyAppTestCase
 
@@ -58,6 +59,27 @@ class TestParseSseEvent(unittest.TestCase):
         self.assertEqual(parse_sse_event(b'data: {"a":\ndata: 1}\n\n')["a"], 1)
 
 
+class TestEventPrefilter(unittest.TestCase):
+    def test_event_name(self):
+        self.assertEqual(sse_event_name(COMPLETED_EVENT), b"response.completed")
+        self.assertEqual(sse_event_name(b": ping\r\nevent:x\r\n\r\n"), b"x")
+        self.assertIsNone(sse_event_name(b'data: {"type":"x"}\n\n'))
+
+    def test_event_line_decides(self):
+        names = (b"response.completed",)
+        self.assertTrue(may_be_event(COMPLETED_EVENT, names))
+        self.assertFalse(may_be_event(DELTA_EVENT, names))
+        # A delta whose text mentions a terminal event is still skipped.
+        self.assertFalse(may_be_event(DELTA_EVENT.replace(
+            b'"Pe"', b'"response.completed"'), names))
+
+    def test_without_event_line_falls_back_to_search(self):
+        names = (b"response.completed",)
+        bare = COMPLETED_EVENT.partition(b"\n")[2]
+        self.assertTrue(may_be_event(bare, names))
+        self.assertFalse(may_be_event(DELTA_EVENT.partition(b"\n")[2], names))
+
+
 class TestUsageFromEvent(unittest.TestCase):
     def test_completed_yields_usage(self):
         u = usage_from_event(parse_sse_event(COMPLETED_EVENT))
@@ -136,6 +158,15 @@ class TestResponsesStreamUsage(unittest.TestCase):
         b = to_billing_tokens(acc.usage())
         self.assertEqual((b["prompt_tokens"], b["completion_tokens"]), (34, 21))
 
+    def test_deltas_are_not_decoded(self):
+        acc = _ResponsesStreamUsage()
+        with mock.patch("llmproxy.streaming.parse_sse_event",
+                wraps=parse_sse_event) as parse:
+            for c in [CREATED_EVENT, DELTA_EVENT, DELTA_EVENT, COMPLETED_EVENT]:
+                acc(c)
+        parse.assert_called_once_with(COMPLETED_EVENT)
+        self.assertEqual(acc.usage()["output_tokens"], 21)
+
     def test_missing_usage_raises(self):
         acc = _ResponsesStreamUsage()
         acc(CREATED_EVENT)
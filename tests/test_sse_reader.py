@@ -0,0 +1,69 @@
+import unittest
+
+import aiohttp
+import aiohttp.test_utils
+
+from llmproxy.streaming import FrameTooLarge, SSEReader
+
+
+class TestSSEReader(aiohttp.test_utils.AioHTTPTestCase):
+    async def get_application(self):
+        app = aiohttp.web.Application()
+        app.add_routes([
+            aiohttp.web.get("/1", self.create_chunk_handler([b"chunk1\n\n", b"chunk2\n\n"])),
+            aiohttp.web.get("/2", self.create_chunk_handler([b"chunk1\n", b"\nchunk2\n\n"])),
+            aiohttp.web.get("/3", self.create_chunk_handler([b"chunk1", b"\n\nchunk2\n\n"])),
+            aiohttp.web.get("/4", self.create_chunk_handler([b"chunk1\n", b"\n", b"chunk2\n\n"])),
+            aiohttp.web.get("/5", self.create_chunk_handler([b"chunk1", b"\n\n", b"chunk2\n\n"])),
+            aiohttp.web.get("/6", self.create_chunk_handler([b"chunk1", b"\n", b"\nchunk2\n\n"])),
+            aiohttp.web.get("/crlf", self.create_chunk_handler([b"chunk1\r\n\r", b"\nchunk2\r\n", b"\r\n"])),
+            aiohttp.web.get("/tail", self.create_chunk_handler([b"chunk1\n\nchunk2"])),
+            aiohttp.web.get("/big", self.create_chunk_handler([b"x" * 100, b"x" * 100])),
+        ])
+        return app
+
+    @staticmethod
+    def create_chunk_handler(chunks):
+        async def handler(req):
+            res = aiohttp.web.StreamResponse()
+            res.enable_chunked_encoding()
+            await res.prepare(req)
+            for chunk in chunks:
+                await res.write(chunk)
+            return res
+
+        return handler
+
+    async def test_sse_reader(self):
+        for endpoint in ["/1", "/2", "/3", "/4", "/5", "/6"]:
+            with self.subTest(endpoint=endpoint):
+                async with self.client.request("GET", endpoint) as res:
+                    reader = SSEReader(res.content)
+                    self.assertEqual(await reader.read_block(), b"chunk1\n\n")
+                    self.assertEqual(await reader.read_block(), b"chunk2\n\n")
+                    self.assertEqual(await reader.read_block(), b"")
+
+    async def test_sse_reader_crlf(self):
+        async with self.client.request("GET", "/crlf") as res:
+            reader = SSEReader(res.content)
+            self.assertEqual(await reader.read_block(), b"chunk1\r\n\r\n")
+            self.assertEqual(await reader.read_block(), b"chunk2\r\n\r\n")
+            self.assertEqual(await reader.read_block(), b"")
+
+    async def test_sse_reader_returns_partial_tail_at_eof(self):
+        async with self.client.request("GET", "/tail") as res:
+            reader = SSEReader(res.content)
+            self.assertEqual(await reader.read_block(), b"chunk1\n\n")
+            self.assertEqual(await reader.read_block(), b"chunk2")
+            self.assertEqual(await reader.read_block(), b"")
+
+    async def test_sse_reader_frame_limit(self):
+        async with self.client.request("GET", "/big") as res:
+            reader = SSEReader(res.content, max_frame_size=150)
+            with self.assertRaises(FrameTooLarge):
+                while await reader.read_block():
+                    pass
+
+
+if __name__ == '__main__':
+    unittest.main()